@@ -0,0 +1,728 @@
+import asyncio
+import socket
+import ssl
+import threading
+import time
+from urllib.parse import urlsplit
+from metrics import DownloadMetrics
+from retry import STALL_TIMEOUT, DownloadCancelled, ErrorBudget, StatusError, backoff, error_message
+
+READ_SIZE = 64 * 1024
+SLOT_POLL_INTERVAL = 0.05
+THROTTLE_STATUS_CODES = (429, 503)
+THROTTLE_BACKOFF = 1.0
+WAIT_POLL_INTERVAL = 0.1
+
+
+def parse_content_range(status, headers):
+    """
+    Tells which part of the file a response to a range request carries.
+
+    A 206 or 416 response describes it in Content-Range. A 200 response carries the whole
+    file, whose size is in Content-Length.
+
+    :param status: The status code of the response.
+    :type status: int
+    :param headers: The headers of the response, looked up by lower-case name.
+    :type headers: dict
+    :return: The first byte of the body and the size of the whole file, which is None if
+        the server did not tell.
+    :rtype: tuple
+    """
+    if status in (206, 416):
+        unit, _, spec = headers.get('content-range', '').partition(' ')
+        first_last, _, size = spec.partition('/')
+        try:
+            first = 0 if first_last.strip() == '*' else int(first_last.partition('-')[0])
+            return first, None if size.strip() == '*' else int(size)
+        except ValueError:
+            return 0, None
+    length = headers.get('content-length')
+    return 0, int(length) if length and length.isdigit() else None
+
+
+def check_range(status, headers, segment, total_size):
+    """
+    Checks that a successful response to the request for a segment carries that segment
+    of the same file, so that its body can be written at the segment's position.
+
+    :param status: The status code of the response, 200 or 206.
+    :type status: int
+    :param headers: The headers of the response, looked up by lower-case name.
+    :type headers: dict
+    :param segment: The segment that was requested.
+    :type segment: Segment
+    :param total_size: The size of the file being downloaded.
+    :type total_size: int
+    :raises: Exception if the response starts elsewhere or belongs to a file of another
+        size, which retrying the same mirror will not fix.
+    """
+    first, size = parse_content_range(status, headers)
+    if status == 200 and segment.position != 0:
+        raise Exception("The server ignored the Range header.")
+    if first != segment.position:
+        raise Exception(f"The server sent bytes from {first} instead of {segment.position}.")
+    if size is not None and size != total_size:
+        raise Exception(f"The server sent part of a file of {size} bytes instead of {total_size}.")
+
+
+class Origin:
+    """The address to connect to and the request target for a URL."""
+
+    def __init__(self, url):
+        """
+        Initializes an Origin instance.
+
+        :param url: The URL of the file. Redirects are not followed, so this should be the
+            final URL.
+        :type url: str
+        """
+        parts = urlsplit(url)
+        self.url = url
+        self.tls = parts.scheme == 'https'
+        self.host = parts.hostname
+        self.port = parts.port or (443 if self.tls else 80)
+        self.host_header = self.host if parts.port is None else f"{self.host}:{parts.port}"
+        self.path = (parts.path or '/') + (f"?{parts.query}" if parts.query else '')
+        self.ssl_context = ssl.create_default_context() if self.tls else None
+
+
+class AsyncRangeEngine:
+    """
+    Downloads the segments of a file over many connections from a single asyncio loop.
+
+    Each connection is a coroutine speaking plain HTTP/1.1 over non-blocking sockets, so
+    hundreds of range requests can be in flight without a thread per connection. The
+    segments come from the same SegmentScheduler and go through the same SegmentWriter
+    as with the threaded engine. The bytes written are counted in downloaded, which the
+    DownloadManager reads on its own schedule.
+
+    Each segment is downloaded from the mirror picked by the MirrorSet. A worker keeps
+    its connection open for the next segment if that goes to the same mirror. If a
+    request fails, the rest of the segment goes back to the scheduler and the ErrorBudget
+    decides whether the worker retries it after a backoff, as with the threaded engine.
+
+    The number of connections can be changed while downloading with set_concurrency:
+    extra workers are started right away, surplus ones stop after their current segment.
+
+    While the download is paused, the workers stop after their current read, hand the
+    rest of their segments back to the scheduler, close their connections and wait to be
+    resumed.
+    """
+
+    def __init__(self, mirrors, scheduler, writer, concurrency, limiter=None, on_error=None, tuner=None,
+                 metrics=None, error_budget=None, stall_timeout=STALL_TIMEOUT, resumed=None, opened=None):
+        """
+        Initializes an AsyncRangeEngine instance.
+
+        :param mirrors: The mirrors to download the file from. Redirects are not
+            followed, so their URLs should be the final ones.
+        :type mirrors: MirrorSet
+        :param scheduler: The scheduler to take segments to download from.
+        :type scheduler: SegmentScheduler
+        :param writer: The writer to hand the received bytes to.
+        :type writer: SegmentWriter
+        :param concurrency: The number of connections to download over.
+        :type concurrency: int
+        :param limiter: The limiter to hold a slot of while requesting a segment, if any.
+        :type limiter: ConnectionLimiter
+        :param on_error: Called with the error message if a connection fails.
+        :type on_error: callable
+        :param tuner: The tuner to report response times and throttling to when the number
+            of connections is tuned automatically. A throttled request then backs off and
+            is retried instead of failing the download.
+        :type tuner: ConnectionTuner
+        :param metrics: Where the metrics of every request are recorded. Defaults to a
+            DownloadMetrics of the engine's own.
+        :type metrics: DownloadMetrics
+        :param error_budget: Decides whether to retry failed requests. Defaults to an
+            ErrorBudget of the engine's own.
+        :type error_budget: ErrorBudget
+        :param stall_timeout: The seconds without data after which the stall watchdog
+            aborts a request, for the error messages. Defaults to STALL_TIMEOUT.
+        :type stall_timeout: float
+        :param resumed: Set while the download runs, cleared while it is paused. Defaults
+            to an event of the engine's own that is never cleared.
+        :type resumed: threading.Event
+        :param opened: The response to the first request of the download, which the first
+            worker reads its segment from before taking any other. Defaults to none.
+        :type opened: OpenedResponse
+        """
+        self.mirrors = mirrors
+        self.origins = {}
+        self.scheduler = scheduler
+        self.writer = writer
+        self.concurrency = concurrency
+        self.limiter = limiter
+        self.on_error = on_error
+        self.tuner = tuner
+        self.metrics = metrics if metrics is not None else DownloadMetrics()
+        self.error_budget = error_budget if error_budget is not None else ErrorBudget()
+        self.stall_timeout = stall_timeout
+        self.resumed = resumed
+        if resumed is None:
+            self.resumed = threading.Event()
+            self.resumed.set()
+        self.opened = opened
+        self.downloaded = 0
+        self.cancelled = False
+        self.loop = None
+        self.tasks = set()
+        self.workers = 0
+        self.started_workers = 0
+
+    def run(self):
+        """Runs the download to completion on a new event loop in the calling thread."""
+        asyncio.run(self.main())
+
+    async def main(self):
+        """
+        Starts one worker coroutine per connection and waits for all of them, including
+        those started in the meantime.
+
+        If the last workers retired with segments handed back to the scheduler, or chunks
+        failed verification, a new worker is started to download them.
+        """
+        self.loop = asyncio.get_running_loop()
+        self.spawn_workers()
+        while self.tasks:
+            done, _ = await asyncio.wait(self.tasks, return_when=asyncio.FIRST_COMPLETED)
+            self.tasks -= done
+            if not self.tasks:
+                await self.loop.run_in_executor(None, self.writer.drain)
+                if not self.cancelled and self.scheduler.pending:
+                    self.spawn_workers(1)
+        if self.opened is not None:
+            self.opened.close()
+
+    def spawn_workers(self, count=None):
+        """
+        Starts workers until there are as many as the concurrency, or count more.
+
+        Must be called on the event loop.
+
+        :param count: The number of workers to start. Defaults to the number missing.
+        :type count: int
+        """
+        if count is None:
+            count = self.concurrency - self.workers
+        for _ in range(count):
+            self.workers += 1
+            self.tasks.add(self.loop.create_task(self.worker(self.started_workers)))
+            self.started_workers += 1
+
+    def set_concurrency(self, concurrency):
+        """
+        Changes the number of connections, from any thread.
+
+        :param concurrency: The number of connections to download over.
+        :type concurrency: int
+        """
+        self.concurrency = concurrency
+        if self.loop is not None:
+            try:
+                self.loop.call_soon_threadsafe(self.spawn_workers)
+            except RuntimeError:
+                pass  # The loop has already finished.
+
+    def should_retire(self):
+        """
+        Tells a worker whether to stop because there are more workers than the concurrency.
+        The worker is no longer counted once this has returned True.
+
+        :rtype: bool
+        """
+        if self.workers > self.concurrency:
+            self.workers -= 1
+            return True
+        return False
+
+    async def worker(self, number):
+        """
+        Downloads segments over one keep-alive connection until the scheduler runs out of work.
+
+        Every request is recorded in the metrics with how it ended. A failed request is
+        retried after a backoff that grows with every failure in a row, unless the
+        ErrorBudget gives up.
+
+        If the download fails, the error message is passed to on_error and the worker stops.
+
+        :param number: The number of the worker, for the metrics.
+        :type number: int
+        """
+        connection = None
+        connected_to = None
+        retired = False
+        failures = 0
+        try:
+            while not self.cancelled:
+                if self.should_retire():
+                    retired = True
+                    break
+                if self.opened is None and not self.resumed.is_set():
+                    self.close(connection)
+                    connection = None
+                    await self.park()
+                    continue
+                opened, self.opened = self.opened, None
+                mirror = self.mirrors.pick(opened.url if opened is not None else None)
+                length = 0
+                started = time.monotonic()
+                delay = 0.0
+                try:
+                    if opened is not None:
+                        segment, record = opened.segment, opened.record
+                    else:
+                        segment = self.scheduler.acquire(mirror.speed)
+                        if segment is None:
+                            break
+                        record = self.metrics.segment(number, mirror.url, segment.position, segment.end)
+                    segment.mirror = mirror
+                    position = segment.position
+                    if connected_to is not mirror:
+                        self.close(connection)
+                        connection = None
+                    try:
+                        if opened is not None:
+                            await self.read_opened(opened, segment, record)
+                        else:
+                            await self.acquire_slot(mirror.url)
+                            try:
+                                connection = await self.download_segment(connection, segment,
+                                                                         self.origin(mirror.url), record)
+                                connected_to = mirror
+                            finally:
+                                if self.limiter is not None:
+                                    self.limiter.release(mirror.url)
+                    except Exception as e:
+                        self.close(connection)
+                        connection = None
+                        if self.cancelled:
+                            self.metrics.finish(record, 'cancelled', position=segment.position)
+                            break
+                        if not self.resumed.is_set():
+                            self.metrics.finish(record, 'paused', position=segment.position)
+                        else:
+                            message = error_message(e, record.stalled, self.stall_timeout)
+                            self.metrics.finish(record, 'stalled' if record.stalled else 'failed', message,
+                                                segment.position)
+                            if self.error_budget.failed(self.mirrors, mirror, e, message):
+                                failures += 1
+                                delay = backoff(failures)
+                    else:
+                        if self.cancelled:
+                            outcome = 'cancelled'
+                        elif self.tuner is not None and record.status in THROTTLE_STATUS_CODES:
+                            outcome = 'throttled'
+                        elif not self.resumed.is_set() and segment.remaining > 0:
+                            outcome = 'paused'
+                        else:
+                            outcome = 'done'
+                            failures = 0
+                            self.error_budget.succeeded()
+                        self.metrics.finish(record, outcome, position=segment.position)
+                    finally:
+                        length = segment.position - position
+                        self.scheduler.release(segment)
+                finally:
+                    self.mirrors.put_back(mirror, length, time.monotonic() - started)
+                await self.wait(delay)
+        except Exception as e:
+            if not self.cancelled and self.on_error is not None:
+                self.on_error(str(e) or type(e).__name__)
+        finally:
+            if not retired:
+                self.workers -= 1
+            self.close(connection)
+
+    async def wait(self, delay):
+        """
+        Sleeps for the given number of seconds, waking up early if the download is cancelled.
+
+        :param delay: The number of seconds to sleep.
+        :type delay: float
+        """
+        deadline = time.monotonic() + delay
+        while delay > 0 and not self.cancelled:
+            await asyncio.sleep(min(delay, WAIT_POLL_INTERVAL))
+            delay = deadline - time.monotonic()
+
+    async def park(self):
+        """
+        Waits while the download is paused, after writing the journal out. Returns early
+        if the download is cancelled.
+        """
+        await self.loop.run_in_executor(None, self.writer.flush)
+        while not self.cancelled and not self.resumed.is_set():
+            await asyncio.sleep(WAIT_POLL_INTERVAL)
+
+    def origin(self, url):
+        """
+        Returns the parsed origin of a mirror's URL, parsing each URL only once.
+
+        :param url: The URL of the mirror.
+        :type url: str
+        :rtype: Origin
+        """
+        origin = self.origins.get(url)
+        if origin is None:
+            origin = self.origins[url] = Origin(url)
+        return origin
+
+    async def acquire_slot(self, url):
+        """
+        Waits for a slot of the limiter, if there is one.
+
+        The limiter is shared with threads, so instead of blocking the event loop on it
+        the slot is polled for every SLOT_POLL_INTERVAL seconds.
+
+        :param url: The URL to be requested.
+        :type url: str
+        :raises: DownloadCancelled if the download is cancelled while waiting.
+        """
+        if self.limiter is not None:
+            while not self.limiter.try_acquire(url):
+                if self.cancelled:
+                    raise DownloadCancelled()
+                await asyncio.sleep(SLOT_POLL_INTERVAL)
+
+    async def connect(self, origin, record):
+        """
+        Opens a new connection to a server.
+
+        The host name is resolved, the TCP connection made and the TLS handshake done as
+        separate steps, so the metrics can tell how long each took. The resolved
+        addresses are tried in turn.
+
+        :param origin: The server to connect to.
+        :type origin: Origin
+        :param record: The metrics of the request the connection is opened for.
+        :type record: SegmentMetrics
+        :return: The reader and writer of the connection.
+        :rtype: tuple
+        """
+        return await asyncio.wait_for(self.open_connection(origin, record), self.mirrors.timeout)
+
+    async def open_connection(self, origin, record):
+        """
+        Opens a new connection to a server without a timeout, see connect.
+
+        :param origin: The server to connect to.
+        :type origin: Origin
+        :param record: The metrics of the request the connection is opened for.
+        :type record: SegmentMetrics
+        :return: The reader and writer of the connection.
+        :rtype: tuple
+        """
+        loop = asyncio.get_running_loop()
+        started = time.monotonic()
+        addresses = await loop.getaddrinfo(origin.host, origin.port, type=socket.SOCK_STREAM)
+        resolved = time.monotonic()
+        sock = None
+        error = None
+        for family, type_, proto, _, address in addresses:
+            sock = socket.socket(family, type_, proto)
+            sock.setblocking(False)
+            try:
+                await loop.sock_connect(sock, address)
+            except OSError as e:
+                sock.close()
+                sock = None
+                error = e
+                continue
+            except BaseException:
+                sock.close()
+                raise
+            break
+        if sock is None:
+            raise error or ConnectionError(f"Cannot resolve {origin.host}.")
+        connected = time.monotonic()
+        try:
+            connection = await asyncio.open_connection(sock=sock, ssl=origin.ssl_context,
+                                                       server_hostname=origin.host if origin.tls else None)
+        except BaseException:
+            sock.close()
+            raise
+        record.connected(resolved - started, connected - resolved,
+                         time.monotonic() - connected if origin.tls else None)
+        return connection
+
+    def abort(self, writer):
+        """
+        Cuts off a connection from any thread, which makes the read waiting on it fail.
+
+        :param writer: The writer of the connection.
+        :type writer: asyncio.StreamWriter
+        """
+        try:
+            self.loop.call_soon_threadsafe(writer.transport.abort)
+        except RuntimeError:
+            pass  # The loop has already finished.
+
+    def close(self, connection):
+        """
+        Closes a connection if there is one.
+
+        :param connection: The reader and writer of the connection, or None.
+        :type connection: tuple
+        """
+        if connection is not None:
+            connection[1].close()
+
+    async def download_segment(self, connection, segment, origin, record):
+        """
+        Downloads a single segment from a mirror into the output file.
+
+        Stops as soon as the end of the segment is reached, which may be earlier than
+        requested if another worker has stolen part of it in the meantime, or when the
+        download is paused or cancelled. The connection is closed in that case, because
+        the rest of the response is still unread.
+
+        When the number of connections is tuned, a response with one of the
+        THROTTLE_STATUS_CODES is reported to the tuner and the worker waits THROTTLE_BACKOFF
+        seconds, leaving the segment to be taken again.
+
+        :param connection: The connection left open by the previous segment, or None.
+        :type connection: tuple
+        :param segment: The segment to download.
+        :type segment: Segment
+        :param origin: The mirror to download it from, which connection is open to.
+        :type origin: Origin
+        :param record: The metrics of the request, which get the connection and response
+            times and the time spent reading, writing and waiting for the rate limiters.
+        :type record: SegmentMetrics
+        :return: The connection if it can be reused for the next segment, or None.
+        :rtype: tuple
+        """
+        timeout = self.mirrors.timeout
+        if connection is None:
+            connection = await self.connect(origin, record)
+        reader, writer = connection
+        end = segment.end
+        started = time.monotonic()
+        writer.write((
+            f"GET {origin.path} HTTP/1.1\r\n"
+            f"Host: {origin.host_header}\r\n"
+            f"Range: bytes={segment.position}-{end}\r\n"
+            "Accept-Encoding: identity\r\n"
+            "Connection: keep-alive\r\n"
+            "\r\n"
+        ).encode('latin-1'))
+        await writer.drain()
+
+        version, status, headers = await self.read_head(reader, timeout)
+        record.responded(status, time.monotonic() - started)
+        if self.tuner is not None:
+            if status in THROTTLE_STATUS_CODES:
+                self.close(connection)
+                self.tuner.note_throttled()
+                record.waited(THROTTLE_BACKOFF)
+                await asyncio.sleep(THROTTLE_BACKOFF)
+                return None
+            self.tuner.note_latency(time.monotonic() - started)
+        if status not in (200, 206):
+            raise StatusError(status, f"{status} Error for url: {origin.url}")
+        check_range(status, headers, segment, self.writer.output.size)
+        keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+        record.watch(lambda: self.abort(writer))
+
+        if not await self.write_body(segment, self.read_body(reader, headers, timeout, record), record,
+                                     end if status == 206 else None):
+            self.close(connection)
+            return None
+        if not keep_alive or 'content-length' not in headers and 'transfer-encoding' not in headers:
+            self.close(connection)
+            return None
+        return connection
+
+    async def read_opened(self, opened, segment, record):
+        """
+        Downloads the first segment of the file from the response the DownloadManager has
+        already opened, reading it in the default executor since it is a blocking
+        requests response, and closes the response afterwards.
+
+        :param opened: The response to the first request of the download.
+        :type opened: OpenedResponse
+        :param segment: The segment it carries.
+        :type segment: Segment
+        :param record: The metrics of the request.
+        :type record: SegmentMetrics
+        """
+        record.watch(opened.abort)
+        try:
+            await self.write_body(segment, self.read_opened_body(opened, segment, record), record)
+        finally:
+            opened.close()
+
+    async def read_opened_body(self, opened, segment, record):
+        """
+        Yields the chunks of the body of an opened response as they are received, up to
+        the end of the segment, since the response is open-ended.
+
+        :param opened: The response to the first request of the download.
+        :type opened: OpenedResponse
+        :param segment: The segment it carries.
+        :type segment: Segment
+        :param record: The metrics of the request, which get the time spent reading.
+        :type record: SegmentMetrics
+        """
+        while segment.remaining > 0:
+            started = time.monotonic()
+            data = await self.loop.run_in_executor(None, opened.read, min(READ_SIZE, segment.remaining))
+            record.read(len(data), time.monotonic() - started)
+            if not data:
+                return
+            yield data
+
+    async def write_body(self, segment, body, record, end=None):
+        """
+        Writes the chunks of a response body into the output file as they arrive.
+
+        Stops as soon as the end of the segment is reached, or when the download is paused
+        or cancelled. A body that ends exactly where the segment does counts as written
+        whole, so its connection can carry the next request, unless the segment was
+        shortened for another worker in the meantime and the body goes on.
+
+        :param segment: The segment the body belongs to.
+        :type segment: Segment
+        :param body: The chunks of the body.
+        :type body: async iterator
+        :param record: The metrics of the request, which get the time spent writing and
+            waiting for the rate limiters.
+        :type record: SegmentMetrics
+        :param end: The last byte of the file the body carries, if known.
+        :type end: int
+        :return: True if the whole body was written, False if it stopped early and the
+            rest of the response is still unread.
+        :rtype: bool
+        :raises: ConnectionError if the body ended before the segment did.
+        """
+        async for data in body:
+            if self.cancelled:
+                return False
+            written = time.monotonic()
+            length = self.writer.write(segment, data)
+            record.wrote(time.monotonic() - written)
+            self.downloaded += length
+            delay = self.writer.throttle(len(data))
+            if delay:
+                record.waited(delay)
+                await asyncio.sleep(delay)
+            if length < len(data) or not self.resumed.is_set():
+                return False
+            if segment.remaining <= 0:
+                return segment.end == end and await self.body_ended(body)
+        if segment.remaining > 0 and not self.cancelled and self.resumed.is_set():
+            raise ConnectionError("The server closed the connection mid-response.")
+        return True
+
+    async def body_ended(self, body):
+        """
+        Tells whether a response body has nothing left after the end of its segment.
+
+        A body whose length is known ends without another read once it has been consumed;
+        a chunked one has its last chunk and trailer read.
+
+        :param body: The chunks of the body.
+        :type body: async iterator
+        :rtype: bool
+        """
+        try:
+            await body.__anext__()
+        except StopAsyncIteration:
+            return True
+        return False
+
+    async def read_head(self, reader, timeout):
+        """
+        Reads the status line and headers of a response.
+
+        :param reader: The reader of the connection.
+        :type reader: asyncio.StreamReader
+        :param timeout: The number of seconds to wait for each line.
+        :type timeout: float
+        :return: The HTTP version, the status code and a dict of lower-cased headers.
+        :rtype: tuple
+        """
+        line = await asyncio.wait_for(reader.readline(), timeout)
+        if not line:
+            raise ConnectionError("The server closed the connection.")
+        version, status = line.decode('latin-1').split(' ', 2)[:2]
+        headers = {}
+        while True:
+            line = await asyncio.wait_for(reader.readline(), timeout)
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        return version, int(status), headers
+
+    async def read(self, reader, size, timeout, record):
+        """
+        Reads the next bytes of a response and records how long that took.
+
+        :param reader: The reader of the connection.
+        :type reader: asyncio.StreamReader
+        :param size: The most bytes to read.
+        :type size: int
+        :param timeout: The number of seconds to wait.
+        :type timeout: float
+        :param record: The metrics of the request.
+        :type record: SegmentMetrics
+        :return: The bytes read, empty at the end of the stream.
+        :rtype: bytes
+        """
+        started = time.monotonic()
+        data = await asyncio.wait_for(reader.read(size), timeout)
+        record.read(len(data), time.monotonic() - started)
+        return data
+
+    async def read_body(self, reader, headers, timeout, record):
+        """
+        Yields the body of a response as it arrives.
+
+        Handles Content-Length, chunked transfer encoding and bodies ended by closing the
+        connection.
+
+        :param reader: The reader of the connection.
+        :type reader: asyncio.StreamReader
+        :param headers: The lower-cased headers of the response.
+        :type headers: dict
+        :param timeout: The number of seconds to wait for each read.
+        :type timeout: float
+        :param record: The metrics of the request.
+        :type record: SegmentMetrics
+        """
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            while True:
+                size_line = await asyncio.wait_for(reader.readline(), timeout)
+                size = int(size_line.split(b';', 1)[0], 16)
+                if size == 0:
+                    while await asyncio.wait_for(reader.readline(), timeout) not in (b'\r\n', b'\n', b''):
+                        pass
+                    return
+                while size:
+                    data = await self.read(reader, min(READ_SIZE, size), timeout, record)
+                    if not data:
+                        raise ConnectionError("The server closed the connection mid-response.")
+                    size -= len(data)
+                    yield data
+                await asyncio.wait_for(reader.readline(), timeout)
+        elif 'content-length' in headers:
+            remaining = int(headers['content-length'])
+            while remaining:
+                data = await self.read(reader, min(READ_SIZE, remaining), timeout, record)
+                if not data:
+                    raise ConnectionError("The server closed the connection mid-response.")
+                remaining -= len(data)
+                yield data
+        else:
+            while True:
+                data = await self.read(reader, READ_SIZE, timeout, record)
+                if not data:
+                    return
+                yield data
+
+    def cancel(self):
+        """Cancel the download."""
+        self.cancelled = True
@@ -0,0 +1,739 @@
+"""
+Benchmarks the download engines against a local HTTP server that supports Range requests.
+
+Every combination of file size, connection count and engine is downloaded in a fresh
+process, so that its CPU time, peak memory and disk writes are its own. The server can
+add latency, jitter, a per-connection bandwidth cap and failed requests, and can cap
+the connections open at once like a busy origin. Results are
+printed as a table and can be written as JSON lines, one object per download, and
+compared against an earlier run to catch regressions.
+
+Usage: python bench.py [--sizes MB [MB ...]] [--connections N [N ...]] [--engines E [E ...]]
+                       [--repeat N] [--latency MS] [--jitter MS] [--bandwidth MB/s]
+                       [--error-rate P] [--seed N] [--max-server-connections N]
+                       [--limit MB/s] [--dir DIR]
+                       [--json PATH] [--baseline PATH] [--tolerance PERCENT]
+"""
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import platform
+import random
+import re
+import select
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from cli import parse_threads
+from core import AUTO, AUTO_MAX_CONNECTIONS, DownloadManager, ENGINES, ConnectionCountCache, ConnectionPool, \
+    MetadataCache
+from http2_engine import HTTP2_SUPPORTED
+
+if HTTP2_SUPPORTED:
+    import h2.config
+    import h2.connection
+    import h2.events
+    import h2.settings
+
+try:
+    import resource
+except ImportError:  # Not available on Windows.
+    resource = None
+
+SEND_BLOCK_SIZE = 64 * 1024
+TTFB_POLL_INTERVAL = 0.001
+H2_PREFACE = b'PRI * HTTP/2.0\r\n\r\nSM\r\n\r\n'
+H2_SERVER_STREAMS = 256
+MB = 1024 * 1024
+
+
+class RangeRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves generated data of the size named by the path, e.g. /1048576.bin, honouring
+    single byte-range requests and the conditions the server simulates.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        """Keeps the benchmark output free of request logs."""
+
+    def send_head(self):
+        """
+        Sends the status line and headers for the requested range.
+
+        :return: The bytes of the response body, or None if the path names no size.
+        :rtype: memoryview
+        """
+        data = self.server.data_for_path(self.path)
+        if data is None:
+            self.send_error(404)
+            return None
+        status, headers, body = self.server.respond(data, self.headers.get('Range', ''))
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        return body
+
+    def send_body(self, body):
+        """
+        Sends a response body no faster than the server's bandwidth per connection.
+
+        :param body: The bytes to send.
+        :type body: memoryview
+        """
+        bandwidth = self.server.bandwidth
+        start = time.perf_counter()
+        for offset in range(0, len(body), SEND_BLOCK_SIZE):
+            self.wfile.write(body[offset:offset + SEND_BLOCK_SIZE])
+            if bandwidth:
+                delay = start + (offset + SEND_BLOCK_SIZE) / bandwidth - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+
+    def do_HEAD(self):
+        """Answers a HEAD request."""
+        self.send_head()
+
+    def do_GET(self):
+        """
+        Answers a GET request after the configured latency and jitter. With the error
+        rate, some requests get a 503 instead and some are cut off halfway through the
+        body.
+        """
+        delay, failure = self.server.draw()
+        if delay:
+            time.sleep(delay)
+        if failure == 'status':
+            self.send_error(503)
+            return
+        body = self.send_head()
+        if body is None:
+            return
+        if failure == 'reset':
+            self.send_body(body[:len(body) // 2])
+            self.close_connection = True
+            return
+        self.send_body(body)
+
+
+def select_range(data, range_header):
+    """
+    Picks the part of the data a Range header asks for, answering 416 when it starts past
+    the end, as it always does for empty data.
+
+    :param data: The whole data.
+    :type data: memoryview
+    :param range_header: The Range header of the request, or an empty string.
+    :type range_header: str
+    :return: The status code, the response headers as (name, value) pairs, and the body.
+    :rtype: tuple
+    """
+    match = re.fullmatch(r'bytes=(\d+)-(\d*)', range_header)
+    headers = []
+    if match and int(match[1]) >= len(data):
+        status = 416
+        headers.append(('Content-Range', f"bytes */{len(data)}"))
+        body = data[:0]
+    elif match:
+        start = int(match[1])
+        end = min(int(match[2]) if match[2] else len(data) - 1, len(data) - 1)
+        status = 206
+        headers.append(('Content-Range', f"bytes {start}-{end}/{len(data)}"))
+        body = data[start:end + 1]
+    else:
+        status = 200
+        body = data
+    headers += [('Content-Length', str(len(body))), ('Accept-Ranges', 'bytes'), ('ETag', '"bench"')]
+    return status, headers, body
+
+
+class BenchServer(ThreadingHTTPServer):
+    """
+    A threading HTTP server with a listen backlog deep enough for hundreds of connections.
+
+    Connections that start with the HTTP/2 preface are served over HTTP/2 with prior
+    knowledge (h2c) when the h2 package is installed and http2 is set, all others over
+    HTTP/1.1. With max_connections, the server behaves like an origin that caps the
+    connections per client: connections beyond the cap get a 429 response, or are closed
+    for HTTP/2.
+    """
+
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, address, latency=0.0, jitter=0.0, bandwidth=None, error_rate=0.0, seed=0,
+                 max_connections=None, http2=True):
+        """
+        Initializes a BenchServer instance.
+
+        :param address: The host and port to listen on.
+        :type address: tuple
+        :param latency: The delay added before answering every GET, in seconds.
+        :type latency: float
+        :param jitter: The most extra delay added at random to every GET, in seconds.
+        :type jitter: float
+        :param bandwidth: The speed limit of every connection in bytes per second, if any.
+        :type bandwidth: float
+        :param error_rate: The share of GETs that fail, between 0 and 1.
+        :type error_rate: float
+        :param seed: The seed of the random jitter and failures.
+        :type seed: int
+        :param max_connections: The most connections open at once, if any.
+        :type max_connections: int
+        :param http2: Whether to speak HTTP/2 to clients that start with its preface.
+            Without it the server only speaks HTTP/1.1, like most plain HTTP servers.
+        :type http2: bool
+        """
+        super().__init__(address, RangeRequestHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.max_connections = max_connections
+        self.http2 = http2 and HTTP2_SUPPORTED
+        self.connections = 0
+        self.lock = threading.Lock()
+        self.size = None
+        self.content = None
+
+    def finish_request(self, request, client_address):
+        """
+        Serves a connection over HTTP/2 or HTTP/1.1, or turns it away if there are
+        max_connections open already.
+
+        :param request: The socket of the connection.
+        :type request: socket.socket
+        :param client_address: The address of the client.
+        :type client_address: tuple
+        """
+        with self.lock:
+            refused = self.max_connections is not None and self.connections >= self.max_connections
+            if not refused:
+                self.connections += 1
+        try:
+            http2 = self.http2 and request.recv(len(H2_PREFACE), socket.MSG_PEEK | socket.MSG_WAITALL) == H2_PREFACE
+            if refused:
+                if not http2:
+                    request.recv(SEND_BLOCK_SIZE)  # The request, so that closing does not reset the connection.
+                    request.sendall(b"HTTP/1.1 429 Too Many Requests\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+            elif http2:
+                self.serve_http2(request)
+            else:
+                super().finish_request(request, client_address)
+        finally:
+            if not refused:
+                with self.lock:
+                    self.connections -= 1
+
+    def serve_http2(self, sock):
+        """
+        Serves the requests of an HTTP/2 connection, one stream per request, under the same
+        conditions as over HTTP/1.1: the latency applies to every request, the bandwidth to
+        the connection as a whole, and failed requests get a 503 response or have their
+        stream reset halfway through the body. The streams take turns sending a frame each.
+
+        :param sock: The socket of the connection.
+        :type sock: socket.socket
+        """
+        connection = h2.connection.H2Connection(h2.config.H2Configuration(client_side=False,
+                                                                          header_encoding='utf-8'))
+        connection.initiate_connection()
+        connection.update_settings({h2.settings.SettingCodes.MAX_CONCURRENT_STREAMS: H2_SERVER_STREAMS})
+        sock.sendall(connection.data_to_send())
+        waiting = {}  # Stream ID: (time to answer at, status, headers, body, failure).
+        sending = {}  # Stream ID: [body, bytes sent, bytes to send before a reset or None].
+        sent = 0
+        start = time.perf_counter()
+        while True:
+            now = time.perf_counter()
+            for stream_id in [stream_id for stream_id, answer in waiting.items() if answer[0] <= now]:
+                _, status, headers, body, failure = waiting.pop(stream_id)
+                headers = [(':status', str(status))] + [(name.lower(), value) for name, value in headers]
+                connection.send_headers(stream_id, headers, end_stream=not body)
+                if body:
+                    sending[stream_id] = [body, 0, len(body) // 2 if failure == 'reset' else None]
+            ready = any(connection.local_flow_control_window(stream_id) > 0 for stream_id in sending)
+            delay = start + sent / self.bandwidth - now if self.bandwidth else 0
+            if delay > 0:
+                ready = False
+            timeouts = [answer[0] - now for answer in waiting.values()]
+            if sending and delay > 0:
+                timeouts.append(delay)
+            readable, _, _ = select.select([sock], [], [], 0 if ready else max(min(timeouts, default=1.0), 0))
+            if readable:
+                data = sock.recv(SEND_BLOCK_SIZE)
+                if not data:
+                    return
+                for event in connection.receive_data(data):
+                    if isinstance(event, h2.events.RequestReceived):
+                        waiting[event.stream_id] = self.answer_http2(dict(event.headers), now)
+                    elif isinstance(event, h2.events.StreamReset):
+                        waiting.pop(event.stream_id, None)
+                        sending.pop(event.stream_id, None)
+                    elif isinstance(event, h2.events.ConnectionTerminated):
+                        return
+            if ready:
+                for stream_id, state in list(sending.items()):
+                    body, offset, cut = state
+                    length = min(connection.local_flow_control_window(stream_id), connection.max_outbound_frame_size,
+                                 SEND_BLOCK_SIZE, (cut if cut is not None else len(body)) - offset)
+                    if length <= 0:
+                        continue
+                    end = offset + length
+                    connection.send_data(stream_id, bytes(body[offset:end]), end_stream=cut is None and end == len(body))
+                    sent += length
+                    state[1] = end
+                    if cut is not None and end >= cut:
+                        connection.reset_stream(stream_id)
+                        del sending[stream_id]
+                    elif end == len(body):
+                        del sending[stream_id]
+            sock.sendall(connection.data_to_send())
+
+    def answer_http2(self, headers, now):
+        """
+        Prepares the response to an HTTP/2 request.
+
+        :param headers: The headers of the request, including the pseudo-headers.
+        :type headers: dict
+        :param now: The time the request was received, from time.perf_counter.
+        :type now: float
+        :return: The time to answer at, the status, the headers, the body and the
+            failure drawn for the request, see draw.
+        :rtype: tuple
+        """
+        delay, failure = self.draw()
+        data = self.data_for_path(headers.get(':path', ''))
+        if data is None:
+            return now + delay, 404, [('Content-Length', '0')], None, None
+        if failure == 'status':
+            return now + delay, 503, [('Content-Length', '0')], None, None
+        status, response_headers, body = self.respond(data, headers.get('range', ''))
+        return now + delay, status, response_headers, body, failure
+
+    def respond(self, data, range_header):
+        """
+        Picks the response to a GET for the data of a path, over HTTP/1.1 and HTTP/2 alike.
+        Subclasses simulate misbehaving servers by overriding it.
+
+        :param data: The data of the path.
+        :type data: memoryview
+        :param range_header: The Range header of the request, or an empty string.
+        :type range_header: str
+        :return: The status code, the response headers as (name, value) pairs, and the body,
+            see select_range.
+        :rtype: tuple
+        """
+        return select_range(data, range_header)
+
+    def handle_error(self, request, client_address):
+        """Ignores clients hanging up mid-response, which the downloader does when a segment is stolen."""
+
+    def data(self, size):
+        """
+        Returns the data served for a size, generating it on first use. Only the data of
+        the last size asked for is kept, as the benchmark downloads one size at a time.
+
+        :param size: The number of bytes.
+        :type size: int
+        :rtype: memoryview
+        """
+        with self.lock:
+            if size != self.size:
+                self.content = memoryview(make_data(size))
+                self.size = size
+            return self.content
+
+    def data_for_path(self, path):
+        """
+        Returns the data served for a path naming its size, e.g. /1048576.bin.
+
+        :param path: The path of the request.
+        :type path: str
+        :return: The data, or None if the path names no size.
+        :rtype: memoryview
+        """
+        match = re.fullmatch(r'/(\d+)\.bin', path)
+        return self.data(int(match[1])) if match else None
+
+    def draw(self):
+        """
+        Draws the delay and the failure, if any, of a GET request.
+
+        :return: The delay in seconds, and None, 'status' for a 503 response or 'reset'
+            for a response cut off halfway.
+        :rtype: tuple
+        """
+        with self.lock:
+            delay = self.latency + self.rng.uniform(0, self.jitter)
+            failure = None
+            if self.rng.random() < self.error_rate:
+                failure = self.rng.choice(('status', 'reset'))
+        return delay, failure
+
+
+def make_data(size):
+    """
+    Returns the same pseudo-random bytes for the same size in every process.
+
+    :param size: The number of bytes.
+    :type size: int
+    :rtype: bytes
+    """
+    rng = random.Random(size)
+    block = 1024 * 1024
+    return b''.join(rng.randbytes(min(block, size - start)) for start in range(0, size, block))
+
+
+def serve(conditions, ports):
+    """
+    Runs a range-serving HTTP server on a free local port until the process is killed.
+
+    :param conditions: The keyword arguments of BenchServer: latency, jitter, bandwidth,
+        error_rate, seed and max_connections.
+    :type conditions: dict
+    :param ports: The queue to report the port of the server on.
+    :type ports: multiprocessing.Queue
+    """
+    server = BenchServer(('127.0.0.1', 0), **conditions)
+    ports.put(server.server_address[1])
+    server.serve_forever()
+
+
+def start_server(**conditions):
+    """
+    Starts the benchmark server in its own process, so it does not compete with the
+    downloader for the GIL or show up in its CPU time.
+
+    :param conditions: The keyword arguments of BenchServer.
+    :return: The server process and the base URL to download from; append "/SIZE.bin".
+    :rtype: tuple
+    """
+    ports = multiprocessing.Queue()
+    process = multiprocessing.Process(target=serve, args=(conditions, ports), daemon=True)
+    process.start()
+    return process, f"http://127.0.0.1:{ports.get(timeout=60)}"
+
+
+def io_counters():
+    """
+    Returns the I/O counters of the current process on Linux.
+
+    :return: The bytes written to storage (write_bytes) and passed to write calls
+        (wchar), or None for each where /proc is not available.
+    :rtype: tuple
+    """
+    try:
+        with open('/proc/self/io', 'r') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+    except OSError:
+        return None, None
+    return int(counters['write_bytes']), int(counters['wchar'])
+
+
+def peak_rss():
+    """
+    Returns the peak resident memory of the current process.
+
+    :return: The peak in bytes, or None where the resource module is not available.
+    :rtype: int
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def file_digest(path):
+    """
+    Returns the SHA-256 hex digest of a file.
+
+    :param path: The path of the file.
+    :type path: str
+    :rtype: str
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(MB), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def measure(url, directory, engine, connections, piece_size, rate_limit, results):
+    """
+    Downloads the URL once and measures it. Runs in a process of its own, started with
+    the spawn method so that it inherits no memory from the benchmark.
+
+    The time to first byte is taken by watching the downloaded byte count from a
+    thread until it moves. The caches of the download are kept in the directory, so
+    runs neither write to the user's caches nor start from what an earlier run left there.
+
+    :param url: The URL to download.
+    :type url: str
+    :param directory: The directory to download into.
+    :type directory: str
+    :param engine: One of ENGINES.
+    :type engine: str
+    :param connections: The number of connections, or AUTO.
+    :type connections: int or str
+    :param piece_size: The piece size in bytes.
+    :type piece_size: int
+    :param rate_limit: The bandwidth limit of the download in bytes per second, if any.
+    :type rate_limit: float
+    :param results: The queue to put the measurements on, as a dict.
+    :type results: multiprocessing.Queue
+    """
+    save_path = os.path.join(directory, 'bench.bin')
+    errors = []
+
+    def collect_errors(event, *args):
+        if event == 'error_occurred':
+            errors.append(args[0])
+
+    manager = DownloadManager(url, save_path, connections, piece_size=piece_size,
+                              pool=ConnectionPool(AUTO_MAX_CONNECTIONS if connections == AUTO else connections),
+                              engine=engine, update_interval=None, rate_limit=rate_limit,
+                              connection_cache=ConnectionCountCache(os.path.join(directory, 'connections.json')),
+                              metadata_cache=MetadataCache(os.path.join(directory, 'metadata.json')))
+    manager.add_listener(collect_errors)
+    first_byte = []
+    done = threading.Event()
+
+    def watch_first_byte():
+        while not done.is_set():
+            if manager.bytes_downloaded() > 0:
+                first_byte.append(time.perf_counter() - start)
+                return
+            time.sleep(TTFB_POLL_INTERVAL)
+
+    write_bytes, wchar = io_counters()
+    start_cpu = time.process_time()
+    start = time.perf_counter()
+    watcher = threading.Thread(target=watch_first_byte, daemon=True)
+    watcher.start()
+    try:
+        manager.run()
+    except Exception as e:
+        errors.append(str(e))
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - start_cpu
+    done.set()
+    watcher.join()
+    end_write_bytes, end_wchar = io_counters()
+    results.put({
+        'seconds': elapsed,
+        'ttfb': first_byte[0] if first_byte else None,
+        'cpu_seconds': cpu,
+        'peak_rss': peak_rss(),
+        'disk_bytes_written': None if write_bytes is None else end_write_bytes - write_bytes,
+        'bytes_passed_to_write': None if wchar is None else end_wchar - wchar,
+        'error': errors[0] if errors else None,
+        'sha256': None if errors else file_digest(save_path),
+    })
+
+
+def run_download(url, engine, connections, piece_size, rate_limit=None, directory=None):
+    """
+    Downloads the URL once in a fresh process and measures it.
+
+    :param directory: The directory to download into; a temporary directory in it is
+        used and removed afterwards. Defaults to the system's temporary directory.
+    :type directory: str
+    :return: The measurements taken by measure.
+    :rtype: dict
+    """
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    with tempfile.TemporaryDirectory(dir=directory) as run_directory:
+        process = context.Process(target=measure, args=(url, run_directory, engine, connections,
+                                                        piece_size, rate_limit, results))
+        process.start()
+        result = results.get()
+        process.join()
+    return result
+
+
+def git_commit():
+    """
+    Returns the commit of the code being benchmarked.
+
+    :return: The commit hash, or None outside a git checkout.
+    :rtype: str
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+CONFIGURATION_KEYS = ('engine', 'size', 'connections', 'piece_size', 'rate_limit', 'latency', 'jitter',
+                      'bandwidth', 'error_rate', 'max_connections')
+
+
+def configuration(record):
+    """
+    Returns what a download was configured with, to match it with the same
+    configuration in another run.
+
+    :param record: The result of a download as written to the JSON lines.
+    :type record: dict
+    :return: The values of CONFIGURATION_KEYS, None for those older runs did not record.
+    :rtype: tuple
+    """
+    return tuple(record.get(key) for key in CONFIGURATION_KEYS)
+
+
+def load_baseline(path):
+    """
+    Reads the median throughput of every configuration from an earlier run's JSON lines.
+
+    :param path: The path of the JSON lines file.
+    :type path: str
+    :return: The median bytes per second of the successful downloads, keyed by
+        configuration.
+    :rtype: dict
+    """
+    speeds = {}
+    with open(path, 'r') as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                if record['ok']:
+                    speeds.setdefault(configuration(record), []).append(record['bytes_per_second'])
+    return {key: statistics.median(values) for key, values in speeds.items()}
+
+
+def format_optional(value, format_spec, scale=1):
+    """
+    Formats a measurement that may be missing.
+
+    :param value: The measurement, or None.
+    :type value: float
+    :param format_spec: The format for the scaled value, e.g. ">10.1f".
+    :type format_spec: str
+    :param scale: The number to divide the value by.
+    :type scale: float
+    :rtype: str
+    """
+    width = re.match(r'\D*(\d*)', format_spec)[1]
+    return format(value / scale, format_spec) if value is not None else format('-', f">{width}")
+
+
+def main(argv=None):
+    """
+    Downloads every file size with every engine at every connection count and prints a
+    table of the results.
+
+    With --limit, every download is rate limited and the table also shows how far the
+    achieved speed was from the limit. With --json, every download is also written as a
+    line of JSON. With --baseline, the median speed of every configuration is compared
+    with the one in an earlier --json file.
+
+    :return: The exit code: 1 if a download failed or produced a corrupt file, or if a
+        configuration got slower than the baseline by more than the tolerance, else 0.
+    :rtype: int
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the download engines.")
+    parser.add_argument('--sizes', '--size', type=float, nargs='+', default=[64], help="file sizes in MB")
+    parser.add_argument('--connections', type=parse_threads, nargs='+', default=[4, 16, 64, 256],
+                        help="connection counts, or auto")
+    parser.add_argument('--engines', nargs='+', choices=ENGINES,
+                        default=[engine for engine in ENGINES if engine != 'http2' or HTTP2_SUPPORTED],
+                        help="engines to compare; http2 needs the h2 package")
+    parser.add_argument('--repeat', type=int, default=1, help="downloads per configuration")
+    parser.add_argument('--latency', type=float, default=20, help="per-request latency in ms")
+    parser.add_argument('--jitter', type=float, default=0, help="most extra random latency per request in ms")
+    parser.add_argument('--bandwidth', type=float, help="server bandwidth per connection in MB/s")
+    parser.add_argument('--error-rate', type=float, default=0, help="share of requests that fail, 0 to 1")
+    parser.add_argument('--seed', type=int, default=0, help="seed of the random jitter and errors")
+    parser.add_argument('--max-server-connections', type=int,
+                        help="most connections the server accepts at once, refusing the rest")
+    parser.add_argument('--piece-size', type=int, default=256 * 1024, help="piece size in bytes")
+    parser.add_argument('--limit', type=float, help="bandwidth limit in MB/s")
+    parser.add_argument('--dir', help="directory to download into")
+    parser.add_argument('--json', help="file to write the results to as JSON lines, - for standard output")
+    parser.add_argument('--baseline', help="JSON lines of an earlier run to compare against")
+    parser.add_argument('--tolerance', type=float, default=10, help="slowdown in percent counted as a regression")
+    args = parser.parse_args(argv)
+    rate_limit = args.limit * MB if args.limit else None
+    baseline = load_baseline(args.baseline) if args.baseline else None
+    table = sys.stderr if args.json == '-' else sys.stdout
+    json_file = sys.stdout if args.json == '-' else open(args.json, 'w') if args.json else None
+
+    conditions = {'latency': args.latency / 1000, 'jitter': args.jitter / 1000,
+                  'bandwidth': args.bandwidth * MB if args.bandwidth else None,
+                  'error_rate': args.error_rate, 'seed': args.seed,
+                  'max_connections': args.max_server_connections}
+    server, base_url = start_server(**conditions)
+    environment = {'commit': git_commit(), 'python': platform.python_version(),
+                   'platform': platform.platform(), 'cpus': os.cpu_count()}
+    print(f"{'engine':<10}{'MB':>8}{'conns':>7}{'seconds':>9}{'MB/s':>9}{'ttfb ms':>9}{'cpu s/GB':>10}"
+          f"{'rss MB':>8}{'disk MB':>9}" + (f"{'vs limit':>10}" if rate_limit else ''), file=table)
+    speeds = {}
+    failed = False
+    for size_mb in args.sizes:
+        size = int(size_mb * MB)
+        expected = hashlib.sha256(make_data(size)).hexdigest()
+        for connections in args.connections:
+            for engine in args.engines:
+                for run in range(args.repeat):
+                    result = run_download(f"{base_url}/{size}.bin", engine, connections, args.piece_size,
+                                          rate_limit, args.dir)
+                    if result['error'] is None and result['sha256'] != expected:
+                        result['error'] = f"{engine} produced a corrupt file"
+                    ok = result['error'] is None
+                    failed |= not ok
+                    speed = size / result['seconds']
+                    record = {'engine': engine, 'size': size, 'connections': connections, 'run': run,
+                              'piece_size': args.piece_size, 'rate_limit': rate_limit, **conditions,
+                              'ok': ok, 'bytes_per_second': speed,
+                              'cpu_seconds_per_gb': result['cpu_seconds'] / (size / 1024 ** 3), **result,
+                              **environment, 'time': time.time()}
+                    del record['sha256']
+                    if ok:
+                        speeds.setdefault(configuration(record), []).append(speed)
+                    if json_file is not None:
+                        json_file.write(json.dumps(record) + '\n')
+                        json_file.flush()
+                    if not ok:
+                        print(f"{engine:<10}{size_mb:>8g}{connections:>7}  failed: {result['error']}", file=table)
+                        continue
+                    print(f"{engine:<10}{size_mb:>8g}{connections:>7}{result['seconds']:>9.2f}{speed / MB:>9.1f}"
+                          f"{format_optional(result['ttfb'], '>9.1f', 0.001)}"
+                          f"{result['cpu_seconds'] / (size / 1024 ** 3):>10.2f}"
+                          f"{format_optional(result['peak_rss'], '>8.0f', MB)}"
+                          f"{format_optional(result['disk_bytes_written'], '>9.0f', MB)}"
+                          + (f"{(speed / rate_limit - 1) * 100:>+9.1f}%" if rate_limit else ''), file=table)
+    server.terminate()
+    if json_file is not None and json_file is not sys.stdout:
+        json_file.close()
+
+    if baseline is not None:
+        print(f"\n{'engine':<10}{'MB':>8}{'conns':>7}{'base MB/s':>11}{'now MB/s':>10}{'change':>9}", file=table)
+        for key, values in speeds.items():
+            engine, size, connections = key[:3]
+            before = baseline.get(key)
+            if before is None:
+                continue
+            now = statistics.median(values)
+            change = (now / before - 1) * 100
+            regressed = change < -args.tolerance
+            failed |= regressed
+            print(f"{engine:<10}{size / MB:>8g}{connections:>7}{before / MB:>11.1f}{now / MB:>10.1f}"
+                  f"{change:>+8.1f}%" + ('  REGRESSION' if regressed else ''), file=table)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
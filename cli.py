@@ -0,0 +1,303 @@
+import argparse
+import re
+import sys
+import threading
+from core import AUTO, DownloadManager, ENGINES, UPDATE_INTERVAL, default_save_path, global_rate_limiter
+from delta import DeltaManifest
+from http2_engine import HTTP2_SUPPORTED
+from integrity import ChunkHashList, parse_digest
+from download_queue import DownloadQueue, MAX_CONNECTIONS, MAX_DOWNLOADS, MAX_PER_HOST
+from metrics import MetricsServer, TraceWriter
+from retry import ERROR_BUDGET
+
+
+def format_bytes(value):
+    """
+    Formats a number of bytes with a binary unit.
+
+    :param value: The number of bytes.
+    :type value: float
+    :return: The formatted value, e.g. "12.3 MiB".
+    :rtype: str
+    """
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if abs(value) < 1024:
+            return f"{value:.1f} {unit}"
+        value /= 1024
+    return f"{value:.1f} TiB"
+
+
+def parse_rate(text):
+    """
+    Parses a bandwidth limit with an optional binary unit, such as "500K" or "2.5MiB/s".
+
+    :param text: The limit as typed by the user. "0", "off" and "none" mean no limit.
+    :type text: str
+    :return: The limit in bytes per second, or None for no limit.
+    :rtype: float
+    :raises: ValueError if the text is not a valid limit.
+    """
+    if text.strip().upper() in ('OFF', 'NONE'):
+        return None
+    match = re.fullmatch(r'(\d+(?:\.\d*)?)\s*([KMG]?)(?:I?B)?(?:/S)?', text.strip().upper())
+    if not match:
+        raise ValueError(f"Invalid rate: {text!r}")
+    rate = float(match[1]) * 1024 ** ' KMG'.index(match[2] or ' ')
+    return rate or None
+
+
+def parse_threads(text):
+    """
+    Parses the number of connections per file.
+
+    :param text: A positive number, or "auto" to tune the number while downloading.
+    :type text: str
+    :return: The number of connections, or AUTO.
+    :rtype: int or str
+    :raises: ValueError if the text is neither.
+    """
+    if text.strip().lower() == AUTO:
+        return AUTO
+    threads = int(text)
+    if threads < 1:
+        raise ValueError(f"Invalid number of threads: {text!r}")
+    return threads
+
+
+def read_commands(manager, stream=sys.stdin, output=sys.stderr):
+    """
+    Reads commands that change a running download, one per line, until the stream ends.
+
+    limit RATE sets the limit over all downloads, file-limit RATE the limit of each file,
+    where RATE is anything parse_rate accepts.
+
+    :param manager: The DownloadManager or DownloadQueue being run.
+    :param stream: The stream to read commands from. Defaults to sys.stdin.
+    :type stream: file
+    :param output: The stream to report invalid commands on. Defaults to sys.stderr.
+    :type output: file
+    """
+    commands = {
+        'limit': global_rate_limiter.set_rate,
+        'file-limit': manager.set_rate_limit,
+    }
+    for line in stream:
+        words = line.split()
+        if not words:
+            continue
+        try:
+            if words[0] not in commands or len(words) != 2:
+                raise ValueError(f"Unknown command: {line.strip()!r}, expected "
+                                 + " or ".join(f"'{name} RATE'" for name in commands))
+            commands[words[0]](parse_rate(words[1]))
+        except ValueError as e:
+            output.write(f"\n{e}\n")
+
+
+class ProgressPrinter:
+    """
+    A DownloadManager or DownloadQueue listener that prints progress on a single
+    terminal line, and a line for every finished file of a queue.
+
+    Error messages are collected in errors so the caller can pick an exit code.
+    """
+
+    def __init__(self, stream=sys.stderr):
+        """
+        Initializes a ProgressPrinter instance.
+
+        :param stream: The stream to print to. Defaults to sys.stderr.
+        :type stream: file
+        """
+        self.stream = stream
+        self.downloaded = 0
+        self.percent = 0.0
+        self.speed = 0.0
+        self.time_remaining = None
+        self.errors = []
+
+    def __call__(self, event, *args):
+        """
+        Handles an event of the DownloadManager or DownloadQueue.
+
+        :param event: The name of the event.
+        :type event: str
+        """
+        if event == 'progress':
+            self.downloaded = args[0]
+        elif event == 'progress_percent':
+            self.percent = args[0]
+        elif event == 'speed':
+            self.speed = args[0]
+            line = f"\r{self.percent:6.2f}%  {format_bytes(self.downloaded)}  {format_bytes(self.speed)}/s"
+            if self.time_remaining is not None:
+                line += f"  ETA {self.time_remaining:.0f}s" if self.speed > 0 else "  ETA --"
+            self.stream.write(line + "   ")
+            self.stream.flush()
+        elif event == 'time_remaining':
+            self.time_remaining = args[0]
+        elif event == 'job_finished':
+            status = "failed" if args[1] is not None else "done"
+            self.stream.write(f"\r{status}: {args[0]}\n")
+        elif event == 'mirror_dropped':
+            self.stream.write(f"\nDropped mirror {args[0]}: {args[1]}\n")
+        elif event == 'error_occurred':
+            self.errors.append(args[0])
+            self.stream.write(f"\nError: {args[0]}\n")
+
+
+def build_parser():
+    """
+    Creates the argument parser of the headless command line.
+
+    :rtype: argparse.ArgumentParser
+    """
+    parser = argparse.ArgumentParser(prog='main.py --headless', description="Download files without the GUI.")
+    parser.add_argument('urls', nargs='*', metavar='url', help="the URLs of the files to download")
+    parser.add_argument('-i', '--input-file', help="a file listing URLs to download, one per line")
+    parser.add_argument('-o', '--output', help="the path to save a single file to (default: the file name of the URL)")
+    parser.add_argument('-d', '--directory', default='', help="the directory to save several files to")
+    parser.add_argument('-t', '--threads', type=parse_threads, default=4,
+                        help="the number of connections per file, or 'auto' to tune it while downloading (default: 4)")
+    parser.add_argument('--engine', choices=ENGINES, default='threads', help="the download engine; http2 needs the h2 package (default: threads)")
+    parser.add_argument('--max-downloads', type=int, default=MAX_DOWNLOADS,
+                        help=f"the number of files downloaded at once (default: {MAX_DOWNLOADS})")
+    parser.add_argument('--max-connections', type=int, default=MAX_CONNECTIONS,
+                        help=f"the number of connections over all files (default: {MAX_CONNECTIONS})")
+    parser.add_argument('--max-per-host', type=int, default=MAX_PER_HOST,
+                        help=f"the number of connections to a single host (default: {MAX_PER_HOST})")
+    parser.add_argument('--limit', type=parse_rate, metavar='RATE',
+                        help="the bandwidth limit over all files, e.g. 500K or 2M (default: none)")
+    parser.add_argument('--file-limit', type=parse_rate, metavar='RATE',
+                        help="the bandwidth limit of each file (default: none)")
+    parser.add_argument('-m', '--mirror', action='append', default=[], metavar='URL',
+                        help="another URL of the same single file to download from at the same time; may be repeated")
+    parser.add_argument('--digest', metavar='[ALGORITHM:]HEX',
+                        help="the expected digest of a single file, e.g. sha256:9f86d0..., checked while downloading")
+    parser.add_argument('--chunk-hashes', metavar='FILE',
+                        help="a JSON list of chunk digests of a single file; bad chunks are downloaded again")
+    parser.add_argument('--delta', metavar='MANIFEST',
+                        help="the path or URL of the delta manifest of a single file (see delta.py); only the "
+                             "blocks the existing file lacks are downloaded")
+    parser.add_argument('--basis', metavar='FILE',
+                        help="the existing file to take unchanged blocks from with --delta (default: the output file)")
+    parser.add_argument('-x', '--extract', metavar='DEST',
+                        help="decompress a single .gz, .bz2, .xz or .zst file to the file DEST, or unpack a tar "
+                             "archive into the directory DEST, while it downloads")
+    parser.add_argument('--discard-archive', action='store_true',
+                        help="delete the downloaded file once --extract has finished with it")
+    parser.add_argument('--max-errors', type=int, default=ERROR_BUDGET, metavar='N',
+                        help="the number of failed requests in a row to retry before a file fails "
+                             f"(default: {ERROR_BUDGET})")
+    parser.add_argument('--trace', metavar='FILE',
+                        help="append the metrics of every request to FILE as JSON lines")
+    parser.add_argument('--metrics-port', type=int, metavar='PORT',
+                        help="serve Prometheus metrics on http://127.0.0.1:PORT/metrics and JSON on /stats")
+    parser.add_argument('-q', '--quiet', action='store_true', help="do not print progress")
+    return parser
+
+
+def main(argv=None):
+    """
+    Downloads files from the command line, without importing any Qt module.
+
+    A single URL is downloaded by a DownloadManager. Several URLs, or an input file, go
+    through a DownloadQueue that keeps to the connection limits.
+
+    The download runs on a worker thread so Ctrl+C can cancel it; the partial files and
+    their journals are kept, so running the same command again resumes them. Meanwhile
+    the bandwidth limits can be changed by typing commands, see read_commands.
+
+    With --trace, the metrics of every request are appended to a file as JSON lines. With
+    --metrics-port, they can be scraped over HTTP while the download runs.
+
+    :param argv: The command line arguments, without the program name.
+    :type argv: list
+    :return: The exit code.
+    :rtype: int
+    """
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if not args.urls and not args.input_file:
+        parser.error("no URL given")
+    update_interval = None if args.quiet else UPDATE_INTERVAL
+    global_rate_limiter.set_rate(args.limit)
+    try:
+        trace = TraceWriter(args.trace) if args.trace else None
+    except OSError as e:
+        parser.error(f"cannot open the trace file: {e}")
+
+    if args.engine == 'http2' and not HTTP2_SUPPORTED:
+        parser.error("--engine http2 needs the h2 package, install it with: pip install h2")
+    if args.basis and not args.delta:
+        parser.error("--basis can only be used with --delta")
+    if args.discard_archive and not args.extract:
+        parser.error("--discard-archive can only be used with --extract")
+
+    if len(args.urls) == 1 and not args.input_file:
+        chunk_hashes = None
+        delta = None
+        try:
+            if args.digest:
+                parse_digest(args.digest)
+            if args.chunk_hashes:
+                chunk_hashes = ChunkHashList.load(args.chunk_hashes)
+            if args.delta:
+                delta = DeltaManifest.load(args.delta)
+        except (OSError, ValueError) as e:
+            parser.error(str(e))
+        manager = DownloadManager(args.urls[0], args.output or default_save_path(args.urls[0], args.directory),
+                                  args.threads, engine=args.engine, update_interval=update_interval,
+                                  rate_limit=args.file_limit, digest=args.digest,
+                                  chunk_hashes=chunk_hashes, mirrors=args.mirror, trace=trace,
+                                  max_errors=args.max_errors, delta=delta, basis=args.basis,
+                                  extract_to=args.extract, keep_archive=not args.discard_archive)
+    else:
+        if args.output:
+            parser.error("-o can only be used with a single URL, use -d for several")
+        if args.digest or args.chunk_hashes or args.mirror or args.delta or args.extract:
+            parser.error("--digest, --chunk-hashes, --mirror, --delta and --extract can only be used with a single URL")
+        manager = DownloadQueue(args.directory, args.threads, args.max_downloads, args.max_connections,
+                                args.max_per_host, engine=args.engine, update_interval=update_interval,
+                                rate_limit=args.file_limit, trace=trace, max_errors=args.max_errors)
+        for url in args.urls:
+            manager.add(url)
+        if args.input_file:
+            manager.add_list(args.input_file)
+
+    metrics_server = None
+    if args.metrics_port is not None:
+        source = manager.stats if isinstance(manager, DownloadQueue) else lambda: [manager.stats()]
+        try:
+            metrics_server = MetricsServer(args.metrics_port, source)
+        except OSError as e:
+            parser.error(f"cannot serve metrics on port {args.metrics_port}: {e}")
+
+    printer = ProgressPrinter()
+    manager.add_listener(printer)
+    thread = threading.Thread(target=manager.run)
+    thread.start()
+    if sys.stdin is not None:
+        threading.Thread(target=read_commands, args=(manager,), daemon=True).start()
+    try:
+        while thread.is_alive():
+            thread.join(0.5)
+    except KeyboardInterrupt:
+        manager.cancel()
+        thread.join()
+        print("\nCancelled. Run the same command again to resume.", file=sys.stderr)
+        return 130
+    finally:
+        if metrics_server is not None:
+            metrics_server.close()
+        if trace is not None:
+            trace.close()
+    if printer.errors:
+        return 1
+    if not args.quiet:
+        print(file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,126 @@
+import threading
+
+import pytest
+
+from bench import BenchServer
+from core import ConnectionCountCache, ConnectionPool, DownloadManager, ENGINES, MetadataCache
+from http2_engine import HTTP2_SUPPORTED
+
+AVAILABLE_ENGINES = [engine for engine in ENGINES if engine != 'http2' or HTTP2_SUPPORTED]
+
+
+def start_server(server_class=BenchServer, **conditions):
+    """
+    Runs a BenchServer on a free local port in a daemon thread.
+
+    :param server_class: The BenchServer subclass to run.
+    :type server_class: type
+    :param conditions: The keyword arguments of the server.
+    :return: The server; stop it with shutdown and server_close.
+    :rtype: BenchServer
+    """
+    bench_server = server_class(('127.0.0.1', 0), **conditions)
+    threading.Thread(target=bench_server.serve_forever, daemon=True).start()
+    bench_server.url = f"http://127.0.0.1:{bench_server.server_address[1]}"
+    return bench_server
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    """Keeps the caches of every download in the test's temporary directory."""
+    monkeypatch.delenv('LOCALAPPDATA', raising=False)
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+
+
+@pytest.fixture(scope='session')
+def server():
+    """
+    A local BenchServer serving generated files over HTTP/1.1, and HTTP/2 with prior
+    knowledge when h2 is installed, for the whole test session.
+
+    :return: The base URL to download from; append "/SIZE.bin".
+    :rtype: str
+    """
+    bench_server = start_server()
+    yield bench_server.url
+    bench_server.shutdown()
+    bench_server.server_close()
+
+
+@pytest.fixture(scope='session')
+def http1_server():
+    """
+    A local BenchServer that only speaks HTTP/1.1, like most plain HTTP servers, for the
+    whole test session.
+
+    :return: The base URL to download from; append "/SIZE.bin".
+    :rtype: str
+    """
+    bench_server = start_server(http2=False)
+    yield bench_server.url
+    bench_server.shutdown()
+    bench_server.server_close()
+
+
+@pytest.fixture
+def make_server():
+    """
+    Starts BenchServers with the conditions of a test, stopped when the test is over.
+
+    :return: A function taking the BenchServer subclass, if any, and its keyword
+        arguments, and returning the running server, whose url attribute is the base URL.
+    :rtype: callable
+    """
+    servers = []
+
+    def make(server_class=BenchServer, **conditions):
+        servers.append(start_server(server_class, **conditions))
+        return servers[-1]
+    yield make
+    for bench_server in servers:
+        bench_server.shutdown()
+        bench_server.server_close()
+
+
+@pytest.fixture(params=AVAILABLE_ENGINES)
+def engine(request):
+    """Every engine that can run here."""
+    return request.param
+
+
+@pytest.fixture
+def make_manager(tmp_path):
+    """
+    Creates DownloadManagers whose caches live in the test's temporary directory, and
+    which record the errors they report.
+
+    :return: A function taking the URL, the save path and the keyword arguments of
+        DownloadManager, and returning the manager, with the errors in its errors
+        attribute. The save path defaults to file.bin in the temporary directory.
+    :rtype: callable
+    """
+    def make(url, save_path=None, **kwargs):
+        kwargs.setdefault('update_interval', None)
+        kwargs.setdefault('pool', ConnectionPool(64))
+        kwargs.setdefault('metadata_cache', MetadataCache(str(tmp_path / 'metadata.json')))
+        kwargs.setdefault('connection_cache', ConnectionCountCache(str(tmp_path / 'connections.json')))
+        manager = DownloadManager(url, save_path or str(tmp_path / 'file.bin'), **kwargs)
+        manager.errors = []
+        manager.add_listener(lambda event, *args: manager.errors.append(args[0])
+                             if event == 'error_occurred' else None)
+        return manager
+    return make
+
+
+@pytest.fixture
+def download(make_manager):
+    """
+    Downloads a file like make_manager, see there, and returns the manager after its run.
+
+    :rtype: callable
+    """
+    def run(url, save_path=None, **kwargs):
+        manager = make_manager(url, save_path, **kwargs)
+        manager.run()
+        return manager
+    return run
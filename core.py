@@ -1,82 +1,1876 @@
 import requests
-from os import remove
+import os
+import bisect
+import json
 import math
+import socket
+import threading
 import time
-from PyQt6.QtCore import QThread, pyqtSignal
+from collections import deque
+from contextlib import ExitStack, contextmanager, nullcontext
+from urllib.parse import unquote, urlsplit
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import NewConnectionError
+from urllib3.util.connection import allowed_gai_family
+from async_engine import AsyncRangeEngine, THROTTLE_BACKOFF, THROTTLE_STATUS_CODES, check_range, parse_content_range
+from concurrent.futures import ThreadPoolExecutor
+from extract import PrefixExtractor
+from http2_engine import HTTP2_SUPPORTED, Http2RangeEngine
+from integrity import ChunkVerifier, PrefixHasher, parse_digest
+from metrics import DownloadMetrics
+from mirrors import MIRROR_TIMEOUT, TIMEOUT, MirrorSet
+from retry import ERROR_BUDGET, STALL_CHECK_INTERVAL, STALL_TIMEOUT, DownloadCancelled, ErrorBudget, backoff, error_message
 
-class PartDownloadThread(QThread):
-    progress = pyqtSignal(int)
-    finished_part = pyqtSignal(int)
-    error = pyqtSignal(str)
+MIN_PIECE_SIZE = 1024 * 1024
+MAX_PIECE_SIZE = 64 * 1024 * 1024
+MIN_SPLIT_SIZE = 256 * 1024
+SMALL_FILE_SIZE = 4 * 1024 * 1024
+JOURNAL_INTERVAL = 1.0
+POOL_SIZE_PER_HOST = 16
+ENGINES = ('threads', 'asyncio', 'http2')
+UPDATE_INTERVAL = 0.1
+SPEED_WINDOW = 5.0
+MIN_READ_SIZE = 64 * 1024
+MAX_READ_SIZE = 4 * 1024 * 1024
+READ_TARGET_TIME = 0.1
+RATE_BURST_TIME = 0.25
+THROTTLE_POLL_INTERVAL = 0.1
+AUTO = 'auto'
+AUTO_START_CONNECTIONS = 2
+AUTO_MAX_CONNECTIONS = 32
+AUTO_TUNE_INTERVAL = 1.0
+AUTO_MIN_GAIN = 0.1
+AUTO_LATENCY_FACTOR = 3.0
+AUTO_LATENCY_SLACK = 0.05
 
-    def __init__(self, url, start, end, part_num, save_path):
+
+class OutputFile:
+    """
+    A temporary file preallocated to the full download size.
+
+    Every part writes its bytes straight to their final offset, so no merge step is
+    needed: once all parts are done the temporary file is renamed over the save path.
+    """
+
+    def __init__(self, save_path, size, allocate=False, resume=False):
+        """
+        Creates the temporary file next to the save path and sizes it.
+
+        :param save_path: The path the finished download will be saved to.
+        :type save_path: str
+        :param size: The total size of the file in bytes.
+        :type size: int
+        :param allocate: Whether to reserve the disk blocks up front with fallocate
+            instead of leaving a sparse file. Defaults to False.
+        :type allocate: bool
+        :param resume: Whether to keep the contents of an existing temporary file instead
+            of truncating it. Defaults to False.
+        :type resume: bool
+        """
+        self.save_path = save_path
+        self.temp_path = f"{save_path}.part"
+        self.size = size
+        self.lock = threading.Lock()
+        flags = os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0)
+        if not resume:
+            flags |= os.O_TRUNC
+        self.fd = os.open(self.temp_path, flags, 0o644)
+        os.ftruncate(self.fd, size)
+        if allocate and size > 0 and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(self.fd, 0, size)
+            except OSError:
+                pass  # Not supported by the filesystem, the sparse file still works.
+
+    def write_at(self, data, offset):
+        """
+        Writes data at the given offset of the file.
+
+        Uses positional writes where the platform has them, so parts never share a
+        file position and can write concurrently without locking.
+
+        :param data: The bytes to write.
+        :type data: bytes
+        :param offset: The byte offset to write the data at.
+        :type offset: int
+        """
+        if hasattr(os, 'pwrite'):
+            view = memoryview(data)
+            while view:
+                written = os.pwrite(self.fd, view, offset)
+                view = view[written:]
+                offset += written
+        else:
+            with self.lock:
+                os.lseek(self.fd, offset, os.SEEK_SET)
+                os.write(self.fd, data)
+
+    def read_at(self, offset, length):
+        """
+        Reads data back from the given offset of the file.
+
+        :param offset: The byte offset to read from.
+        :type offset: int
+        :param length: The maximum number of bytes to read.
+        :type length: int
+        :return: The bytes read, fewer than length at the end of the file.
+        :rtype: bytes
+        """
+        if hasattr(os, 'pread'):
+            return os.pread(self.fd, length, offset)
+        with self.lock:
+            os.lseek(self.fd, offset, os.SEEK_SET)
+            return os.read(self.fd, length)
+
+    def sync(self):
+        """Flushes the written data to disk."""
+        if self.fd is not None:
+            os.fsync(self.fd)
+
+    def close(self):
+        """Closes the file descriptor if it is still open."""
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def finalize(self):
+        """Closes the temporary file and renames it over the save path."""
+        self.close()
+        os.replace(self.temp_path, self.save_path)
+
+    def discard(self):
+        """Closes and deletes the temporary file."""
+        self.close()
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+
+class RangeSet:
+    """
+    A sorted list of disjoint, inclusive byte ranges.
+
+    Touching or overlapping ranges are merged as they are added, so the list stays as
+    short as the number of holes in the file.
+    """
+
+    def __init__(self, ranges=()):
+        """
+        Initializes a RangeSet instance.
+
+        :param ranges: The (start, end) ranges to start with.
+        :type ranges: iterable
+        """
+        self.ranges = []
+        for start, end in ranges:
+            self.add(start, end)
+
+    def add(self, start, end):
+        """
+        Adds the range start-end (inclusive) to the set.
+
+        :param start: The first byte of the range.
+        :type start: int
+        :param end: The last byte of the range.
+        :type end: int
+        """
+        ranges = self.ranges
+        i = bisect.bisect_left(ranges, (start,))
+        if i > 0 and ranges[i - 1][1] >= start - 1:
+            i -= 1
+        j = i
+        while j < len(ranges) and ranges[j][0] <= end + 1:
+            start = min(start, ranges[j][0])
+            end = max(end, ranges[j][1])
+            j += 1
+        ranges[i:j] = [(start, end)]
+
+    def missing(self, total_size):
+        """
+        Returns the ranges of a file of the given size that are not in the set.
+
+        :param total_size: The size of the file in bytes.
+        :type total_size: int
+        :return: The missing (start, end) ranges, in order.
+        :rtype: list
+        """
+        missing = []
+        position = 0
+        for start, end in self.ranges:
+            if start > position:
+                missing.append((position, start - 1))
+            position = max(position, end + 1)
+        if position < total_size:
+            missing.append((position, total_size - 1))
+        return missing
+
+    @property
+    def size(self):
+        """The number of bytes covered by the set."""
+        return sum(end - start + 1 for start, end in self.ranges)
+
+
+class ResumeJournal:
+    """
+    A sidecar file recording which byte ranges of a download are safely on disk.
+
+    Finished ranges are collected in memory and written out at most every
+    JOURNAL_INTERVAL seconds, each time after an fsync of the output file, so the
+    journal never claims bytes that could still be lost in a crash. Those periodic flushes
+    run on a thread of their own, so no worker, and in particular not the event loop of
+    the asyncio engines, waits for the fsyncs. The server's ETag
+    and Last-Modified are stored with the ranges so a changed file is never resumed.
+    """
+
+    def __init__(self, save_path, total_size, etag=None, last_modified=None, done=()):
+        """
+        Initializes a ResumeJournal instance.
+
+        :param save_path: The path the finished download will be saved to.
+        :type save_path: str
+        :param total_size: The total size of the file in bytes.
+        :type total_size: int
+        :param etag: The ETag the server sent for the file, if any.
+        :type etag: str
+        :param last_modified: The Last-Modified date the server sent for the file, if any.
+        :type last_modified: str
+        :param done: The (start, end) ranges that are already on disk.
+        :type done: iterable
+        """
+        self.path = f"{save_path}.journal"
+        self.total_size = total_size
+        self.etag = etag
+        self.last_modified = last_modified
+        self.done = RangeSet(done)
+        self.output = None
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.last_flush = time.monotonic()
+
+    @classmethod
+    def load(cls, save_path):
+        """
+        Loads the journal of an earlier attempt at downloading to the given save path.
+
+        :param save_path: The path the finished download will be saved to.
+        :type save_path: str
+        :return: The journal, or None if there is no usable journal.
+        :rtype: ResumeJournal or None
+        """
+        try:
+            with open(f"{save_path}.journal", 'r') as f:
+                data = json.load(f)
+            return cls(save_path, data['size'], data.get('etag'), data.get('last_modified'),
+                       [tuple(r) for r in data['done']])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def matches(self, total_size, etag, last_modified):
+        """
+        Checks whether the journal was written for the same version of the file.
+
+        :param total_size: The size of the file on the server.
+        :type total_size: int
+        :param etag: The ETag the server sent for the file, if any.
+        :type etag: str
+        :param last_modified: The Last-Modified date the server sent for the file, if any.
+        :type last_modified: str
+        :return: True if the size and validators are unchanged.
+        :rtype: bool
+        """
+        return (self.total_size == total_size and self.etag == etag
+                and self.last_modified == last_modified)
+
+    def record(self, start, end):
+        """
+        Records that the range start-end (inclusive) has been written to the output file.
+
+        Starts writing the journal out in the background if the last write is older than
+        JOURNAL_INTERVAL, unless a flush is already running. The caller never waits for it.
+
+        :param start: The first byte of the range.
+        :type start: int
+        :param end: The last byte of the range.
+        :type end: int
+        """
+        with self.lock:
+            self.done.add(start, end)
+        if time.monotonic() - self.last_flush >= JOURNAL_INTERVAL and self.flush_lock.acquire(blocking=False):
+            self.last_flush = time.monotonic()
+            threading.Thread(target=self.flush_in_background, daemon=True).start()
+
+    def flush_in_background(self):
+        """
+        Writes the journal out on a background thread that holds flush_lock, see record.
+
+        A journal that cannot be written is only left older than it could be; the next
+        flush tries again, and the one that saves the journal for good reports the error.
+        """
+        try:
+            self.flush()
+        except OSError:
+            pass
+        finally:
+            self.flush_lock.release()
+
+    def wait(self):
+        """Waits until a flush running in the background has finished."""
+        with self.flush_lock:
+            pass
+
+    def flush(self):
+        """
+        Syncs the output file and atomically replaces the journal on disk.
+
+        The ranges are copied before the output file is synced, so every range in the
+        journal was written before the fsync that made it durable.
+        """
+        with self.lock:
+            done = list(self.done.ranges)
+        if self.output is not None:
+            self.output.sync()
+        data = {
+            'size': self.total_size,
+            'etag': self.etag,
+            'last_modified': self.last_modified,
+            'done': done,
+        }
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+        self.last_flush = time.monotonic()
+
+    def prefix(self):
+        """
+        Returns the length of the part at the start of the file that is complete.
+
+        :return: The number of bytes from the start of the file up to the first hole.
+        :rtype: int
+        """
+        with self.lock:
+            ranges = self.done.ranges
+            return ranges[0][1] + 1 if ranges and ranges[0][0] == 0 else 0
+
+    def remove(self):
+        """Deletes the journal from disk, after a flush running in the background."""
+        with self.flush_lock:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+
+class Segment:
+    """
+    A byte range of the file that is downloaded by one worker at a time.
+
+    The end of a segment can move backwards while it is being downloaded, when an idle
+    worker steals the back half of it.
+    """
+
+    def __init__(self, start, end):
+        """
+        Initializes a Segment instance.
+
+        :param start: The first byte of the segment.
+        :type start: int
+        :param end: The last byte of the segment (inclusive).
+        :type end: int
+        """
+        self.start = start
+        self.end = end
+        self.position = start
+
+    @property
+    def remaining(self):
+        """The number of bytes of the segment that have not been claimed yet."""
+        return self.end - self.position + 1
+
+
+class SegmentScheduler:
+    """
+    Hands out pieces of the file to the download workers from a shared queue.
+
+    The file is cut into small pieces up front. Once the queue is empty, an idle worker
+    splits the active segment with the most bytes left in half and takes over the back
+    half, so a worker stuck on a slow connection never holds up the end of the download.
+    """
+
+    def __init__(self, ranges, piece_size, min_split=MIN_SPLIT_SIZE, align=1, speed_of=None):
+        """
+        Initializes a SegmentScheduler instance.
+
+        :param ranges: The (start, end) byte ranges that still have to be downloaded.
+        :type ranges: iterable
+        :param piece_size: The size of the pieces the ranges are cut into.
+        :type piece_size: int
+        :param min_split: The smallest piece a segment may be split into when it is
+            stolen from. Defaults to MIN_SPLIT_SIZE.
+        :type min_split: int
+        :param align: Segments are split at multiples of this many bytes where possible,
+            so that a chunk verified as a whole is usually downloaded by one worker.
+            Defaults to 1.
+        :type align: int
+        :param speed_of: Returns the speed a segment is being downloaded at, for splitting
+            segments in proportion to the speeds of the workers. Defaults to treating all
+            workers as equally fast.
+        :type speed_of: callable
+        """
+        self.lock = threading.Lock()
+        self.min_split = min_split
+        self.align = align
+        self.speed_of = speed_of
+        self.pending = deque(
+            Segment(start, min(start + piece_size - 1, end))
+            for range_start, end in ranges
+            for start in range(range_start, end + 1, piece_size)
+        )
+        self.active = set()
+
+    def time_left(self, segment):
+        """
+        Estimates how long an active segment will take to finish.
+
+        :param segment: The segment.
+        :type segment: Segment
+        :return: The remaining bytes divided by the speed of the segment, or just the
+            remaining bytes without speed_of.
+        :rtype: float
+        """
+        if self.speed_of is None:
+            return segment.remaining
+        return segment.remaining / self.speed_of(segment)
+
+    def acquire(self, speed=None):
+        """
+        Returns the next segment to download, or None if there is nothing left to do.
+
+        Takes the next piece from the queue, or when the queue is empty steals the back
+        of the active segment that will take longest to finish. The victim and the thief
+        split its remaining bytes in proportion to their speeds, so both finish at about
+        the same time; without speeds they take half each.
+
+        :param speed: The speed the calling worker is expected to download at, if known.
+        :type speed: float
+        :return: The segment the calling worker should download.
+        :rtype: Segment or None
+        """
+        with self.lock:
+            if self.pending:
+                segment = self.pending.popleft()
+            else:
+                victim = max(self.active, key=self.time_left, default=None)
+                if victim is None or victim.remaining < 2 * self.min_split:
+                    return None
+                take = victim.remaining // 2
+                if speed and self.speed_of is not None:
+                    take = int(victim.remaining * speed / (speed + self.speed_of(victim)))
+                    if take < self.min_split:
+                        return None
+                middle = victim.end + 1 - take
+                if middle - middle % self.align > victim.position:
+                    middle -= middle % self.align
+                segment = Segment(middle, victim.end)
+                victim.end = middle - 1
+            self.active.add(segment)
+            return segment
+
+    def claim(self, segment, length):
+        """
+        Claims the next bytes of a segment for the worker downloading it.
+
+        :param segment: The segment being downloaded.
+        :type segment: Segment
+        :param length: The number of bytes the worker has received.
+        :type length: int
+        :return: How many of those bytes belong to the segment; fewer than length once
+            the end of the segment has been reached or stolen.
+        :rtype: int
+        """
+        with self.lock:
+            length = max(0, min(length, segment.remaining))
+            segment.position += length
+            return length
+
+    def add(self, start, end):
+        """
+        Queues the range start-end (inclusive) to be downloaded again.
+
+        :param start: The first byte of the range.
+        :type start: int
+        :param end: The last byte of the range.
+        :type end: int
+        """
+        with self.lock:
+            self.pending.append(Segment(start, end))
+
+    def release(self, segment):
+        """
+        Marks a segment as no longer being downloaded.
+
+        If the worker stopped before the end of the segment, the rest of it goes back to
+        the front of the queue for the next worker.
+
+        :param segment: The segment the worker has stopped downloading.
+        :type segment: Segment
+        """
+        with self.lock:
+            self.active.discard(segment)
+            if segment.remaining > 0:
+                self.pending.appendleft(Segment(segment.position, segment.end))
+
+
+class ConnectionTimer:
+    """
+    Records how long opening a urllib3 connection took, for SegmentMetrics.
+
+    Mixed into the connection classes of TimedHTTPAdapter. The host name is resolved
+    separately from the TCP handshake so the two can be told apart; the resolved
+    addresses are then tried in turn. Every new connection sets timings to the time it
+    was opened and the seconds spent on DNS, TCP and TLS.
+    """
+
+    timings = None
+
+    def _new_conn(self):
+        """
+        Resolves the host and opens a socket to the first address that accepts it.
+
+        :rtype: socket.socket
+        """
+        host = self._dns_host
+        started = time.monotonic()
+        try:
+            addresses = socket.getaddrinfo(host, self.port, allowed_gai_family(), socket.SOCK_STREAM)
+        except socket.gaierror:
+            return super()._new_conn()  # Raises urllib3's error for the failed lookup.
+        resolved = time.monotonic()
+        error = None
+        try:
+            for address in dict.fromkeys(info[4][0] for info in addresses):
+                self._dns_host = address
+                try:
+                    sock = super()._new_conn()
+                    break
+                except NewConnectionError as e:
+                    error = e
+            else:
+                raise error
+        finally:
+            self._dns_host = host
+        self.timings = (started, resolved - started, time.monotonic() - resolved, None)
+        return sock
+
+
+class TimedHTTPConnection(ConnectionTimer, HTTPConnection):
+    """An HTTP connection that records how long opening it took."""
+
+
+class TimedHTTPSConnection(ConnectionTimer, HTTPSConnection):
+    """An HTTPS connection that records how long opening it took, TLS handshake included."""
+
+    def connect(self):
+        """Opens the connection and adds the time of the TLS handshake to timings."""
+        started = time.monotonic()
+        super().connect()
+        opened, dns, connect, _ = self.timings
+        self.timings = (opened, dns, connect, max(time.monotonic() - started - dns - connect, 0.0))
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    """A requests adapter whose connections record how long opening them took."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        """Creates the pool manager and makes it use the timed connection pools."""
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': TimedHTTPConnectionPool,
+                                                   'https': TimedHTTPSConnectionPool}
+
+
+def connection_timings(response, since):
+    """
+    Returns how long opening the connection of a response took, if it was opened for it.
+
+    :param response: The streamed response, before its body has been read.
+    :type response: requests.Response
+    :param since: The time the request was started, from time.monotonic().
+    :type since: float
+    :return: The seconds spent on DNS, TCP and TLS (None for plain HTTP), or None if the
+        request went over a connection that was already open.
+    :rtype: tuple
+    """
+    timings = getattr(getattr(response.raw, 'connection', None), 'timings', None)
+    if timings is None or timings[0] < since:
+        return None
+    return timings[1:]
+
+
+class ConnectionPool:
+    """
+    A per-host pool of keep-alive sessions that download workers borrow from.
+
+    Every session keeps its connection open between requests, so a worker that borrows
+    a session to fetch its next segment, or the first range request after the HEAD
+    probe, skips the TCP and TLS handshakes.
+    """
+
+    def __init__(self, max_idle_per_host=POOL_SIZE_PER_HOST):
+        """
+        Initializes a ConnectionPool instance.
+
+        :param max_idle_per_host: The maximum number of idle sessions kept per host.
+            Sessions given back beyond that are closed. Defaults to POOL_SIZE_PER_HOST.
+        :type max_idle_per_host: int
+        """
+        self.max_idle_per_host = max_idle_per_host
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.sessions = {}
+        self.hits = {}
+        self.misses = {}
+
+    @staticmethod
+    def host_key(url):
+        """
+        Returns the key sessions for the given URL are pooled under.
+
+        :param url: The URL to be requested.
+        :type url: str
+        :return: The scheme and network location of the URL.
+        :rtype: str
+        """
+        parts = urlsplit(url)
+        return f"{parts.scheme}://{parts.netloc}"
+
+    def new_session(self):
+        """
+        Creates a session that keeps a single connection alive and records how long
+        opening it took.
+
+        :return: The new session.
+        :rtype: requests.Session
+        """
+        session = requests.Session()
+        adapter = TimedHTTPAdapter(pool_connections=1, pool_maxsize=1)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def borrow(self, url):
+        """
+        Takes an idle session for the host of the URL, or creates one if there is none.
+
+        :param url: The URL to be requested.
+        :type url: str
+        :return: A session for the calling thread to use exclusively.
+        :rtype: requests.Session
+        """
+        key = self.host_key(url)
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if idle:
+                self.hits[key] = self.hits.get(key, 0) + 1
+                return idle.pop()
+            self.misses[key] = self.misses.get(key, 0) + 1
+        session = self.new_session()
+        with self.lock:
+            self.sessions.setdefault(key, []).append(session)
+        return session
+
+    def give_back(self, url, session):
+        """
+        Returns a borrowed session to the pool.
+
+        :param url: The URL the session was borrowed for.
+        :type url: str
+        :param session: The borrowed session.
+        :type session: requests.Session
+        """
+        key = self.host_key(url)
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < self.max_idle_per_host:
+                idle.append(session)
+                return
+            self.sessions[key].remove(session)
+        session.close()
+
+    @contextmanager
+    def session(self, url):
+        """
+        Borrows a session for the duration of a with block.
+
+        :param url: The URL to be requested.
+        :type url: str
+        """
+        session = self.borrow(url)
+        try:
+            yield session
+        finally:
+            self.give_back(url, session)
+
+    def stats(self):
+        """
+        Returns the reuse statistics of the pool per host.
+
+        hits and misses count borrowed sessions that were taken from the pool or had to be
+        created. requests and connections count the HTTP requests sent and the TCP
+        connections opened for them, so requests - connections requests reused a
+        connection.
+
+        :return: A dict of host to a dict of hits, misses, requests and connections.
+        :rtype: dict
+        """
+        with self.lock:
+            sessions = {key: list(value) for key, value in self.sessions.items()}
+            stats = {key: {'hits': self.hits.get(key, 0), 'misses': self.misses.get(key, 0),
+                           'requests': 0, 'connections': 0}
+                     for key in sessions}
+        for key, host_sessions in sessions.items():
+            for session in host_sessions:
+                for adapter in set(session.adapters.values()):
+                    pools = adapter.poolmanager.pools
+                    for pool_key in pools.keys():
+                        pool = pools.get(pool_key)
+                        if pool is not None:
+                            stats[key]['requests'] += pool.num_requests
+                            stats[key]['connections'] += pool.num_connections
+        return stats
+
+    def close(self):
+        """Closes every session of the pool."""
+        with self.lock:
+            sessions = [session for value in self.sessions.values() for session in value]
+            self.idle.clear()
+            self.sessions.clear()
+        for session in sessions:
+            session.close()
+
+
+default_pool = ConnectionPool()
+
+
+class ConnectionLimiter:
+    """
+    Caps the number of requests in flight, in total and per host.
+
+    Shared by every download that should stay within the same budget. A slot is held for
+    the duration of one request, so downloads running side by side take turns on the
+    connections instead of each claiming a fixed share up front.
+    """
+
+    def __init__(self, max_connections=None, max_per_host=None):
+        """
+        Initializes a ConnectionLimiter instance.
+
+        :param max_connections: The maximum number of requests in flight overall, or None
+            for no limit.
+        :type max_connections: int
+        :param max_per_host: The maximum number of requests in flight to a single host,
+            or None for no limit.
+        :type max_per_host: int
+        """
+        self.max_connections = max_connections
+        self.max_per_host = max_per_host
+        self.condition = threading.Condition()
+        self.active = 0
+        self.active_per_host = {}
+
+    def available(self, key):
+        """
+        Checks whether a slot for the given host is free. Must be called with the
+        condition held.
+
+        :param key: The host key, as returned by ConnectionPool.host_key.
+        :type key: str
+        :rtype: bool
+        """
+        return ((self.max_connections is None or self.active < self.max_connections)
+                and (self.max_per_host is None or self.active_per_host.get(key, 0) < self.max_per_host))
+
+    def take(self, key):
+        """
+        Takes a slot for the given host. Must be called with the condition held.
+
+        :param key: The host key, as returned by ConnectionPool.host_key.
+        :type key: str
+        """
+        self.active += 1
+        self.active_per_host[key] = self.active_per_host.get(key, 0) + 1
+
+    def try_acquire(self, url):
+        """
+        Takes a slot for the host of the URL if one is free, without waiting.
+
+        :param url: The URL to be requested.
+        :type url: str
+        :return: True if a slot was taken.
+        :rtype: bool
+        """
+        key = ConnectionPool.host_key(url)
+        with self.condition:
+            if not self.available(key):
+                return False
+            self.take(key)
+            return True
+
+    def acquire(self, url, cancelled=None):
+        """
+        Waits for a slot for the host of the URL and takes it.
+
+        :param url: The URL to be requested.
+        :type url: str
+        :param cancelled: Returns True once the caller no longer wants the slot. It is
+            checked whenever a slot is released and after wake.
+        :type cancelled: callable
+        :raises: DownloadCancelled if cancelled returned True before a slot was free.
+        """
+        key = ConnectionPool.host_key(url)
+        with self.condition:
+            self.condition.wait_for(lambda: self.available(key) or cancelled is not None and cancelled())
+            if not self.available(key):
+                raise DownloadCancelled()
+            self.take(key)
+
+    def wake(self):
+        """Wakes every caller waiting for a slot, so the cancelled ones give up."""
+        with self.condition:
+            self.condition.notify_all()
+
+    def release(self, url):
+        """
+        Gives back a slot taken for the host of the URL.
+
+        :param url: The URL that was requested.
+        :type url: str
+        """
+        key = ConnectionPool.host_key(url)
+        with self.condition:
+            self.active -= 1
+            self.active_per_host[key] -= 1
+            self.condition.notify_all()
+
+    @contextmanager
+    def slot(self, url, cancelled=None):
+        """
+        Holds a slot for the host of the URL for the duration of a with block.
+
+        :param url: The URL to be requested.
+        :type url: str
+        :param cancelled: Stops waiting for the slot once it returns True, see acquire.
+        :type cancelled: callable
+        """
+        self.acquire(url, cancelled)
+        try:
+            yield
+        finally:
+            self.release(url)
+
+
+class RateLimiter:
+    """
+    Caps the bandwidth of the workers that draw from it with a token bucket.
+
+    Tokens are bytes. They accrue at rate bytes per second, up to RATE_BURST_TIME seconds'
+    worth. Workers take the tokens for a read after it has arrived, and the bucket may go
+    into debt: a worker is told how long to wait until the debt is paid off and waits
+    outside the lock. The lock is only held for a few arithmetic operations once per read,
+    and reads are tens of kilobytes or more, so it is never contended for long. Without a
+    rate the lock is not taken at all.
+    """
+
+    def __init__(self, rate=None):
+        """
+        Initializes a RateLimiter instance.
+
+        :param rate: The limit in bytes per second, or None for no limit.
+        :type rate: float
+        """
+        self.lock = threading.Lock()
+        self.rate = None
+        self.capacity = 0
+        self.tokens = 0
+        self.last_time = time.monotonic()
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        """
+        Changes the limit, also while workers are drawing from the bucket.
+
+        :param rate: The limit in bytes per second, or None or 0 for no limit.
+        :type rate: float
+        """
+        with self.lock:
+            now = time.monotonic()
+            if self.rate:
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_time) * self.rate)
+            self.last_time = now
+            if rate:
+                self.capacity = max(rate * RATE_BURST_TIME, MIN_READ_SIZE)
+                self.tokens = min(self.tokens, self.capacity) if self.rate else self.capacity
+            self.rate = rate or None
+
+    def reserve(self, amount):
+        """
+        Takes tokens for bytes that have been received.
+
+        :param amount: The number of bytes received.
+        :type amount: int
+        :return: The number of seconds to wait before receiving more, 0 if there is no need.
+        :rtype: float
+        """
+        if self.rate is None:
+            return 0.0
+        with self.lock:
+            rate = self.rate
+            if rate is None:
+                return 0.0
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last_time) * rate) - amount
+            self.last_time = now
+            return -self.tokens / rate if self.tokens < 0 else 0.0
+
+
+global_rate_limiter = RateLimiter()
+
+
+class ConnectionTuner:
+    """
+    Picks the number of connections of a download from its measured throughput.
+
+    Starts with a few connections and adds half as many again every AUTO_TUNE_INTERVAL
+    seconds for as long as the combined speed keeps improving by at least AUTO_MIN_GAIN.
+    On a plateau it goes back to the best count seen and settles there. If the server
+    answers with one of THROTTLE_STATUS_CODES, or the time to the first byte of a response
+    grows well past the lowest seen, it drops a connection and never grows past that count
+    again; if the server keeps complaining, it keeps dropping one per interval.
+
+    The workers report to note_latency and note_throttled from their own threads; the
+    DownloadManager calls update on its own schedule and applies the count it returns.
+    """
+
+    def __init__(self, start=AUTO_START_CONNECTIONS, maximum=AUTO_MAX_CONNECTIONS):
+        """
+        Initializes a ConnectionTuner instance.
+
+        :param start: The number of connections to start with. Defaults to
+            AUTO_START_CONNECTIONS.
+        :type start: int
+        :param maximum: The most connections to ever use. Defaults to AUTO_MAX_CONNECTIONS.
+        :type maximum: int
+        """
+        self.lock = threading.Lock()
+        self.count = max(1, min(start, maximum))
+        self.ceiling = maximum
+        self.best_count = self.count
+        self.best_speed = 0.0
+        self.settled = False
+        self.base_latency = None
+        self.latencies = []
+        self.throttled = False
+        self.last_time = None
+        self.last_total = 0
+
+    @property
+    def result(self):
+        """
+        The number of connections worth starting with next time: the count the tuner
+        settled on, or the best count so far if it has not settled, or None if the
+        download was too short to tell.
+        """
+        if self.settled:
+            return self.count
+        return self.best_count if self.best_speed else None
+
+    def note_latency(self, seconds):
+        """
+        Records the time a request took until its response headers arrived.
+
+        :param seconds: The time to the first byte.
+        :type seconds: float
+        """
+        with self.lock:
+            self.latencies.append(seconds)
+
+    def note_throttled(self):
+        """Records that the server asked to slow down."""
+        self.throttled = True
+
+    def skip(self):
+        """Forgets the last sample, so that an interval spent paused is not taken for a slow one."""
+        self.last_time = None
+
+    def update(self, now, total):
+        """
+        Adjusts the number of connections after another interval of the download.
+
+        :param now: The current time.
+        :type now: float
+        :param total: The number of bytes downloaded so far.
+        :type total: int
+        :return: The number of connections to use from now on.
+        :rtype: int
+        """
+        with self.lock:
+            latencies, self.latencies = self.latencies, []
+            throttled, self.throttled = self.throttled, False
+        if self.last_time is None or now <= self.last_time:
+            self.last_time, self.last_total = now, total
+            return self.count
+        speed = (total - self.last_total) / (now - self.last_time)
+        self.last_time, self.last_total = now, total
+
+        slow = False
+        if latencies:
+            latency = sorted(latencies)[len(latencies) // 2]
+            if self.base_latency is None or latency < self.base_latency:
+                self.base_latency = latency
+            slow = latency > self.base_latency * AUTO_LATENCY_FACTOR + AUTO_LATENCY_SLACK
+
+        if throttled or slow:
+            self.ceiling = self.count = max(1, self.count - 1)
+            self.best_count = min(self.best_count, self.count)
+            self.settled = True
+        elif not self.settled:
+            if speed > self.best_speed * (1 + AUTO_MIN_GAIN):
+                self.best_speed = speed
+                self.best_count = self.count
+                if self.count < self.ceiling:
+                    self.count = min(self.ceiling, self.count + max(1, self.count // 2))
+                else:
+                    self.settled = True
+            else:
+                self.count = self.best_count
+                self.settled = True
+        return self.count
+
+
+def default_cache_dir():
+    """
+    Returns the directory QuickDownloader keeps its caches in.
+
+    :return: LOCALAPPDATA on Windows, otherwise XDG_CACHE_HOME or ~/.cache, with a
+        quickdownloader directory inside.
+    :rtype: str
+    """
+    base = os.environ.get('LOCALAPPDATA') or os.environ.get('XDG_CACHE_HOME') \
+        or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'quickdownloader')
+
+
+class JsonCache:
+    """
+    A dict kept in a JSON file in default_cache_dir(), shared by the downloads of a
+    process.
+
+    The file is read the first time the dict is needed and replaced atomically on every
+    change. The cache is only a hint: if the file cannot be read or written, it is
+    ignored. Subclasses set file_name and turn the loaded JSON into their entries in parse.
+    """
+
+    file_name = None
+
+    def __init__(self, path=None):
+        """
+        Initializes a JsonCache instance.
+
+        :param path: The path of the JSON file. Defaults to file_name in
+            default_cache_dir().
+        :type path: str
+        """
+        self.path = path or os.path.join(default_cache_dir(), self.file_name)
+        self.lock = threading.Lock()
+        self.entries = None
+
+    def parse(self, data):
+        """
+        Turns the JSON read from the file into the entries of the cache.
+
+        :param data: The decoded JSON.
+        :return: The entries.
+        :rtype: dict
+        :raises: ValueError, AttributeError or TypeError if the data is not valid.
         """
-        Initializes a PartDownloadThread instance.
+        return dict(data)
 
-        :param url: The URL of the file to download.
+    def load(self):
+        """
+        Reads the file the first time it is needed. Must be called with the lock held.
+
+        :return: The entries.
+        :rtype: dict
+        """
+        if self.entries is None:
+            try:
+                with open(self.path, 'r') as f:
+                    self.entries = self.parse(json.load(f))
+            except (OSError, ValueError, AttributeError, TypeError):
+                self.entries = {}
+        return self.entries
+
+    def save(self):
+        """Writes the entries to a file next to the cache and moves it into place. Must be called with the lock held."""
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            temp_path = f"{self.path}.tmp"
+            with open(temp_path, 'w') as f:
+                json.dump(self.entries, f)
+            os.replace(temp_path, self.path)
+        except OSError:
+            pass
+
+
+class ConnectionCountCache(JsonCache):
+    """
+    Remembers the best number of connections found for each host in a JSON file, so
+    the next automatically tuned download from the same host starts there.
+    """
+
+    file_name = 'connections.json'
+
+    def parse(self, data):
+        """
+        Reads the counts by host key.
+
+        :rtype: dict
+        """
+        return {key: int(count) for key, count in data.items()}
+
+    def get(self, url):
+        """
+        Returns the remembered number of connections for the host of a URL.
+
+        :param url: The URL to be downloaded.
         :type url: str
-        :param start: The start byte of the part to download.
-        :type start: int
-        :param end: The end byte of the part to download.
-        :type end: int
-        :param part_num: The number of the part to download.
-        :type part_num: int
-        :param save_path: The path to save the downloaded part to.
+        :return: The number of connections, or None if the host is not in the cache.
+        :rtype: int
+        """
+        with self.lock:
+            return self.load().get(ConnectionPool.host_key(url))
+
+    def set(self, url, count):
+        """
+        Remembers the number of connections for the host of a URL.
+
+        :param url: The URL that was downloaded.
+        :type url: str
+        :param count: The best number of connections found.
+        :type count: int
+        """
+        with self.lock:
+            self.load()[ConnectionPool.host_key(url)] = count
+            self.save()
+
+
+connection_count_cache = ConnectionCountCache()
+
+
+class MetadataCache(JsonCache):
+    """
+    Remembers the ETag and Last-Modified date of every finished download in a JSON file,
+    with the size and modification time the saved file had, so downloading the same URL
+    to the same path again can be a conditional request that skips the transfer if the
+    file has not changed on either side.
+    """
+
+    file_name = 'metadata.json'
+
+    def parse(self, data):
+        """
+        Reads the entries by URL.
+
+        :rtype: dict
+        """
+        return {url: dict(entry) for url, entry in data.items()}
+
+    def get(self, url, save_path):
+        """
+        Returns the validators of a URL if the file it was saved to is still as it was.
+
+        :param url: The URL to be downloaded.
+        :type url: str
+        :param save_path: The path it is to be saved to.
         :type save_path: str
+        :return: The ETag and Last-Modified date, either of which may be None, or None if
+            the URL was not saved to this path or the file has changed since.
+        :rtype: tuple
         """
-        super().__init__()
-        self.url = url
+        with self.lock:
+            entry = self.load().get(url)
+        if entry is None or entry.get('path') != os.path.abspath(save_path):
+            return None
+        try:
+            stat = os.stat(save_path)
+        except OSError:
+            return None
+        if stat.st_size != entry.get('size') or stat.st_mtime_ns != entry.get('mtime'):
+            return None
+        return entry.get('etag'), entry.get('last_modified')
+
+    def set(self, url, save_path, etag, last_modified):
+        """
+        Remembers the validators of a URL and the file it was saved to.
+
+        Nothing is remembered if the server sent neither an ETag nor a Last-Modified date.
+
+        :param url: The URL that was downloaded.
+        :type url: str
+        :param save_path: The path it was saved to.
+        :type save_path: str
+        :param etag: The ETag the server sent, if any.
+        :type etag: str
+        :param last_modified: The Last-Modified date the server sent, if any.
+        :type last_modified: str
+        """
+        if not etag and not last_modified:
+            return
+        try:
+            stat = os.stat(save_path)
+        except OSError:
+            return
+        with self.lock:
+            self.load()[url] = {'path': os.path.abspath(save_path), 'size': stat.st_size,
+                                'mtime': stat.st_mtime_ns, 'etag': etag, 'last_modified': last_modified}
+            self.save()
+
+
+file_metadata_cache = MetadataCache()
+
+
+def default_save_path(url, directory=''):
+    """
+    Picks a file name from the last part of the URL's path.
+
+    :param url: The URL being downloaded.
+    :type url: str
+    :param directory: The directory to put the file in. Defaults to the current directory.
+    :type directory: str
+    :return: The path to save the file to.
+    :rtype: str
+    """
+    name = os.path.basename(unquote(urlsplit(url).path)) or 'download'
+    return os.path.join(directory, name)
+
+
+class SegmentWriter:
+    """
+    Writes the bytes received for segments into the output file.
+
+    Shared by every worker of a download, whichever engine drives them, so claiming,
+    writing, journaling and throttling a chunk works the same way everywhere.
+    """
+
+    def __init__(self, scheduler, output, journal, rate_limiters=(), verifier=None):
+        """
+        Initializes a SegmentWriter instance.
+
+        :param scheduler: The scheduler the segments were taken from.
+        :type scheduler: SegmentScheduler
+        :param output: The preallocated file to write the segments into.
+        :type output: OutputFile
+        :param journal: The journal to record the written ranges in.
+        :type journal: ResumeJournal
+        :param rate_limiters: The rate limiters every received byte is drawn from.
+        :type rate_limiters: tuple
+        :param verifier: The verifier to hand the written bytes to, which records them in
+            the journal once their chunk is verified. Without one they are recorded at once.
+        :type verifier: ChunkVerifier
+        """
+        self.scheduler = scheduler
+        self.output = output
+        self.journal = journal
+        self.rate_limiters = rate_limiters
+        self.verifier = verifier
+
+    def write(self, segment, data):
+        """
+        Writes the next bytes received for a segment at their offset of the output file.
+
+        :param segment: The segment the bytes belong to.
+        :type segment: Segment
+        :param data: The bytes received.
+        :type data: bytes
+        :return: The number of bytes written. This is less than len(data) once the end of
+            the segment has been reached, after which the worker should stop reading.
+        :rtype: int
+        """
+        offset = segment.position
+        length = self.scheduler.claim(segment, len(data))
+        if length:
+            self.output.write_at(data[:length] if length < len(data) else data, offset)
+            if self.verifier is not None:
+                self.verifier.written(offset, length)
+            else:
+                self.journal.record(offset, offset + length - 1)
+        return length
+
+    def drain(self):
+        """
+        Waits until every written chunk has been verified, if there is a verifier. Chunks
+        that failed are back in the scheduler afterwards.
+        """
+        if self.verifier is not None:
+            self.verifier.drain()
+
+    def flush(self):
+        """
+        Writes the journal out now, waiting for a flush already in progress, so every range
+        written so far survives the process being killed while the download is paused.
+        """
+        with self.journal.flush_lock:
+            self.journal.flush()
+
+    def throttle(self, length):
+        """
+        Draws received bytes from every rate limiter.
+
+        The worker does the waiting itself, since a thread sleeps and a coroutine awaits.
+
+        :param length: The number of bytes received.
+        :type length: int
+        :return: The number of seconds the worker should wait before reading on, 0 if none.
+        :rtype: float
+        """
+        delay = 0.0
+        for rate_limiter in self.rate_limiters:
+            delay = max(delay, rate_limiter.reserve(length))
+        return delay
+
+
+class SpeedMeter:
+    """
+    Estimates the download speed over a sliding window of recent progress samples.
+
+    Unlike the average since the start, the estimate follows changes in bandwidth within
+    a few seconds and is not dragged down by a slow start or a pause.
+    """
+
+    def __init__(self, window=SPEED_WINDOW):
+        """
+        Initializes a SpeedMeter instance.
+
+        :param window: The number of seconds of samples to average over. Defaults to
+            SPEED_WINDOW.
+        :type window: float
+        """
+        self.window = window
+        self.samples = deque()
+
+    def update(self, now, total):
+        """
+        Adds a sample and returns the speed over the window.
+
+        :param now: The time of the sample, from time.monotonic().
+        :type now: float
+        :param total: The number of bytes downloaded so far.
+        :type total: int
+        :return: The speed in bytes per second.
+        :rtype: float
+        """
+        samples = self.samples
+        samples.append((now, total))
+        while len(samples) > 2 and now - samples[1][0] >= self.window:
+            samples.popleft()
+        first_time, first_total = samples[0]
+        if now <= first_time:
+            return 0.0
+        return (total - first_total) / (now - first_time)
+
+    def reset(self):
+        """Forgets the samples so far, e.g. after a pause."""
+        self.samples.clear()
+
+
+class ReadSizer:
+    """
+    Picks the size of the next read from a connection based on its observed throughput.
+
+    Reads are sized to take about READ_TARGET_TIME seconds, rounded to a power of two
+    between MIN_READ_SIZE and MAX_READ_SIZE: large enough that a fast link needs few
+    Python-level calls per megabyte, small enough that a slow one still reports progress
+    and notices a cancel promptly.
+    """
+
+    def __init__(self):
+        """Initializes a ReadSizer instance."""
+        self.size = MIN_READ_SIZE
+        self.last_time = None
+
+    def update(self, length):
+        """
+        Adjusts the read size after a read has finished.
+
+        :param length: The number of bytes the read returned.
+        :type length: int
+        :return: The size of the next read.
+        :rtype: int
+        """
+        now = time.monotonic()
+        if self.last_time is not None and now > self.last_time:
+            wanted = length / (now - self.last_time) * READ_TARGET_TIME
+            size = MIN_READ_SIZE
+            while size < wanted and size < MAX_READ_SIZE:
+                size *= 2
+            self.size = size
+        self.last_time = now
+        return self.size
+
+
+def read_into(response, buffer):
+    """
+    Reads the next bytes of a streamed response body into a buffer.
+
+    Unencoded bodies are read by the http.client response under urllib3, which receives
+    straight into the buffer with no intermediate bytes objects. Encoded bodies fall back
+    to urllib3's decoding read and a copy.
+
+    :param response: The streamed response.
+    :type response: requests.Response
+    :param buffer: The buffer to read into.
+    :type buffer: memoryview
+    :return: The number of bytes read, 0 at the end of the body.
+    :rtype: int
+    """
+    raw = response.raw
+    fp = getattr(raw, '_fp', None)
+    if fp is not None and hasattr(fp, 'readinto') and not response.headers.get('content-encoding'):
+        return fp.readinto(buffer)
+    data = raw.read(len(buffer))
+    buffer[:len(data)] = data
+    return len(data)
+
+
+def release_if_read(response):
+    """
+    Hands the connection of a response read with read_into back to the pool once its
+    whole body has been read, so closing the response does not close the connection.
+
+    :param response: The streamed response.
+    :type response: requests.Response
+    """
+    fp = getattr(response.raw, '_fp', None)
+    if fp is not None and hasattr(fp, 'isclosed') and fp.isclosed():
+        response.raw.release_conn()
+
+
+def content_range(response):
+    """
+    Tells which part of the file a response to a range request carries, see
+    parse_content_range.
+
+    :param response: The response.
+    :type response: requests.Response
+    :return: The first byte of the body and the size of the whole file, which is None if
+        the server did not tell.
+    :rtype: tuple
+    """
+    return parse_content_range(response.status_code, response.headers)
+
+
+def abort_response(response):
+    """
+    Cuts off the connection of a streamed response from another thread, which makes the
+    read waiting on it fail.
+
+    :param response: The streamed response.
+    :type response: requests.Response
+    """
+    sock = getattr(getattr(response.raw, 'connection', None), 'sock', None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class OpenedResponse:
+    """
+    The response to the first request of a download, which also told its size.
+
+    The DownloadManager hands it to the worker that downloads the first segment, which
+    reads on from it instead of requesting the segment again, so the download starts
+    streaming with the first round trip.
+    """
+
+    def __init__(self, response, stack, record, start):
+        """
+        Initializes an OpenedResponse instance.
+
+        :param response: The streamed response.
+        :type response: requests.Response
+        :param stack: Holds the session and limiter slot the response was requested with,
+            and closes them with the response.
+        :type stack: contextlib.ExitStack
+        :param record: The metrics of the request.
+        :type record: SegmentMetrics
+        :param start: The first byte of the body.
+        :type start: int
+        """
+        self.response = response
+        self.stack = stack
+        self.record = record
         self.start = start
-        self.end = end
+        self.url = response.url
+        self.segment = None
+
+    def read(self, size):
+        """
+        Reads the next bytes of the body.
+
+        :param size: The most bytes to read.
+        :type size: int
+        :return: The bytes, empty at the end of the body.
+        :rtype: bytes
+        """
+        return self.response.raw.read(size)
+
+    def abort(self):
+        """Cuts off the connection from another thread, see abort_response."""
+        abort_response(self.response)
+
+    def close(self):
+        """Closes the response and gives back the session and limiter slot."""
+        self.stack.close()
+
+
+class PartDownloadThread(threading.Thread):
+    def __init__(self, mirrors, scheduler, writer, part_num, pool, limiter=None, on_finished=None, on_error=None,
+                 tuner=None, metrics=None, error_budget=None, stall_timeout=STALL_TIMEOUT, resumed=None,
+                 opened=None):
+        """
+        Initializes a PartDownloadThread instance.
+
+        :param mirrors: The mirrors to download the file from.
+        :type mirrors: MirrorSet
+        :param scheduler: The scheduler to take segments to download from.
+        :type scheduler: SegmentScheduler
+        :param writer: The writer to hand the received bytes to.
+        :type writer: SegmentWriter
+        :param part_num: The number of the worker.
+        :type part_num: int
+        :param pool: The pool to borrow a session from for each segment.
+        :type pool: ConnectionPool
+        :param limiter: The limiter to hold a slot of while requesting a segment, if any.
+        :type limiter: ConnectionLimiter
+        :param on_finished: Called with the part number once the scheduler runs out of work.
+        :type on_finished: callable
+        :param on_error: Called with the error message if the download fails.
+        :type on_error: callable
+        :param tuner: The tuner to report response times and throttling to when the number
+            of connections is tuned automatically. A throttled request then backs off and
+            is retried instead of failing the download.
+        :type tuner: ConnectionTuner
+        :param metrics: Where the metrics of every request are recorded. Defaults to a
+            DownloadMetrics of the thread's own.
+        :type metrics: DownloadMetrics
+        :param error_budget: Decides whether to retry failed requests, shared by all
+            workers of the download. Defaults to an ErrorBudget of the thread's own.
+        :type error_budget: ErrorBudget
+        :param stall_timeout: The seconds without data after which the stall watchdog
+            aborts a request, for the error messages. Defaults to STALL_TIMEOUT.
+        :type stall_timeout: float
+        :param resumed: Set while the download runs, cleared while it is paused. Defaults
+            to an event of the thread's own that is never cleared.
+        :type resumed: threading.Event
+        :param opened: The response to the first request of the download, to read its
+            segment from before taking any other. Defaults to none.
+        :type opened: OpenedResponse
+        """
+        super().__init__(daemon=True)
+        self.mirrors = mirrors
+        self.scheduler = scheduler
+        self.writer = writer
         self.part_num = part_num
-        self.save_path = save_path
+        self.pool = pool
+        self.limiter = limiter
+        self.on_finished = on_finished
+        self.on_error = on_error
+        self.tuner = tuner
+        self.metrics = metrics if metrics is not None else DownloadMetrics()
+        self.error_budget = error_budget if error_budget is not None else ErrorBudget()
+        self.stall_timeout = stall_timeout
+        self.resumed = resumed
+        if resumed is None:
+            self.resumed = threading.Event()
+            self.resumed.set()
+        self.opened = opened
+        self.buffer = memoryview(bytearray(MAX_READ_SIZE))
+        self.downloaded = 0
         self.cancelled = False
+        self.retiring = False
 
     def run(self):
         """
-        Downloads a part of a file from the given URL and saves it to the given save path.
+        Downloads segments of a file from its mirrors until the scheduler runs out of work.
+
+        Each segment is downloaded from the mirror picked by the MirrorSet. If a request
+        fails, the rest of the segment, from the last byte written, goes back to the
+        scheduler and the ErrorBudget decides what happens next: usually the thread waits
+        a backoff that grows with every failure in a row and requests the rest again.
+        Mirrors that keep failing are dropped; the download only fails once the budget is
+        used up or the last mirror fails in a way retrying cannot fix.
 
-        The part to download is specified by the start and end byte offsets, and the number
-        of the part is specified by the part_num parameter.
+        Every chunk is written at its own offset of the output file, so the segments never
+        need to be copied anywhere afterwards. The bytes written are only added to the
+        downloaded counter of the thread, which the DownloadManager reads on its own schedule.
 
-        If the download is cancelled, the file is deleted and the function exits immediately.
+        Every request is recorded in the metrics with how it ended.
 
-        If any error occurs, the error message is emitted as a signal.
+        If the download is cancelled, the function exits immediately. If the thread is
+        retired, it exits after the current read and the rest of its segment is left to
+        the other threads. If the download is paused, the thread stops after the current
+        read as well, hands the rest of its segment back to the scheduler and gives its
+        session back to the pool, then parks until the download is resumed and requests
+        the rest from the first byte it has not written.
+
+        If any error occurs, the error message is passed to on_error.
 
         :return: None
         """
+        failures = 0
         try:
-            headers = {'Range': f'bytes={self.start}-{self.end}'}
-            with requests.get(self.url, headers=headers, stream=True, timeout=120) as response:
-                response.raise_for_status()
-                with open(f"{self.save_path}.part{self.part_num}", 'wb') as f:
-                    for chunk in response.iter_content(chunk_size=1024):
+            while not self.cancelled and not self.retiring:
+                if self.opened is None and not self.resumed.is_set():
+                    self.park()
+                    continue
+                opened, self.opened = self.opened, None
+                mirror = self.mirrors.pick(opened.url if opened is not None else None)
+                downloaded = self.downloaded
+                started = time.monotonic()
+                delay = 0.0
+                try:
+                    if opened is not None:
+                        segment, record = opened.segment, opened.record
+                    else:
+                        segment = self.scheduler.acquire(mirror.speed)
+                        if segment is None:
+                            break
+                        record = self.metrics.segment(self.part_num, mirror.url, segment.position, segment.end)
+                    segment.mirror = mirror
+                    try:
+                        self.download_segment(segment, mirror.url, record, opened)
+                    except Exception as e:
                         if self.cancelled:
-                            f.close()
-                            remove(f"{self.save_path}.part{self.part_num}")
-                            return
-                        if chunk:
-                            f.write(chunk)
-                            self.progress.emit(len(chunk))
-            self.finished_part.emit(self.part_num)
+                            self.metrics.finish(record, 'cancelled', position=segment.position)
+                            break
+                        if not self.resumed.is_set():
+                            self.metrics.finish(record, 'paused', position=segment.position)
+                        else:
+                            message = error_message(e, record.stalled, self.stall_timeout)
+                            self.metrics.finish(record, 'stalled' if record.stalled else 'failed', message,
+                                                segment.position)
+                            if self.error_budget.failed(self.mirrors, mirror, e, message):
+                                failures += 1
+                                delay = backoff(failures)
+                    else:
+                        outcome = self.outcome(segment, record)
+                        if outcome == 'done':
+                            failures = 0
+                            self.error_budget.succeeded()
+                        self.metrics.finish(record, outcome, position=segment.position)
+                    finally:
+                        self.scheduler.release(segment)
+                finally:
+                    self.mirrors.put_back(mirror, self.downloaded - downloaded, time.monotonic() - started)
+                self.wait(delay)
+            if not self.cancelled and not self.retiring and self.on_finished is not None:
+                self.on_finished(self.part_num)
         except Exception as e:
-            self.error.emit(str(e))
+            if self.on_error is not None:
+                self.on_error(str(e))
+        finally:
+            if self.opened is not None:
+                self.opened.close()
+
+    def download_segment(self, segment, url, record, opened=None):
+        """
+        Downloads a single segment from a mirror into the output file.
+
+        The body is read into the preallocated buffer of the thread, in reads sized by a
+        ReadSizer, and written to the output file from there. For the first segment of
+        the download, it is read from the response the DownloadManager has already opened.
+
+        When the number of connections is tuned, a response with one of the
+        THROTTLE_STATUS_CODES is reported to the tuner and the thread waits THROTTLE_BACKOFF
+        seconds, leaving the segment to be taken again.
+
+        Stops as soon as the end of the segment is reached, which may be earlier than
+        requested if another worker has stolen part of it in the meantime.
+
+        :param segment: The segment to download.
+        :type segment: Segment
+        :param url: The URL of the mirror to download it from.
+        :type url: str
+        :param record: The metrics of the request.
+        :type record: SegmentMetrics
+        :param opened: The response to read the segment from instead of requesting it.
+        :type opened: OpenedResponse
+        """
+        headers = {'Range': f'bytes={segment.position}-{segment.end}', 'Accept-Encoding': 'identity'}
+        throttled = False
+        with ExitStack() as stack:
+            if opened is not None:
+                stack.push(opened.stack)
+                response = opened.response
+            else:
+                if self.limiter:
+                    stack.enter_context(self.limiter.slot(url, lambda: self.cancelled))
+                session = stack.enter_context(self.pool.session(url))
+                started = time.monotonic()
+                response = stack.enter_context(session.get(url, headers=headers, stream=True,
+                                                           timeout=self.mirrors.timeout))
+                elapsed = time.monotonic() - started
+                timings = connection_timings(response, started)
+                if timings is not None:
+                    record.connected(*timings)
+                    elapsed -= sum(timing for timing in timings if timing is not None)
+                record.responded(response.status_code, max(elapsed, 0.0))
+            record.watch(lambda: abort_response(response))
+            if self.tuner is not None and response.status_code in THROTTLE_STATUS_CODES:
+                throttled = True
+            else:
+                if self.tuner is not None and opened is None:
+                    self.tuner.note_latency(time.monotonic() - started)
+                response.raise_for_status()
+                check_range(response.status_code, response.headers, segment, self.writer.output.size)
+                self.read_body(segment, response, record)
+        if throttled:
+            self.tuner.note_throttled()
+            record.waited(THROTTLE_BACKOFF)
+            self.wait(THROTTLE_BACKOFF)
+
+    def read_body(self, segment, response, record):
+        """
+        Reads the body of a segment's response into the output file.
+
+        No read goes past the end of the segment, so the open-ended response to the first
+        request is not read further than the first segment, and a response that has been
+        read to its end can go back to the pool.
+
+        :param segment: The segment being downloaded.
+        :type segment: Segment
+        :param response: The streamed response for the segment.
+        :type response: requests.Response
+        :param record: The metrics of the request, which get the time spent reading,
+            writing and waiting for the rate limiters.
+        :type record: SegmentMetrics
+        """
+        sizer = ReadSizer()
+        size = sizer.size
+        try:
+            while not self.cancelled and not self.retiring and self.resumed.is_set():
+                wanted = min(size, segment.remaining)
+                if wanted <= 0:
+                    return
+                started = time.monotonic()
+                received = read_into(response, self.buffer[:wanted])
+                read = time.monotonic()
+                record.read(received, read - started)
+                if not received:
+                    if segment.remaining > 0:
+                        raise ConnectionError("The server closed the connection mid-response.")
+                    return
+                length = self.writer.write(segment, self.buffer[:received])
+                record.wrote(time.monotonic() - read)
+                self.downloaded += length
+                delay = self.writer.throttle(received)
+                if delay:
+                    record.waited(delay)
+                    self.wait(delay)
+                if length < received or segment.remaining <= 0:
+                    return
+                size = sizer.update(received)
+        finally:
+            release_if_read(response)
+
+    def outcome(self, segment, record):
+        """
+        Tells how a request that raised no error ended, for the metrics.
+
+        :param segment: The segment that was requested.
+        :type segment: Segment
+        :param record: The metrics of the request.
+        :type record: SegmentMetrics
+        :return: 'cancelled', 'throttled', 'retired', 'paused' or 'done'.
+        :rtype: str
+        """
+        if self.cancelled:
+            return 'cancelled'
+        if self.tuner is not None and record.status in THROTTLE_STATUS_CODES:
+            return 'throttled'
+        if self.retiring and segment.remaining > 0:
+            return 'retired'
+        if not self.resumed.is_set() and segment.remaining > 0:
+            return 'paused'
+        return 'done'
+
+    def park(self):
+        """
+        Waits while the download is paused, after writing the journal out. Returns early
+        if the download is cancelled or the thread retired in the meantime.
+        """
+        self.writer.flush()
+        while not self.cancelled and not self.retiring and not self.resumed.wait(THROTTLE_POLL_INTERVAL):
+            pass
+
+    def wait(self, delay):
+        """
+        Sleeps for the given number of seconds, waking up early if the download is cancelled.
+
+        :param delay: The number of seconds to sleep.
+        :type delay: float
+        """
+        deadline = time.monotonic() + delay
+        while delay > 0 and not self.cancelled:
+            time.sleep(min(delay, THROTTLE_POLL_INTERVAL))
+            delay = deadline - time.monotonic()
+
+    def retire(self):
+        """Stops the thread after its current read, without cancelling the download."""
+        self.retiring = True
 
     def cancel(self):
         """Cancel the download."""
         self.cancelled = True
 
 
-class DownloadManager(QThread):
-    progress = pyqtSignal(int)
-    progress_percent = pyqtSignal(float)
-    speed = pyqtSignal(float)
-    max_speed = pyqtSignal(float)
-    time_remaining = pyqtSignal(float)
-    finished_download = pyqtSignal()
-    error_occurred = pyqtSignal(str)
+class DownloadManager:
+    """
+    Downloads a file over several connections and reports on it through events.
+
+    Listeners added with add_listener are called as listener(event, *args) from the
+    download's threads, with one of the EVENTS below. The manager has no dependency on
+    Qt; run() blocks until the download is over, so callers run it on a thread of their
+    choosing.
+    """
 
-    def __init__(self, url, save_path, num_threads=4):
+    EVENTS = (
+        'progress',  # bytes downloaded so far (int)
+        'progress_percent',  # percentage downloaded (float)
+        'speed',  # current speed in bytes per second (float)
+        'max_speed',  # highest speed so far in bytes per second (float)
+        'time_remaining',  # estimated seconds left (float)
+        'part_done',  # number of a worker that ran out of work (int)
+        'mirror_dropped',  # URL of a mirror that is no longer used (str) and why (str)
+        'finished_download',  # the download is over, whether it succeeded or not
+        'error_occurred',  # error message (str)
+    )
+
+    def __init__(self, url, save_path, num_threads=4, piece_size=None, allocate=False, pool=None,
+                 engine='threads', update_interval=UPDATE_INTERVAL, limiter=None,
+                 small_file_size=SMALL_FILE_SIZE, rate_limit=None, connection_cache=None, digest=None,
+                 chunk_hashes=None, mirrors=(), trace=None, max_errors=ERROR_BUDGET, stall_timeout=STALL_TIMEOUT,
+                 metadata_cache=None, delta=None, basis=None, extract_to=None, keep_archive=True):
         """
         Initializes a DownloadManager instance.
 
@@ -84,173 +1878,784 @@ class DownloadManager(QThread):
         :type url: str
         :param save_path: The path to save the downloaded file to.
         :type save_path: str
-        :param num_threads: The number of threads to use for downloading. Defaults to 4.
-        :type num_threads: int
+        :param num_threads: The number of threads to use for downloading, or with the
+            asyncio engine the number of connections. AUTO tunes the number while
+            downloading with a ConnectionTuner. Defaults to 4.
+        :type num_threads: int or str
+        :param piece_size: The size of the pieces handed out to the threads. Defaults to
+            a size based on the file size and the number of threads.
+        :type piece_size: int
+        :param allocate: Whether to reserve the disk space of the whole file before
+            downloading instead of using a sparse file. Defaults to False.
+        :type allocate: bool
+        :param pool: The connection pool to borrow sessions from. Defaults to the pool
+            shared by all downloads.
+        :type pool: ConnectionPool
+        :param engine: The engine to download with, one of ENGINES: 'threads' runs a
+            PartDownloadThread per connection, 'asyncio' runs every connection in a single
+            AsyncRangeEngine loop, and 'http2' runs the connections as streams over a few
+            HTTP/2 connections in an Http2RangeEngine, which needs the h2 package.
+            Defaults to 'threads'.
+        :type engine: str
+        :param update_interval: The number of seconds between progress updates, or None to
+            emit no progress events at all. Defaults to UPDATE_INTERVAL.
+        :type update_interval: float
+        :param limiter: The limiter that caps the requests in flight, shared with other
+            downloads. Defaults to no limit.
+        :type limiter: ConnectionLimiter
+        :param small_file_size: Files up to this size are downloaded over a single
+            connection in one piece. Defaults to SMALL_FILE_SIZE.
+        :type small_file_size: int
+        :param rate_limit: The bandwidth limit of this download in bytes per second, on top
+            of the global_rate_limiter shared by all downloads. Defaults to no limit.
+        :type rate_limit: float
+        :param connection_cache: Where the best number of connections per host is
+            remembered with AUTO. Defaults to the cache shared by all downloads.
+        :type connection_cache: ConnectionCountCache
+        :param digest: The expected digest of the whole file, as accepted by parse_digest,
+            e.g. "sha256:9f86d0...". It is computed by a PrefixHasher while downloading.
+            Defaults to no check.
+        :type digest: str
+        :param chunk_hashes: The expected digests of the chunks of the file. Every chunk is
+            checked by a ChunkVerifier as soon as it is complete and downloaded again if it
+            does not match. Defaults to no check.
+        :type chunk_hashes: ChunkHashList
+        :param mirrors: Other URLs of the same file to download from alongside url. Each
+            segment goes to the mirror expected to be fastest for it, and mirrors that
+            fail are dropped. Defaults to none.
+        :type mirrors: list
+        :param trace: The trace to write the metrics of every request to as JSON lines.
+            Defaults to none; the metrics are available from stats either way.
+        :type trace: TraceWriter
+        :param max_errors: The number of failed requests in a row the download survives
+            by retrying them, or None for no limit. Defaults to ERROR_BUDGET.
+        :type max_errors: int
+        :param stall_timeout: The number of seconds a request may receive no data before
+            it is aborted and retried. Defaults to STALL_TIMEOUT.
+        :type stall_timeout: float
+        :param metadata_cache: Where the ETag and Last-Modified date of finished downloads
+            are remembered, to skip downloading them again while they are unchanged.
+            Defaults to the cache shared by all downloads.
+        :type metadata_cache: MetadataCache
+        :param delta: The manifest of the file, to update a local copy by downloading only
+            the blocks that changed. Its digests also verify the downloaded blocks unless
+            chunk_hashes are given. Defaults to downloading the whole file.
+        :type delta: DeltaManifest
+        :param basis: The local copy to take the unchanged blocks from with delta.
+            Defaults to the file at the save path.
+        :type basis: str
+        :param extract_to: Where to decompress or unpack the file while it downloads, see
+            PrefixExtractor: the directory for a tar archive, possibly compressed, or the
+            file for anything else that is compressed. Defaults to no extraction.
+        :type extract_to: str
+        :param keep_archive: Whether to keep the downloaded file once it has been extracted.
+            Defaults to True.
+        :type keep_archive: bool
 
-        This method sets up the necessary variables and starts the download process by calling the run method in a separate thread.
+        This method sets up the necessary variables; the download starts when run is called.
         """
-        super().__init__()
+        self.listeners = []
         self.url = url
         self.save_path = save_path
         self.num_threads = num_threads
+        self.piece_size = piece_size
+        self.allocate = allocate
+        self.pool = pool or default_pool
+        self.limiter = limiter
+        self.small_file_size = small_file_size
+        self.rate_limiter = RateLimiter(rate_limit)
+        self.connection_cache = connection_cache or connection_count_cache
+        self.metadata_cache = metadata_cache or file_metadata_cache
+        self.digest = parse_digest(digest) if digest else None
+        self.chunk_hashes = chunk_hashes
+        self.verifier = None
+        self.delta = delta
+        self.basis_path = basis or save_path
+        self.delta_plan = None
+        self.extract_to = extract_to
+        self.keep_archive = keep_archive
+        self.mirror_urls = list(mirrors)
+        self.mirrors = None
+        self.tuner = None
+        self.workers_lock = threading.Lock()
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown engine {engine!r}, expected one of {ENGINES}.")
+        if engine == 'http2' and not HTTP2_SUPPORTED:
+            raise ValueError("The http2 engine needs the h2 package.")
+        self.engine = engine
+        self.async_engine = None
+        self.output = None
+        self.journal = None
         self.threads = []
         self.total_size = 0
+        self.download_url = url
+        self.etag = None
+        self.last_modified = None
+        self.accepts_ranges = True
+        self.not_modified = False
+        self.opened = None
+        self.update_interval = update_interval
+        self.resumed_bytes = 0
         self.downloaded = 0
         self.max_speed_value = 0
+        self.speed_meter = SpeedMeter()
+        self.metrics = DownloadMetrics(url, save_path, trace)
+        self.error_budget = ErrorBudget(max_errors)
+        self.stall_timeout = stall_timeout
+        self.done = threading.Event()
+        self.resumed = threading.Event()
+        self.resumed.set()
         self.cancelled = False
         self.paused = False
-        self.start_time = time.time()
+
+    def add_listener(self, listener):
+        """
+        Registers a callable to be told about the events of the download.
+
+        :param listener: Called as listener(event, *args) for every event in EVENTS.
+        :type listener: callable
+        """
+        self.listeners.append(listener)
+
+    def emit(self, event, *args):
+        """
+        Calls every listener with an event.
+
+        :param event: The name of the event, one of EVENTS.
+        :type event: str
+        """
+        for listener in self.listeners:
+            listener(event, *args)
 
     def run(self):
         """
-        Starts the download process.
+        Runs the download process and returns when it is over.
 
-        This method gets the total size of the file, creates and starts the required number of threads to download the file in parts, and waits for all the threads to finish.
+        This method gets the total size of the file from the response to the first request, preallocates the output file, and downloads the pieces handed out by a SegmentScheduler with the selected engine: either by starting the required number of threads and waiting for all of them to finish, or by running an AsyncRangeEngine, or the Http2RangeEngine built on it, until it is done. The first segment is read from the response to the first request, see open_first_request.
 
-        If the download is not cancelled, it merges the downloaded parts into a single file and emits the finished_download signal.
+        Files no larger than small_file_size, and files from servers that do not support ranges, skip the splitting and are downloaded in one piece over a single connection.
 
-        If any error occurs, it emits the error_occurred signal with the error message and then emits the finished_download signal.
+        If the file was downloaded to the save path before and the server answers that it has not changed since, nothing is downloaded and the finished_download event is emitted right away.
+
+        Meanwhile a reporter thread publishes the progress events every update_interval seconds, unless update_interval is None.
+
+        If a ResumeJournal from an earlier attempt matches the file on the server, only the ranges it does not cover are downloaded. If the server's validators have changed, the journal is thrown away and the download starts from scratch.
+
+        If a delta manifest was given, the blocks of the new file that the local copy at the basis path already contains are copied from it and recorded in the journal before the download starts, so that only the ranges between them are downloaded, see DeltaPlan.
+
+        If mirrors were given, the ones that report a different size, ETag or Last-Modified than url are dropped before the download starts.
+
+        If a digest or chunk hashes were given, the file is verified while it is downloaded. Chunks that fail are downloaded again; if the digest of the whole file does not match, the output file and journal are deleted and an error is reported.
+
+        If the download is not cancelled, it renames the output file to the save path, deletes the journal and emits the finished_download event. Otherwise the partial output file and journal are kept so the download can be resumed later.
+
+        A request that fails is retried from the last byte written, after a backoff, until the ErrorBudget is used up; a watchdog aborts and retries requests that receive no data for stall_timeout seconds.
+
+        If extract_to was given, a PrefixExtractor decompresses or unpacks the file while it downloads; the downloaded file is deleted afterwards unless keep_archive is set. If the extraction fails, the downloaded file is kept and an error is reported.
+
+        If any error occurs, it emits the error_occurred event with the error message and then emits the finished_download event.
+
+        Every request is recorded in the DownloadMetrics of the manager, see stats.
         """
+        hasher = None
+        extractor = None
         try:
-            self.total_size = self.get_file_size()
-            part_size = math.ceil(self.total_size / self.num_threads)
-            self.progress.emit(0)
-            self.progress_percent.emit(0.0)
-            self.downloaded = 0
+            self.total_size = self.open_first_request()
+            if self.not_modified:
+                self.metrics.start(self.total_size, self.engine, self.num_threads)
+                self.resumed_bytes = self.downloaded = self.total_size
+                self.done.set()
+                if self.update_interval:
+                    self.update_progress()
+                self.metrics.done()
+                self.emit('finished_download')
+                return
+            urls = self.check_mirrors() if self.accepts_ranges else [self.download_url]
+            self.mirrors = MirrorSet(urls, self.mirror_dropped)
+            if self.delta is not None and self.accepts_ranges:
+                self.delta.check_size(self.total_size)
+                if self.chunk_hashes is None:
+                    self.chunk_hashes = self.delta.chunk_hashes()
+            if self.chunk_hashes is not None:
+                self.chunk_hashes.check_size(self.total_size)
+            self.journal = self.open_journal()
+            self.output = OutputFile(self.save_path, self.total_size, self.allocate,
+                                     resume=self.journal.done.size > 0)
+            self.journal.output = self.output
+            if self.delta is not None and self.accepts_ranges and self.journal.done.size == 0:
+                plan = self.delta_plan or self.delta.match(self.basis_path)
+                plan.seed(self.output, self.journal)
+            num_threads = self.num_threads
+            if self.total_size <= self.small_file_size or not self.accepts_ranges:
+                num_threads = 1
+                piece_size = max(self.total_size, 1)
+            elif num_threads == AUTO:
+                self.tuner = ConnectionTuner(self.connection_cache.get(self.download_url)
+                                             or AUTO_START_CONNECTIONS)
+                num_threads = self.tuner.count
+                piece_size = self.piece_size or self.default_piece_size(AUTO_MAX_CONNECTIONS)
+            else:
+                piece_size = self.piece_size or self.default_piece_size(num_threads)
+            align = 1
+            if self.chunk_hashes is not None:
+                align = self.chunk_hashes.chunk_size
+                piece_size = math.ceil(piece_size / align) * align
+            self.metrics.start(self.total_size, self.engine, self.num_threads)
+            missing = self.journal.done.missing(self.total_size)
+            scheduler = SegmentScheduler(missing, piece_size, align=align,
+                                         speed_of=self.mirrors.segment_speed)
+            self.hand_over_opened(scheduler)
+            self.resumed_bytes = self.downloaded = self.journal.done.size
             self.max_speed_value = 0
+            reporter = None
+            if self.update_interval:
+                self.update_progress()
+                reporter = threading.Thread(target=self.report_progress, daemon=True)
+                reporter.start()
 
-            for i in range(self.num_threads):
-                start = part_size * i
-                end = start + part_size - 1 if i < self.num_threads - 1 else self.total_size
-                thread = PartDownloadThread(self.url, start, end, i, self.save_path)
-                thread.progress.connect(self.update_progress)
-                thread.finished_part.connect(self.part_finished)
-                thread.error.connect(self.thread_error)
-                self.threads.append(thread)
-                thread.start()
+            if self.chunk_hashes is not None:
+                self.verifier = ChunkVerifier(self.chunk_hashes, scheduler, self.output, self.journal,
+                                              missing, self.thread_error)
+            if self.digest is not None:
+                hasher = PrefixHasher(self.digest[0], self.output, self.journal)
+                hasher.start()
+            if self.extract_to is not None:
+                extractor = PrefixExtractor(self.output, self.journal, self.extract_to)
+                extractor.start()
+            writer = SegmentWriter(scheduler, self.output, self.journal,
+                                   (self.rate_limiter, global_rate_limiter), self.verifier)
+            if self.tuner is not None:
+                threading.Thread(target=self.tune_connections, daemon=True).start()
+            threading.Thread(target=self.watch_stalls, daemon=True).start()
+            if self.engine in ('asyncio', 'http2'):
+                engine_class = Http2RangeEngine if self.engine == 'http2' else AsyncRangeEngine
+                with self.workers_lock:
+                    if not self.cancelled:
+                        self.async_engine = engine_class(self.mirrors, scheduler, writer, num_threads,
+                                                         self.limiter, self.thread_error, self.tuner,
+                                                         self.metrics, self.error_budget, self.stall_timeout,
+                                                         self.resumed, self.opened)
+                        self.opened = None
+                if self.async_engine is not None:
+                    self.async_engine.run()
+            else:
+                self.scheduler = scheduler
+                self.writer = writer
+                self.set_connections(num_threads)
+                self.join_threads()
 
-            for thread in self.threads:
-                thread.wait()
+            self.done.set()
+            if reporter is not None:
+                reporter.join()
+                self.update_progress()
 
+            if self.verifier is not None:
+                self.verifier.close()
+            self.journal.wait()
             if not self.cancelled:
-                self.merge_files()
-                self.finished_download.emit()
+                if hasher is not None:
+                    actual = hasher.finish()
+                    if actual != self.digest[1]:
+                        self.output.discard()
+                        self.journal.remove()
+                        self.journal = None
+                        raise Exception(f"The downloaded file does not match the expected {self.digest[0]} "
+                                        f"digest {self.digest[1]}, got {actual}.")
+                extract_error = None
+                if extractor is not None:
+                    try:
+                        extractor.finish()
+                    except Exception as e:
+                        extract_error = e
+                    extractor = None
+                self.output.finalize()
+                self.journal.remove()
+                self.journal = None
+                if self.extract_to is not None and not self.keep_archive and extract_error is None:
+                    os.remove(self.save_path)
+                else:
+                    self.metadata_cache.set(self.url, self.save_path, self.etag, self.last_modified)
+                if extract_error is not None:
+                    raise Exception(f"The file was downloaded but could not be extracted: {extract_error}")
+                if self.tuner is not None and self.tuner.result is not None:
+                    self.connection_cache.set(self.download_url, self.tuner.result)
+                self.metrics.done()
+                self.emit('finished_download')
+            else:
+                self.close_opened()
+                if hasher is not None:
+                    hasher.stop()
+                if extractor is not None:
+                    extractor.stop()
+                self.save_journal()
+                self.metrics.done()
         except Exception as e:
-            self.error_occurred.emit(str(e))
-            self.finished_download.emit()
+            self.done.set()
+            self.close_opened()
+            if hasher is not None:
+                hasher.stop()
+            if extractor is not None:
+                extractor.stop()
+            if self.verifier is not None:
+                self.verifier.close()
+            self.save_journal()
+            self.metrics.done(str(e))
+            self.emit('error_occurred', str(e))
+            self.emit('finished_download')
+
+    def close_opened(self):
+        """Closes the response to the first request if no worker has taken it over."""
+        if self.opened is not None:
+            self.opened.close()
+            self.metrics.finish(self.opened.record, 'cancelled', position=self.opened.start)
+            self.opened = None
+
+    def open_journal(self):
+        """
+        Returns the journal to record the download in.
+
+        Reuses the journal of an earlier attempt if it was written for the same size, ETag
+        and Last-Modified, its output file is still there and the server supports ranges.
+        Otherwise any old journal is deleted and a fresh one is started.
+
+        :return: The journal for this download.
+        :rtype: ResumeJournal
+        """
+        journal = ResumeJournal.load(self.save_path)
+        if journal is not None:
+            if (self.accepts_ranges and journal.matches(self.total_size, self.etag, self.last_modified)
+                    and os.path.exists(f"{self.save_path}.part")):
+                return journal
+            journal.remove()
+        return ResumeJournal(self.save_path, self.total_size, self.etag, self.last_modified)
+
+    def save_journal(self):
+        """Writes the journal out and closes the output file so the download can be resumed."""
+        if self.journal is not None and self.output is not None:
+            with self.journal.flush_lock:
+                self.journal.flush()
+            self.output.close()
+
+    def default_piece_size(self, num_threads):
+        """
+        Picks a piece size that gives every thread a few pieces to work through.
 
-    def get_file_size(self):
+        :param num_threads: The number of threads, or the most threads there may be.
+        :type num_threads: int
+        :return: The piece size in bytes, between MIN_PIECE_SIZE and MAX_PIECE_SIZE.
+        :rtype: int
         """
-        Retrieves the size of the file at the given URL.
+        piece_size = math.ceil(self.total_size / (num_threads * 4))
+        return min(max(piece_size, MIN_PIECE_SIZE), MAX_PIECE_SIZE)
 
-        :return: The size of the file in bytes, or 0 if the size could not be retrieved.
-        :type: int
-        :raises: Exception if the request fails.
+    def open_first_request(self):
         """
+        Requests the file from the first byte still missing and learns its size from the
+        response.
+
+        There is no separate HEAD request: the first request asks for the rest of the file
+        with an open-ended Range header, the size comes from its Content-Range, and its body
+        is kept open in opened for the worker that downloads the first segment. The download
+        therefore starts streaming after a single round trip, and servers that reject HEAD
+        work as well.
+
+        If an earlier attempt left a journal, the request starts at the first byte the
+        journal does not cover, with its ETag or Last-Modified date in If-Range, so a file
+        that has changed since comes back whole instead. Otherwise, if the file was saved to
+        the save path before and is unchanged on disk, the request carries the validators
+        remembered in the MetadataCache in If-None-Match and If-Modified-Since, and a 304
+        response sets not_modified. Files to be verified against a digest or chunk hashes
+        are always downloaded. For a delta update the local copy is scanned first, see
+        DeltaManifest.match, and the request starts at the first block it lacks.
+
+        A 200 response without Accept-Ranges: bytes means the server does not support
+        ranges, which clears accepts_ranges; the file is then downloaded in a single stream
+        from that response. An empty file has no byte to start at, so servers answer 416
+        with a Content-Range of */0, which is taken as a file of size 0.
 
-        response = requests.head(self.url)
-        if response.status_code == 200:
-            return int(response.headers.get('content-length', 0))
+        Also stores the ETag and Last-Modified headers of the response, which are used to
+        tell whether a partial download can be resumed, and the URL redirects led to, which
+        the segments are downloaded from.
+
+        :return: The size of the file in bytes.
+        :rtype: int
+        :raises: Exception if the request fails or the server does not tell the size.
+        """
+        headers = {'Accept-Encoding': 'identity'}
+        start = 0
+        cached = None
+        journal = ResumeJournal.load(self.save_path)
+        if journal is not None and os.path.exists(f"{self.save_path}.part"):
+            missing = journal.done.missing(journal.total_size)
+            start = missing[0][0] if missing else 0
+            strong_etag = journal.etag if journal.etag and not journal.etag.startswith('W/') else None
+            if strong_etag or journal.last_modified:
+                headers['If-Range'] = strong_etag or journal.last_modified
         else:
-            raise Exception("Failed to retrieve file size.")
+            if self.delta is not None:
+                self.delta_plan = self.delta.match(self.basis_path)
+                start = min(self.delta_plan.first_missing(), max(self.delta.size - 1, 0))
+            if self.digest is None and self.chunk_hashes is None:
+                cached = self.metadata_cache.get(self.url, self.save_path)
+            if cached is not None:
+                if cached[0]:
+                    headers['If-None-Match'] = cached[0]
+                if cached[1]:
+                    headers['If-Modified-Since'] = cached[1]
+        headers['Range'] = f'bytes={start}-'
+
+        record = self.metrics.segment(0, self.url, start, None)
+        stack = ExitStack()
+        try:
+            if self.limiter:
+                stack.enter_context(self.limiter.slot(self.url, lambda: self.cancelled))
+            session = stack.enter_context(self.pool.session(self.url))
+            started = time.monotonic()
+            response = stack.enter_context(session.get(self.url, headers=headers, stream=True, timeout=TIMEOUT))
+            elapsed = time.monotonic() - started
+            timings = connection_timings(response, started)
+            if timings is not None:
+                record.connected(*timings)
+                elapsed -= sum(timing for timing in timings if timing is not None)
+            record.responded(response.status_code, max(elapsed, 0.0))
+            self.download_url = response.url
+            if response.status_code == 304 and cached is not None:
+                self.not_modified = True
+                self.etag = response.headers.get('etag') or cached[0]
+                self.last_modified = response.headers.get('last-modified') or cached[1]
+                stack.close()
+                self.metrics.finish(record, 'done')
+                return os.path.getsize(self.save_path)
+            if response.status_code == 416 and content_range(response)[1] == 0:
+                self.etag = response.headers.get('etag')
+                self.last_modified = response.headers.get('last-modified')
+                stack.close()
+                self.metrics.finish(record, 'done')
+                return 0
+            response.raise_for_status()
+            if response.status_code not in (200, 206):
+                raise Exception(f"Failed to retrieve file size: the server answered {response.status_code}.")
+            first, size = content_range(response)
+            if size is None:
+                raise Exception("Failed to retrieve file size: the server sent neither Content-Range nor "
+                                "Content-Length.")
+            self.etag = response.headers.get('etag')
+            self.last_modified = response.headers.get('last-modified')
+            self.accepts_ranges = (response.status_code == 206
+                                   or response.headers.get('accept-ranges', '').lower() == 'bytes')
+        except Exception as e:
+            stack.close()
+            self.metrics.finish(record, 'failed', error_message(e), start)
+            raise
+        record.end = size - 1
+        self.opened = OpenedResponse(response, stack, record, first)
+        return size
+
+    def hand_over_opened(self, scheduler):
+        """
+        Takes the first segment from the scheduler for the worker that reads it from the
+        response to the first request.
+
+        If the response does not start where the segment does, for instance because the
+        journal was thrown away after all, the response is closed and the segment is
+        requested like any other.
+
+        :param scheduler: The scheduler of the download.
+        :type scheduler: SegmentScheduler
+        """
+        opened = self.opened
+        if opened is None:
+            return
+        segment = scheduler.acquire()
+        if segment is not None and segment.position == opened.start:
+            opened.segment = segment
+            return
+        if segment is not None:
+            scheduler.release(segment)
+        self.opened = None
+        opened.close()
+        self.metrics.finish(opened.record, 'retired', position=opened.start)
+
+    def probe_mirror(self, url):
+        """
+        Asks a mirror for the size and validators of its copy of the file, with a request
+        for its first byte. A mirror that does not support ranges cannot be used.
+
+        :param url: The URL of the file on the mirror.
+        :type url: str
+        :return: The URL redirects led to, the size, the ETag and the Last-Modified date,
+            or the exception if the request failed.
+        :rtype: tuple or Exception
+        """
+        try:
+            headers = {'Range': 'bytes=0-0', 'Accept-Encoding': 'identity'}
+            with self.limiter.slot(url, lambda: self.cancelled) if self.limiter else nullcontext(), \
+                    self.pool.session(url) as session, \
+                    session.get(url, headers=headers, stream=True, timeout=MIRROR_TIMEOUT) as response:
+                response.raise_for_status()
+                if response.status_code != 206:
+                    raise Exception("The mirror does not support ranges.")
+                response.content
+            return (response.url, content_range(response)[1],
+                    response.headers.get('etag'), response.headers.get('last-modified'))
+        except Exception as e:
+            return e
+
+    def check_mirrors(self):
+        """
+        Checks that the mirrors serve the same file as the download URL.
+
+        All mirrors are asked at once. A mirror is dropped if it fails to answer, reports
+        a different size, or sends an ETag or Last-Modified date that differs from the
+        download URL's. Validators a mirror or the download URL does not send cannot be
+        compared, so such a mirror is only checked by its size.
+
+        :return: The URLs to download from, the download URL first.
+        :rtype: list
+        """
+        urls = [self.download_url]
+        if not self.mirror_urls:
+            return urls
+        with ThreadPoolExecutor(len(self.mirror_urls)) as executor:
+            results = list(executor.map(self.probe_mirror, self.mirror_urls))
+        for url, result in zip(self.mirror_urls, results):
+            if isinstance(result, Exception):
+                reason = str(result) or type(result).__name__
+            else:
+                final_url, size, etag, last_modified = result
+                if size != self.total_size:
+                    reason = f"The size {size} differs from {self.total_size}."
+                elif etag and self.etag and etag != self.etag:
+                    reason = f"The ETag {etag} differs from {self.etag}."
+                elif last_modified and self.last_modified and last_modified != self.last_modified:
+                    reason = f"Last-Modified {last_modified} differs from {self.last_modified}."
+                else:
+                    urls.append(final_url)
+                    continue
+            self.emit('mirror_dropped', url, reason)
+        return urls
+
+    def mirror_dropped(self, url, reason):
+        """
+        Called when a mirror fails during the download.
+
+        Emits the mirror_dropped event with the URL and the reason.
+
+        :param url: The URL of the mirror.
+        :type url: str
+        :param reason: The error message.
+        :type reason: str
+        """
+        self.emit('mirror_dropped', url, reason)
+
+    def bytes_downloaded(self):
+        """
+        Adds up the bytes written by all workers, plus those resumed from the journal.
+
+        :return: The number of bytes of the file that have been downloaded.
+        :rtype: int
+        """
+        downloaded = self.resumed_bytes + sum(thread.downloaded for thread in self.threads)
+        if self.async_engine is not None:
+            downloaded += self.async_engine.downloaded
+        if self.verifier is not None:
+            downloaded -= self.verifier.discarded
+        return downloaded
+
+    def stats(self):
+        """
+        Returns the metrics of the download so far.
+
+        :return: The stats of the DownloadMetrics of the download, with the number of
+            bytes downloaded added as downloaded: per-request latencies (DNS, connect,
+            TLS, first byte), bytes, throughput samples, retries, stalls and the time
+            spent reading, writing and waiting, added up and for the active and recent
+            requests.
+        :rtype: dict
+        """
+        stats = self.metrics.stats()
+        stats['downloaded'] = self.bytes_downloaded()
+        return stats
+
+    def set_connections(self, count):
+        """
+        Starts or retires PartDownloadThreads until count of them are working.
+
+        Retired threads stop after their current read and leave the rest of their segment
+        to the others. Does nothing once the download is done or cancelled.
 
-    def update_progress(self, chunk_size):
+        :param count: The number of threads to keep working.
+        :type count: int
         """
-        Called when a part of the download has finished.
+        with self.workers_lock:
+            if self.done.is_set() or self.cancelled:
+                return
+            working = [thread for thread in self.threads if thread.is_alive() and not thread.retiring]
+            for thread in working[count:]:
+                thread.retire()
+            for i in range(len(working), count):
+                self.start_thread()
 
-        Updates the progress signals and displays the current speed, max speed, and time remaining.
+    def start_thread(self):
+        """Starts another PartDownloadThread. Must be called with workers_lock held."""
+        opened, self.opened = self.opened, None
+        thread = PartDownloadThread(self.mirrors, self.scheduler, self.writer, len(self.threads),
+                                    self.pool, self.limiter, self.part_finished, self.thread_error,
+                                    self.tuner, self.metrics, self.error_budget, self.stall_timeout,
+                                    self.resumed, opened)
+        self.threads.append(thread)
+        thread.start()
 
-        :param chunk_size: The size of the chunk of data that has been downloaded
-        :type chunk_size: int
+    def join_threads(self):
+        """
+        Waits for all PartDownloadThreads, including those started while waiting, and
+        marks the download as done once none is left so no more are started.
+
+        If the last threads were retired with segments handed back to the scheduler, or
+        chunks failed verification, a new thread is started to download them.
+        """
+        while True:
+            for thread in list(self.threads):
+                thread.join()
+            self.writer.drain()
+            with self.workers_lock:
+                if not any(thread.is_alive() for thread in self.threads):
+                    if self.cancelled or not self.scheduler.pending:
+                        self.done.set()
+                        return
+                    self.start_thread()
+
+    def tune_connections(self):
+        """
+        Updates the tuner every AUTO_TUNE_INTERVAL seconds until the download is done and
+        applies the number of connections it picks.
+        """
+        while not self.done.wait(AUTO_TUNE_INTERVAL):
+            if self.paused:
+                self.tuner.skip()
+                continue
+            count = self.tuner.update(time.monotonic(), self.bytes_downloaded())
+            if self.async_engine is not None:
+                self.async_engine.set_concurrency(count)
+            else:
+                self.set_connections(count)
+
+    def watch_stalls(self):
+        """
+        Aborts the requests that have received no data for stall_timeout seconds, checking
+        every STALL_CHECK_INTERVAL seconds until the download is done. Their workers then
+        retry the rest of their segments.
+        """
+        while not self.done.wait(STALL_CHECK_INTERVAL):
+            for record in self.metrics.stalled(self.stall_timeout):
+                record.abort_stalled()
+
+    def report_progress(self):
+        """Calls update_progress every update_interval seconds until the download is done."""
+        while not self.done.wait(self.update_interval):
+            self.update_progress()
+
+    def update_progress(self):
+        """
+        Publishes the current progress.
+
+        Reads the byte counters of the workers and emits the progress events with the
+        current speed, max speed, and time remaining. The speed is measured over the last
+        SPEED_WINDOW seconds by a SpeedMeter.
         """
         if not self.paused:
-            self.downloaded += chunk_size
-            self.progress.emit(self.downloaded)
-            percent = (self.downloaded / self.total_size) * 100
-            self.progress_percent.emit(percent)
+            self.downloaded = self.bytes_downloaded()
+            self.emit('progress', self.downloaded)
+            percent = (self.downloaded / self.total_size) * 100 if self.total_size else 100.0
+            self.emit('progress_percent', percent)
 
-            elapsed_time = time.time() - self.start_time
-            current_speed = self.downloaded / (elapsed_time + 1e-9)  # bytes per second
-            self.speed.emit(current_speed)
+            current_speed = self.speed_meter.update(time.monotonic(), self.downloaded)  # bytes per second
+            self.emit('speed', current_speed)
 
             if current_speed > self.max_speed_value:
                 self.max_speed_value = current_speed
-                self.max_speed.emit(self.max_speed_value)
+                self.emit('max_speed', self.max_speed_value)
 
             remaining_bytes = self.total_size - self.downloaded
             remaining_time = remaining_bytes / (current_speed + 1e-9)
-            self.time_remaining.emit(remaining_time)
+            self.emit('time_remaining', remaining_time)
 
     def part_finished(self, part_num):
         """
         Called when a part of the download is finished.
 
-        Emits the part_finished signal with the given part number.
+        Emits the part_done event with the given part number.
 
         :param part_num: The part number that has finished downloading
         :type part_num: int
         """
 
-        self.part_finished.emit(part_num)
+        self.emit('part_done', part_num)
 
     def thread_error(self, error_msg):
         """
-        Called when an error occurs in a PartDownloadThread.
+        Called when a PartDownloadThread gives up on the download, or a chunk keeps failing
+        verification.
 
-        Emits the error_occurred signal with the given error message and
+        Emits the error_occurred event with the given error message and
         cancels the download.
 
         :param error_msg: The error message from the PartDownloadThread
         :type error_msg: str
         """
-        self.error_occurred.emit(error_msg)
+        self.metrics.fail(error_msg)
+        self.emit('error_occurred', error_msg)
         self.cancel()
 
-    def merge_files(self):
+    def set_rate_limit(self, rate):
         """
-        Merges the part files into a single file after all parts have been downloaded.
-        
-        Opens the save path as a binary file in write mode and writes the contents of each
-        part file to it. The part files are then deleted.
+        Changes the bandwidth limit of this download, also while it is running.
+
+        :param rate: The limit in bytes per second, or None for no limit.
+        :type rate: float
         """
-        with open(self.save_path, 'wb') as outfile:
-            for i in range(self.num_threads):
-                part_path = f"{self.save_path}.part{i}"
-                with open(part_path, 'rb') as infile:
-                    outfile.write(infile.read())
-                remove(part_path)
+        self.rate_limiter.set_rate(rate)
 
     def pause(self):
         """
         Pauses the download process if it is running.
 
-        Sets the paused flag to True, which will prevent the DownloadManager from
-        updating the progress bar and the UI. The pause method of each PartDownloadThread
-        is called to pause the individual threads, but currently, it does nothing.
+        Sets the paused flag to True, which stops the progress updates, and stops the
+        workers of either engine after their current read. Each one hands the rest of its
+        segment back to the scheduler, closes or gives back its connection, writes the
+        journal out and parks, so a paused download uses neither the network nor the disk.
         """
-        
         self.paused = True
-        for thread in self.threads:
-            thread.pause()  # Note: PartDownloadThread has no pause method
+        self.resumed.clear()
 
     def resume(self):
         """
         Resumes the download process if it was paused.
 
-        Sets the paused flag to False, allowing the download process to continue.
+        Sets the paused flag to False and wakes the workers, which request the rest of the
+        file from exactly the bytes they stopped at, so nothing is downloaded twice. The
+        speed is measured afresh from then on.
         """
-        
+        self.speed_meter.reset()
         self.paused = False
+        self.resumed.set()
 
     def cancel(self):
         """
         Cancels the download process and stops all threads.
 
         Sets the cancelled flag to True and calls the cancel method of each
-        PartDownloadThread in the list of threads.
+        PartDownloadThread in the list of threads. Under workers_lock, so a download
+        cancelled before its workers started, for instance during the first request, never
+        starts them.
 
         :return: None
         """
-        self.cancelled = True
-        for thread in self.threads:
-            thread.cancel()
+        with self.workers_lock:
+            self.cancelled = True
+            if self.async_engine is not None:
+                self.async_engine.cancel()
+            for thread in self.threads:
+                thread.cancel()
+        if self.limiter is not None:
+            self.limiter.wake()
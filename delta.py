@@ -0,0 +1,384 @@
+"""
+Block-level delta updates of a file that is already on disk, in the spirit of zsync.
+
+The publisher of a file makes a manifest of it with this module: the size of the file,
+a block size, and for every block an Adler-32 checksum and a strong digest. A client
+that has an older copy scans it for blocks that still appear in the new file, at any
+offset, copies those into the download and only requests the byte ranges that are left.
+
+Usage: python delta.py FILE [--block-size BYTES] [--algorithm NAME] [-o MANIFEST]
+"""
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import zlib
+from core import default_pool
+from integrity import ChunkHashList
+from mirrors import TIMEOUT
+
+DELTA_BLOCK_SIZE = 64 * 1024
+DELTA_ALGORITHM = 'sha256'
+ROLL_LIMIT = 8
+ADLER_MODULUS = 65521
+
+
+class DeltaManifest:
+    """
+    The block checksums of a published file.
+
+    The file is cut into blocks of block_size bytes, the last of which may be shorter.
+    Every block has a weak checksum, the Adler-32 of its bytes, which can be rolled one
+    byte at a time to look for the block at every offset of a local file cheaply, and a
+    strong digest that confirms a match. The strong digests double as a ChunkHashList
+    to verify the blocks that are downloaded.
+    """
+
+    def __init__(self, size, block_size, algorithm, weak, strong):
+        """
+        Initializes a DeltaManifest instance.
+
+        :param size: The size of the file in bytes.
+        :type size: int
+        :param block_size: The size of every block but the last, in bytes.
+        :type block_size: int
+        :param algorithm: The name of the hashlib algorithm of the strong digests.
+        :type algorithm: str
+        :param weak: The Adler-32 checksum of every block, in order.
+        :type weak: list
+        :param strong: The hex digest of every block, in order.
+        :type strong: list
+        :raises: ValueError if the lists do not cover a file of the given size.
+        """
+        hashlib.new(algorithm)  # Raises ValueError for an unknown algorithm.
+        if block_size < 1:
+            raise ValueError("The block size must be at least 1 byte.")
+        blocks = -(-size // block_size)
+        if len(weak) != blocks or len(strong) != blocks:
+            raise ValueError(f"A file of {size} bytes has {blocks} blocks, but the manifest has "
+                             f"{len(weak)} checksums and {len(strong)} digests.")
+        self.size = size
+        self.block_size = block_size
+        self.algorithm = algorithm
+        self.weak = [int(checksum) for checksum in weak]
+        self.strong = [digest.lower() for digest in strong]
+
+    @classmethod
+    def make(cls, path, block_size=DELTA_BLOCK_SIZE, algorithm=DELTA_ALGORITHM):
+        """
+        Computes the manifest of a file.
+
+        :param path: The path of the file.
+        :type path: str
+        :param block_size: The block size in bytes. Smaller blocks find smaller changes
+            but make a larger manifest. Defaults to DELTA_BLOCK_SIZE.
+        :type block_size: int
+        :param algorithm: The hashlib algorithm of the strong digests. Defaults to
+            DELTA_ALGORITHM.
+        :type algorithm: str
+        :rtype: DeltaManifest
+        """
+        weak = []
+        strong = []
+        with open(path, 'rb') as f:
+            while True:
+                block = f.read(block_size)
+                if not block:
+                    break
+                weak.append(zlib.adler32(block))
+                strong.append(hashlib.new(algorithm, block).hexdigest())
+        return cls(os.path.getsize(path), block_size, algorithm, weak, strong)
+
+    @classmethod
+    def load(cls, source, pool=None):
+        """
+        Reads a manifest from a JSON file of the form {"size": 10485760, "block_size":
+        65536, "algorithm": "sha256", "weak": [...], "strong": ["...", ...]}.
+
+        :param source: The path of the file, or an http or https URL to download it from.
+        :type source: str
+        :param pool: The pool to borrow a session from for a URL. Defaults to the pool
+            the downloads share.
+        :type pool: ConnectionPool
+        :rtype: DeltaManifest
+        :raises: ValueError if the file is not a valid manifest or the server answers
+            with an error status, OSError if it cannot be read.
+        """
+        if source.startswith(('http://', 'https://')):
+            with (pool or default_pool).session(source) as session:
+                response = session.get(source, timeout=TIMEOUT)
+            if not response.ok:
+                raise ValueError(f"Cannot download the delta manifest {source!r}: "
+                                 f"{response.status_code} {response.reason}")
+            data = response.json()
+        else:
+            with open(source, 'r') as f:
+                data = json.load(f)
+        try:
+            return cls(int(data['size']), int(data['block_size']), data['algorithm'], data['weak'], data['strong'])
+        except (KeyError, TypeError) as e:
+            raise ValueError(f"Invalid delta manifest {source!r}: {e}")
+
+    def save(self, path):
+        """
+        Writes the manifest to a JSON file, see load.
+
+        :param path: The path of the file.
+        :type path: str
+        """
+        data = {
+            'size': self.size,
+            'block_size': self.block_size,
+            'algorithm': self.algorithm,
+            'weak': self.weak,
+            'strong': self.strong,
+        }
+        with open(path, 'w') as f:
+            json.dump(data, f)
+
+    def block_range(self, index):
+        """
+        Returns the byte range of a block.
+
+        :param index: The number of the block.
+        :type index: int
+        :return: The first and last byte of the block.
+        :rtype: tuple
+        """
+        start = index * self.block_size
+        return start, min(start + self.block_size, self.size) - 1
+
+    def check_size(self, total_size):
+        """
+        Checks that the manifest was made for a file of the given size.
+
+        :param total_size: The size of the file on the server in bytes.
+        :type total_size: int
+        :raises: ValueError if the sizes differ, which means the manifest is out of date.
+        """
+        if total_size != self.size:
+            raise ValueError(f"The delta manifest is for a file of {self.size} bytes, "
+                             f"but the file on the server has {total_size} bytes.")
+
+    def chunk_hashes(self):
+        """
+        Returns the strong digests as a ChunkHashList, to verify downloaded blocks.
+
+        :rtype: ChunkHashList
+        """
+        return ChunkHashList(self.algorithm, self.block_size, self.strong)
+
+    def match(self, basis_path):
+        """
+        Finds the blocks of the file that a local file already contains.
+
+        The local file is walked block by block. Where a block of it is not in the
+        manifest, the weak checksum is rolled forward a byte at a time to find blocks that
+        moved because bytes were inserted or removed before them; after a match the walk
+        goes on right behind it. After ROLL_LIMIT blocks without a match the rolling is
+        given up until the next match, and only blocks at the current offset are compared,
+        so that a file that has nothing in common takes little more than a read.
+
+        :param basis_path: The path of the local file, usually the older version of the
+            file at the save path.
+        :type basis_path: str
+        :return: The plan of what to copy and what to download.
+        :rtype: DeltaPlan
+        """
+        found = {}
+        if not os.path.isfile(basis_path) or os.path.getsize(basis_path) == 0 or self.size == 0:
+            return DeltaPlan(self, basis_path, found)
+        block_size = self.block_size
+        full_blocks = self.size // block_size
+        candidates = {}
+        for index in range(full_blocks):
+            candidates.setdefault(self.weak[index], []).append(index)
+        with open(basis_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            size = len(data)
+            position = 0
+            rolled = 0
+            while position + block_size <= size and len(found) < full_blocks:
+                block = data[position:position + block_size]
+                checksum = zlib.adler32(block)
+                if self.take(block, checksum, position, candidates, found):
+                    position += block_size
+                    rolled = 0
+                    continue
+                start = None
+                if rolled < ROLL_LIMIT * block_size:
+                    start = self.roll(data, position, checksum, candidates, found)
+                if start is None:
+                    position += block_size
+                    rolled += block_size
+                else:
+                    position = start + block_size
+                    rolled = 0
+            if full_blocks < len(self.strong):
+                # The last block is shorter, so it can only be looked for where it would
+                # fit the same way: at the same offset or at the end of the local file.
+                last = full_blocks
+                length = self.size - last * block_size
+                for offset in {last * block_size, size - length}:
+                    if 0 <= offset <= size - length and last not in found:
+                        block = data[offset:offset + length]
+                        if hashlib.new(self.algorithm, block).hexdigest() == self.strong[last]:
+                            found[last] = offset
+        return DeltaPlan(self, basis_path, found)
+
+    def take(self, block, checksum, offset, candidates, found):
+        """
+        Records every block of the manifest that a block of the local file matches.
+
+        :param block: The bytes of the local block.
+        :type block: bytes
+        :param checksum: The Adler-32 checksum of the block.
+        :type checksum: int
+        :param offset: The offset of the block in the local file.
+        :type offset: int
+        :param candidates: The block numbers of the manifest by weak checksum.
+        :type candidates: dict
+        :param found: The offsets in the local file of the blocks found so far, by
+            block number, updated in place.
+        :type found: dict
+        :return: True if the block is in the manifest, whether it was found before or not.
+        :rtype: bool
+        """
+        indexes = candidates.get(checksum)
+        if not indexes:
+            return False
+        digest = hashlib.new(self.algorithm, block).hexdigest()
+        matched = False
+        for index in indexes:
+            if self.strong[index] == digest:
+                matched = True
+                found.setdefault(index, offset)
+        return matched
+
+    def roll(self, data, position, checksum, candidates, found):
+        """
+        Looks for a block of the manifest at the offsets after position, up to the next
+        block boundary, by rolling the Adler-32 checksum of the block at position.
+
+        :param data: The contents of the local file.
+        :type data: mmap.mmap
+        :param position: The offset of the block that did not match.
+        :type position: int
+        :param checksum: The Adler-32 checksum of that block.
+        :type checksum: int
+        :param candidates: The block numbers of the manifest by weak checksum.
+        :type candidates: dict
+        :param found: The blocks found so far, see take.
+        :type found: dict
+        :return: The offset of the first block that matched, or None.
+        :rtype: int or None
+        """
+        block_size = self.block_size
+        a = checksum & 0xffff
+        b = checksum >> 16
+        end = min(position + block_size, len(data) - block_size + 1)
+        for start in range(position + 1, end):
+            removed = data[start - 1]
+            a = (a - removed + data[start + block_size - 1]) % ADLER_MODULUS
+            b = (b - block_size * removed + a - 1) % ADLER_MODULUS
+            checksum = b << 16 | a
+            if checksum in candidates and self.take(data[start:start + block_size], checksum, start,
+                                                    candidates, found):
+                return start
+        return None
+
+
+class DeltaPlan:
+    """
+    Which blocks of a new file can be copied from a local file, and from where.
+    """
+
+    def __init__(self, manifest, basis_path, found):
+        """
+        Initializes a DeltaPlan instance.
+
+        :param manifest: The manifest of the new file.
+        :type manifest: DeltaManifest
+        :param basis_path: The path of the local file.
+        :type basis_path: str
+        :param found: The offset in the local file of every block that can be copied, by
+            block number.
+        :type found: dict
+        """
+        self.manifest = manifest
+        self.basis_path = basis_path
+        self.found = found
+
+    @property
+    def reused(self):
+        """The number of bytes of the new file that can be copied from the local file."""
+        return sum(end - start + 1 for start, end in map(self.manifest.block_range, self.found))
+
+    def first_missing(self):
+        """
+        Returns where the first block that has to be downloaded starts.
+
+        :return: The offset, or the size of the file if every block can be copied.
+        :rtype: int
+        """
+        index = 0
+        while index in self.found:
+            index += 1
+        return min(index * self.manifest.block_size, self.manifest.size)
+
+    def seed(self, output, journal):
+        """
+        Copies the blocks found in the local file into the output file of the download
+        and records them in its journal, so that only the rest is downloaded. Adjacent
+        blocks left over form a single missing range, which the scheduler hands out as
+        one request unless it is large enough to be split between connections.
+
+        Every block is checked against its digest again as it is copied, in case the
+        local file changed since it was scanned.
+
+        :param output: The output file of the download.
+        :type output: OutputFile
+        :param journal: The journal of the download.
+        :type journal: ResumeJournal
+        :return: The number of bytes copied.
+        :rtype: int
+        """
+        copied = 0
+        if not self.found:
+            return copied
+        with open(self.basis_path, 'rb') as f:
+            for index in sorted(self.found):
+                start, end = self.manifest.block_range(index)
+                f.seek(self.found[index])
+                block = f.read(end - start + 1)
+                if hashlib.new(self.manifest.algorithm, block).hexdigest() != self.manifest.strong[index]:
+                    continue
+                output.write_at(block, start)
+                journal.record(start, end)
+                copied += len(block)
+        with journal.flush_lock:
+            journal.flush()
+        return copied
+
+
+def main(argv=None):
+    """
+    Writes the delta manifest of a file.
+
+    :param argv: The command line arguments. Defaults to sys.argv[1:].
+    :type argv: list
+    """
+    parser = argparse.ArgumentParser(description="Make the delta manifest of a file for delta updates.")
+    parser.add_argument('file', help="the file to make the manifest of")
+    parser.add_argument('-b', '--block-size', type=int, default=DELTA_BLOCK_SIZE, metavar='BYTES',
+                        help=f"the block size (default: {DELTA_BLOCK_SIZE})")
+    parser.add_argument('-a', '--algorithm', default=DELTA_ALGORITHM,
+                        help=f"the hashlib algorithm of the block digests (default: {DELTA_ALGORITHM})")
+    parser.add_argument('-o', '--output', help="where to write the manifest (default: FILE.delta.json)")
+    args = parser.parse_args(argv)
+    manifest = DeltaManifest.make(args.file, args.block_size, args.algorithm)
+    manifest.save(args.output or f"{args.file}.delta.json")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,321 @@
+import os
+import threading
+import time
+from core import (DownloadManager, ConnectionLimiter, SpeedMeter, default_save_path,
+                  UPDATE_INTERVAL)
+from retry import ERROR_BUDGET
+
+MAX_DOWNLOADS = 8
+MAX_CONNECTIONS = 16
+MAX_PER_HOST = 4
+
+
+class DownloadJob:
+    """A single URL of a DownloadQueue and what became of it."""
+
+    def __init__(self, url, save_path):
+        """
+        Initializes a DownloadJob instance.
+
+        :param url: The URL of the file to download.
+        :type url: str
+        :param save_path: The path to save the downloaded file to.
+        :type save_path: str
+        """
+        self.url = url
+        self.save_path = save_path
+        self.manager = None
+        self.error = None
+        self.finished = False
+
+
+class DownloadQueue:
+    """
+    Downloads many files side by side within a global and a per-host connection budget.
+
+    Up to max_downloads files are downloaded at once, each by its own DownloadManager.
+    All of them share one ConnectionLimiter, so no more than max_connections requests are
+    in flight overall and no more than max_per_host go to any one origin. Small files take
+    the single-connection fast path of DownloadManager.
+
+    Listeners added with add_listener are called as listener(event, *args) with one of the
+    EVENTS below.
+    """
+
+    EVENTS = (
+        'job_started',  # URL of a file whose download has started (str)
+        'job_finished',  # URL of a finished file (str) and its error message or None
+        'progress',  # bytes downloaded so far over all files (int)
+        'progress_percent',  # percentage of the files downloaded (float)
+        'speed',  # current combined speed in bytes per second (float)
+        'max_speed',  # highest combined speed so far in bytes per second (float)
+        'finished_download',  # every file is finished, whether it succeeded or not
+        'error_occurred',  # "URL: error message" of a file that failed (str)
+    )
+
+    def __init__(self, directory='', num_threads=4, max_downloads=MAX_DOWNLOADS,
+                 max_connections=MAX_CONNECTIONS, max_per_host=MAX_PER_HOST, engine='threads',
+                 update_interval=UPDATE_INTERVAL, pool=None, rate_limit=None, trace=None,
+                 max_errors=ERROR_BUDGET):
+        """
+        Initializes a DownloadQueue instance.
+
+        :param directory: The directory to save the files to. Defaults to the current
+            directory.
+        :type directory: str
+        :param num_threads: The number of connections each file may use, or AUTO to tune
+            it for each file. Defaults to 4.
+        :type num_threads: int or str
+        :param max_downloads: The number of files downloaded at once. Defaults to
+            MAX_DOWNLOADS.
+        :type max_downloads: int
+        :param max_connections: The maximum number of requests in flight overall.
+            Defaults to MAX_CONNECTIONS.
+        :type max_connections: int
+        :param max_per_host: The maximum number of requests in flight to one host.
+            Defaults to MAX_PER_HOST.
+        :type max_per_host: int
+        :param engine: The engine each DownloadManager downloads with. Defaults to 'threads'.
+        :type engine: str
+        :param update_interval: The number of seconds between progress updates, or None to
+            emit no progress events at all. Defaults to UPDATE_INTERVAL.
+        :type update_interval: float
+        :param pool: The connection pool to borrow sessions from. Defaults to the pool
+            shared by all downloads.
+        :type pool: ConnectionPool
+        :param rate_limit: The bandwidth limit of each file in bytes per second. Defaults
+            to no limit.
+        :type rate_limit: float
+        :param trace: The trace every DownloadManager writes the metrics of its requests
+            to. Defaults to none.
+        :type trace: TraceWriter
+        :param max_errors: The number of failed requests in a row each file survives by
+            retrying them, or None for no limit. Defaults to ERROR_BUDGET.
+        :type max_errors: int
+        """
+        self.directory = directory
+        self.num_threads = num_threads
+        self.max_downloads = max_downloads
+        self.engine = engine
+        self.update_interval = update_interval
+        self.pool = pool
+        self.rate_limit = rate_limit
+        self.trace = trace
+        self.max_errors = max_errors
+        self.limiter = ConnectionLimiter(max_connections, max_per_host)
+        self.jobs = []
+        self.save_paths = set()
+        self.listeners = []
+        self.lock = threading.Lock()
+        self.speed_meter = SpeedMeter()
+        self.max_speed_value = 0
+        self.done = threading.Event()
+        self.cancelled = False
+        self.paused = False
+
+    def add(self, url, save_path=None):
+        """
+        Adds a URL to the queue.
+
+        :param url: The URL of the file to download.
+        :type url: str
+        :param save_path: The path to save the file to. Defaults to the file name of the
+            URL in the queue's directory, numbered if another job already uses it.
+        :type save_path: str
+        :return: The job for the URL.
+        :rtype: DownloadJob
+        """
+        if save_path is None:
+            save_path = default_save_path(url, self.directory)
+            root, extension = os.path.splitext(save_path)
+            number = 1
+            while save_path in self.save_paths:
+                save_path = f"{root}-{number}{extension}"
+                number += 1
+        self.save_paths.add(save_path)
+        job = DownloadJob(url, save_path)
+        self.jobs.append(job)
+        return job
+
+    def add_list(self, path):
+        """
+        Adds every URL of a list file, one per line. Blank lines and lines starting with
+        # are skipped.
+
+        :param path: The path of the list file.
+        :type path: str
+        """
+        with open(path, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    self.add(line)
+
+    def add_listener(self, listener):
+        """
+        Registers a callable to be told about the events of the queue.
+
+        :param listener: Called as listener(event, *args) for every event in EVENTS.
+        :type listener: callable
+        """
+        self.listeners.append(listener)
+
+    def emit(self, event, *args):
+        """
+        Calls every listener with an event.
+
+        :param event: The name of the event, one of EVENTS.
+        :type event: str
+        """
+        for listener in self.listeners:
+            listener(event, *args)
+
+    def run(self):
+        """
+        Downloads every job of the queue and returns when all of them are over.
+
+        Starts a thread per job as soon as fewer than max_downloads jobs are running, and
+        meanwhile publishes the combined progress every update_interval seconds.
+        """
+        self.done.clear()
+        reporter = None
+        if self.update_interval:
+            reporter = threading.Thread(target=self.report_progress, daemon=True)
+            reporter.start()
+
+        running = threading.BoundedSemaphore(self.max_downloads)
+        threads = []
+        for job in self.jobs:
+            while not running.acquire(timeout=0.5):
+                if self.cancelled:
+                    break
+            if self.cancelled:
+                break
+            thread = threading.Thread(target=self.run_job, args=(job, running), daemon=True)
+            threads.append(thread)
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.done.set()
+        if reporter is not None:
+            reporter.join()
+            self.update_progress()
+        self.emit('finished_download')
+
+    def run_job(self, job, running):
+        """
+        Downloads a single job and frees its place among the running jobs afterwards.
+
+        :param job: The job to download.
+        :type job: DownloadJob
+        :param running: The semaphore counting the running jobs.
+        :type running: threading.BoundedSemaphore
+        """
+        def on_event(event, *args):
+            if event == 'error_occurred' and job.error is None:
+                job.error = args[0]
+
+        try:
+            manager = DownloadManager(job.url, job.save_path, self.num_threads, pool=self.pool,
+                                      engine=self.engine, update_interval=None, limiter=self.limiter,
+                                      trace=self.trace, max_errors=self.max_errors)
+            manager.add_listener(on_event)
+            with self.lock:
+                manager.set_rate_limit(self.rate_limit)
+                if self.paused:
+                    manager.pause()
+                job.manager = manager
+            if self.cancelled:
+                return
+            self.emit('job_started', job.url)
+            manager.run()
+        except Exception as e:
+            job.error = str(e)
+        finally:
+            job.finished = True
+            running.release()
+            if job.error is not None:
+                self.emit('error_occurred', f"{job.url}: {job.error}")
+            self.emit('job_finished', job.url, job.error)
+
+    def report_progress(self):
+        """Calls update_progress every update_interval seconds until the queue is done."""
+        while not self.done.wait(self.update_interval):
+            self.update_progress()
+
+    def update_progress(self):
+        """
+        Publishes the combined progress of all jobs.
+
+        The percentage counts every job equally, with running jobs counted by how much of
+        their file is done, because the sizes of jobs that have not started are unknown.
+        """
+        with self.lock:
+            managers = [(job, job.manager) for job in self.jobs if job.manager is not None]
+        downloaded = 0
+        completed = 0.0
+        for job, manager in managers:
+            done = manager.bytes_downloaded()
+            downloaded += done
+            if job.finished:
+                completed += 1
+            elif manager.total_size:
+                completed += min(done / manager.total_size, 1.0)
+        self.emit('progress', downloaded)
+        self.emit('progress_percent', completed / len(self.jobs) * 100 if self.jobs else 100.0)
+
+        current_speed = self.speed_meter.update(time.monotonic(), downloaded)
+        self.emit('speed', current_speed)
+        if current_speed > self.max_speed_value:
+            self.max_speed_value = current_speed
+            self.emit('max_speed', self.max_speed_value)
+
+    def stats(self):
+        """
+        Returns the metrics of every download that has started.
+
+        :return: The stats of each DownloadManager, see DownloadManager.stats.
+        :rtype: list
+        """
+        with self.lock:
+            managers = [job.manager for job in self.jobs if job.manager is not None]
+        return [manager.stats() for manager in managers]
+
+    def set_rate_limit(self, rate):
+        """
+        Changes the bandwidth limit of each file, for the running downloads as well as
+        those still to come.
+
+        :param rate: The limit in bytes per second, or None for no limit.
+        :type rate: float
+        """
+        with self.lock:
+            self.rate_limit = rate
+            managers = [job.manager for job in self.jobs if job.manager is not None]
+        for manager in managers:
+            manager.set_rate_limit(rate)
+
+    def pause(self):
+        """Pauses every running download, and those started until resume is called."""
+        with self.lock:
+            self.paused = True
+            managers = [job.manager for job in self.jobs if job.manager is not None]
+        for manager in managers:
+            manager.pause()
+
+    def resume(self):
+        """Resumes every running download."""
+        with self.lock:
+            self.paused = False
+            managers = [job.manager for job in self.jobs if job.manager is not None]
+        for manager in managers:
+            manager.resume()
+
+    def cancel(self):
+        """Cancels every running download and starts no new ones."""
+        self.cancelled = True
+        with self.lock:
+            managers = [job.manager for job in self.jobs if job.manager is not None]
+        for manager in managers:
+            manager.cancel()
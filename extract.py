@@ -0,0 +1,359 @@
+import bz2
+import gzip
+import io
+import lzma
+import os
+import shutil
+import tarfile
+import threading
+
+try:
+    import zstandard
+except ImportError:  # Optional, only needed for .zst files.
+    zstandard = None
+
+EXTRACT_READ_SIZE = 1024 * 1024
+EXTRACT_POLL_INTERVAL = 0.05
+COMPRESSION_MAGIC = (
+    (b'\x1f\x8b', 'gzip'),
+    (b'BZh', 'bzip2'),
+    (b'\xfd7zXZ\x00', 'xz'),
+    (b'\x28\xb5\x2f\xfd', 'zstd'),
+)
+TAR_MAGIC_OFFSET = 257
+TAR_HEADER_SIZE = 512
+
+
+class ExtractionStopped(Exception):
+    """Raised inside the extractor thread when the download is cancelled."""
+
+
+class PrefixReader(io.RawIOBase):
+    """
+    A read-only file over the contiguous prefix of a file being downloaded.
+
+    Reads wait until the journal records more bytes in order, and return the end of the
+    file only once the download has finished, so decompressors and tarfile can read it
+    like any other file while it is still coming in.
+    """
+
+    def __init__(self, output, journal):
+        """
+        Initializes a PrefixReader instance.
+
+        :param output: The file being downloaded into.
+        :type output: OutputFile
+        :param journal: The journal whose contiguous prefix is safe to read.
+        :type journal: ResumeJournal
+        """
+        super().__init__()
+        self.output = output
+        self.journal = journal
+        self.position = 0
+        self.finishing = False
+        self.cancelled = False
+        self.changed = threading.Event()
+
+    def readable(self):
+        """The reader can be read from."""
+        return True
+
+    def available(self):
+        """
+        Waits until there are bytes to read or the download is over.
+
+        :return: Where the bytes that can be read now end.
+        :rtype: int
+        :raises: ExtractionStopped if the download was cancelled.
+        """
+        while True:
+            if self.cancelled:
+                raise ExtractionStopped()
+            finishing = self.finishing
+            end = self.output.size if finishing else self.journal.prefix()
+            if self.position < end or finishing:
+                return end
+            self.changed.wait(EXTRACT_POLL_INTERVAL)
+
+    def readinto(self, buffer):
+        """
+        Reads the next bytes of the prefix, waiting for them if needed.
+
+        :param buffer: The buffer to read into.
+        :type buffer: bytearray or memoryview
+        :return: The number of bytes read, 0 at the end of the finished file.
+        :rtype: int
+        """
+        end = self.available()
+        if self.position >= end:
+            return 0
+        data = self.output.read_at(self.position, min(len(buffer), end - self.position))
+        if not data:
+            raise OSError("The output file is shorter than expected.")
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def peek_start(self, length):
+        """
+        Returns the first bytes of the file without moving the position, waiting until
+        they have been downloaded.
+
+        :param length: The number of bytes, fewer if the file is shorter.
+        :type length: int
+        :rtype: bytes
+        """
+        position = self.position
+        self.position = 0
+        try:
+            while self.available() < min(length, self.output.size) and not self.finishing:
+                self.changed.wait(EXTRACT_POLL_INTERVAL)
+        finally:
+            self.position = position
+        return self.output.read_at(0, min(length, self.output.size))
+
+
+class HeadReader:
+    """A file object that returns some bytes already read, then the rest of a stream."""
+
+    def __init__(self, head, stream):
+        """
+        Initializes a HeadReader instance.
+
+        :param head: The bytes read from the start of the stream.
+        :type head: bytes
+        :param stream: The rest of the stream.
+        :type stream: file object
+        """
+        self.head = head
+        self.stream = stream
+
+    def read(self, size=-1):
+        """
+        Reads up to size bytes, or everything that is left if size is negative.
+
+        :rtype: bytes
+        """
+        if not self.head:
+            return self.stream.read(size)
+        if size < 0:
+            data, self.head = self.head + self.stream.read(), b''
+            return data
+        data, self.head = self.head[:size], self.head[size:]
+        return data
+
+
+def read_fully(stream, length):
+    """
+    Reads length bytes from a stream whose reads may return fewer.
+
+    :param stream: The stream.
+    :type stream: file object
+    :param length: The number of bytes to read.
+    :type length: int
+    :return: The bytes read, fewer only at the end of the stream.
+    :rtype: bytes
+    """
+    chunks = []
+    while length > 0:
+        data = stream.read(length)
+        if not data:
+            break
+        chunks.append(data)
+        length -= len(data)
+    return b''.join(chunks)
+
+
+def detect_compression(head):
+    """
+    Tells the compression of a file from its first bytes.
+
+    :param head: At least the first 6 bytes of the file, unless it is shorter.
+    :type head: bytes
+    :return: 'gzip', 'bzip2', 'xz', 'zstd', or None if it is not compressed in a format
+        that can be streamed.
+    :rtype: str or None
+    """
+    for magic, compression in COMPRESSION_MAGIC:
+        if head.startswith(magic):
+            return compression
+    return None
+
+
+def decompressed(stream, compression):
+    """
+    Wraps a stream of compressed bytes in a stream of the decompressed ones.
+
+    Files made of several concatenated members or frames, as written by pigz or pbzip2,
+    are read to the end.
+
+    :param stream: The compressed stream.
+    :type stream: file object
+    :param compression: The compression, see detect_compression, or None.
+    :type compression: str or None
+    :rtype: file object
+    :raises: ValueError if the compression needs a module that is not installed.
+    """
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=stream, mode='rb')
+    if compression == 'bzip2':
+        return bz2.BZ2File(stream)
+    if compression == 'xz':
+        return lzma.LZMAFile(stream)
+    if compression == 'zstd':
+        if zstandard is None:
+            raise ValueError("Decompressing zstd files needs the zstandard package.")
+        return zstandard.ZstdDecompressor().stream_reader(stream, read_across_frames=True)
+    return stream
+
+
+def inside(path, directory):
+    """
+    Tells whether a path is in a directory once symbolic links are resolved.
+
+    :param path: The path.
+    :type path: str
+    :param directory: The directory.
+    :type directory: str
+    :rtype: bool
+    """
+    directory = os.path.realpath(directory)
+    return os.path.commonpath([os.path.realpath(path), directory]) == directory
+
+
+def check_member(member, destination):
+    """
+    Refuses a tar member that could write outside of the destination directory, for
+    Pythons whose tarfile has no extraction filters.
+
+    :param member: The member about to be extracted.
+    :type member: tarfile.TarInfo
+    :param destination: The directory the archive is unpacked into.
+    :type destination: str
+    :raises: ValueError if the member has an absolute path, leaves the destination, links
+        to outside of it, or is a device file or named pipe.
+    """
+    if os.path.isabs(member.name) or os.path.splitdrive(member.name)[0]:
+        raise ValueError(f"The archive member {member.name!r} has an absolute path.")
+    path = os.path.join(destination, member.name)
+    if not inside(path, destination):
+        raise ValueError(f"The archive member {member.name!r} is outside of the destination.")
+    if member.issym() or member.islnk():
+        if os.path.isabs(member.linkname):
+            raise ValueError(f"The archive member {member.name!r} links to an absolute path.")
+        base = os.path.dirname(path) if member.issym() else destination
+        if not inside(os.path.join(base, member.linkname), destination):
+            raise ValueError(f"The archive member {member.name!r} links to outside of the destination.")
+    elif not (member.isfile() or member.isdir()):
+        raise ValueError(f"The archive member {member.name!r} is a device file or named pipe.")
+
+
+class PrefixExtractor(threading.Thread):
+    """
+    Decompresses or unpacks a file while it is being downloaded.
+
+    Like PrefixHasher, the thread follows the contiguous prefix of the file recorded in
+    the journal and reads each newly completed part back while it is still in the page
+    cache, so decompression runs alongside the download instead of in a second pass over
+    the whole file afterwards. The workers never wait for it.
+
+    The format is told from the first bytes. A gzip, bzip2, xz or zstd file is
+    decompressed; if the result, or the file itself, is a tar archive, it is unpacked
+    into the destination directory, otherwise it is written to the destination file.
+    Formats that cannot be read as a stream, such as 7z and zip, whose index is at the
+    end, are rejected.
+    """
+
+    def __init__(self, output, journal, destination):
+        """
+        Initializes a PrefixExtractor instance.
+
+        :param output: The file being downloaded into.
+        :type output: OutputFile
+        :param journal: The journal whose contiguous prefix is safe to read.
+        :type journal: ResumeJournal
+        :param destination: The directory to unpack a tar archive into, or the file to
+            write the decompressed bytes of anything else to.
+        :type destination: str
+        """
+        super().__init__(daemon=True)
+        self.reader = PrefixReader(output, journal)
+        self.destination = destination
+        self.error = None
+
+    def run(self):
+        """Extracts the file as it grows until it has been read to the end."""
+        try:
+            compression = detect_compression(self.reader.peek_start(8))
+            stream = decompressed(io.BufferedReader(self.reader, EXTRACT_READ_SIZE), compression)
+            head = read_fully(stream, TAR_HEADER_SIZE)
+            if head[TAR_MAGIC_OFFSET:TAR_MAGIC_OFFSET + 5] == b'ustar':
+                self.unpack(HeadReader(head, stream))
+            elif compression is not None:
+                self.write(head, stream)
+            else:
+                raise ValueError("The file is not a gzip, bzip2, xz, zstd or tar file.")
+        except ExtractionStopped:
+            pass
+        except Exception as e:
+            self.error = e
+
+    def unpack(self, stream):
+        """
+        Unpacks a tar archive member by member into the destination directory.
+
+        Members that would end up outside of it, links to outside of it and device files
+        are refused, by tarfile's data filter where it has one and by check_member
+        otherwise, which like the filter also drops set-user-ID and group- or world-writable
+        mode bits and the owner of the members.
+
+        :param stream: The uncompressed tar archive.
+        :type stream: file object
+        :raises: ValueError if a member is refused.
+        """
+        os.makedirs(self.destination, exist_ok=True)
+        with tarfile.open(fileobj=stream, mode='r|') as archive:
+            if hasattr(tarfile, 'data_filter'):
+                archive.extractall(self.destination, filter='data')
+                return
+            for member in archive:
+                check_member(member, self.destination)
+                member.mode &= 0o755
+                member.uname = member.gname = ''
+                if hasattr(os, 'getuid'):
+                    member.uid, member.gid = os.getuid(), os.getgid()
+                archive.extract(member, self.destination)
+
+    def write(self, head, stream):
+        """
+        Writes the decompressed bytes to the destination file, next to it first and
+        renamed over it once complete.
+
+        :param head: The first decompressed bytes, already read.
+        :type head: bytes
+        :param stream: The rest of the decompressed bytes.
+        :type stream: file object
+        """
+        temp_path = f"{self.destination}.part"
+        with open(temp_path, 'wb') as f:
+            f.write(head)
+            shutil.copyfileobj(stream, f, EXTRACT_READ_SIZE)
+        os.replace(temp_path, self.destination)
+
+    def finish(self):
+        """
+        Extracts what is left of the file once every byte has been written.
+
+        :raises: The error the thread ran into, if any.
+        """
+        self.reader.finishing = True
+        self.reader.changed.set()
+        self.join()
+        if self.error is not None:
+            raise self.error
+
+    def stop(self):
+        """Stops the thread without extracting the rest of the file and waits for it."""
+        self.reader.cancelled = True
+        self.reader.changed.set()
+        self.join()
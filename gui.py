@@ -4,7 +4,8 @@ from PyQt6.QtWidgets import (
     QProgressBar, QFileDialog, QMessageBox, QGridLayout
 )
 from PyQt6.QtCore import Qt
-from core import DownloadManager
+from core import AUTO, global_rate_limiter
+from qt_adapter import QtDownloadManager, QtDownloadQueue
 
 
 class Downloader(QMainWindow):
@@ -13,15 +14,16 @@ class Downloader(QMainWindow):
         Initializes the main window of the application.
 
         Sets the window title, size, initializes the UI components, and
-        sets the download manager and max speed to None and 0, respectively.
+        sets the download manager, failed downloads and max speed to None, an empty list and 0, respectively.
 
         :return: None
         """
         super().__init__()
         self.setWindowTitle("Quick Downloader v2")
-        self.setFixedSize(600, 350)
+        self.setFixedSize(600, 380)
         self.init_ui()
         self.download_manager = None
+        self.failed_downloads = []
         self.max_speed = 0
 
     def init_ui(self):
@@ -45,7 +47,7 @@ class Downloader(QMainWindow):
         layout.addWidget(self.url_label, 0, 0, alignment=Qt.AlignmentFlag.AlignLeft)
 
         self.url_entry = QLineEdit()
-        self.url_entry.setPlaceholderText("Enter the URL to download")
+        self.url_entry.setPlaceholderText("Enter the URL to download, or several separated by spaces")
         layout.addWidget(self.url_entry, 0, 1, 1, 3)
 
         # Download Button
@@ -70,36 +72,58 @@ class Downloader(QMainWindow):
         layout.addWidget(self.threads_label, 2, 0, alignment=Qt.AlignmentFlag.AlignLeft)
 
         self.threads_entry = QLineEdit("4")
+        self.threads_entry.setToolTip("The number of connections per file, or auto to tune it while downloading")
         self.threads_entry.setFixedWidth(50)
         layout.addWidget(self.threads_entry, 2, 1)
 
+        # Speed Limits, applied to the running download as soon as they are edited
+        self.file_limit_label = QLabel("Limit per file (KiB/s):")
+        layout.addWidget(self.file_limit_label, 2, 2, alignment=Qt.AlignmentFlag.AlignLeft)
+
+        self.file_limit_entry = QLineEdit()
+        self.file_limit_entry.setPlaceholderText("none")
+        self.file_limit_entry.setFixedWidth(80)
+        self.file_limit_entry.editingFinished.connect(self.apply_speed_limits)
+        layout.addWidget(self.file_limit_entry, 2, 3)
+
+        self.total_limit_label = QLabel("Total limit (KiB/s):")
+        layout.addWidget(self.total_limit_label, 3, 2, alignment=Qt.AlignmentFlag.AlignLeft)
+
+        self.total_limit_entry = QLineEdit()
+        self.total_limit_entry.setPlaceholderText("none")
+        self.total_limit_entry.setFixedWidth(80)
+        self.total_limit_entry.editingFinished.connect(self.apply_speed_limits)
+        layout.addWidget(self.total_limit_entry, 3, 3)
+
         # Progress Bar
         self.progress_bar = QProgressBar()
         self.progress_bar.setValue(0)
         self.progress_bar.setMaximum(100)
-        layout.addWidget(self.progress_bar, 3, 0, 1, 4)
+        layout.addWidget(self.progress_bar, 4, 0, 1, 4)
 
         # Progress Label
         self.progress_label = QLabel("Downloaded: 0.00%")
-        layout.addWidget(self.progress_label, 4, 0, 1, 4)
+        layout.addWidget(self.progress_label, 5, 0, 1, 4)
 
         # Time Remaining Label
         self.time_label = QLabel("Estimated time remaining: 0.00 seconds")
-        layout.addWidget(self.time_label, 5, 0, 1, 4)
+        layout.addWidget(self.time_label, 6, 0, 1, 4)
 
         # Current Speed Label
         self.speed_label = QLabel("Current speed: 0.00 bytes/second")
-        layout.addWidget(self.speed_label, 6, 0, 1, 4)
+        layout.addWidget(self.speed_label, 7, 0, 1, 4)
 
         # Max Speed Label
         self.max_speed_label = QLabel("Max speed: 0.00 bytes/second")
-        layout.addWidget(self.max_speed_label, 7, 0, 1, 4)
+        layout.addWidget(self.max_speed_label, 8, 0, 1, 4)
 
     def start_download(self):
         """
         Starts the download process based on the user's input.
 
-        This method gets the URL and number of threads from the user interface, prompts the user to select a save location, and starts the download process using the DownloadManager class.
+        This method gets the URL and number of threads from the user interface, prompts the user to select a save location, and starts the download process using the QtDownloadManager class.
+
+        If several URLs separated by spaces are entered, the user is asked for a folder instead, and the files are downloaded side by side by a QtDownloadQueue.
 
         If the user enters invalid input, a warning message box will pop up and the method will return without starting the download.
 
@@ -109,26 +133,38 @@ class Downloader(QMainWindow):
 
         The method also sets the initial text of the max speed label to 0.00 bytes/second.
 
-        The method connects the signals of the DownloadManager instance to the corresponding slots of this class.
+        The method connects the signals of the QtDownloadManager instance to the corresponding slots of this class.
 
-        Finally, the method starts the DownloadManager instance and begins the download process.
+        Finally, the method starts the QtDownloadManager instance and begins the download process.
         """
-        url = self.url_entry.text().strip()
-        if not url:
+        urls = self.url_entry.text().split()
+        if not urls:
             QMessageBox.warning(self, "Input Error", "Please enter a valid URL.")
             return
 
         try:
-            num_threads = int(self.threads_entry.text())
-            if num_threads < 1:
-                raise ValueError
+            num_threads = self.threads_entry.text().strip().lower()
+            if num_threads != AUTO:
+                num_threads = int(num_threads)
+                if num_threads < 1:
+                    raise ValueError
         except ValueError:
-            QMessageBox.warning(self, "Input Error", "Please enter a valid number of threads.")
+            QMessageBox.warning(self, "Input Error", "Please enter a valid number of threads, or auto.")
             return
 
-        save_path, _ = QFileDialog.getSaveFileName(self, "Save File", "", "All Files (*)")
-        if not save_path:
-            return  # User cancelled the save dialog
+        limits = self.read_speed_limits()
+        if limits is None:
+            return
+        file_limit, total_limit = limits
+
+        if len(urls) > 1:
+            directory = QFileDialog.getExistingDirectory(self, "Save Files To")
+            if not directory:
+                return  # User cancelled the folder dialog
+        else:
+            save_path, _ = QFileDialog.getSaveFileName(self, "Save File", "", "All Files (*)")
+            if not save_path:
+                return  # User cancelled the save dialog
 
         self.download_button.setEnabled(False)
         self.cancel_button.setEnabled(True)
@@ -137,16 +173,62 @@ class Downloader(QMainWindow):
         self.max_speed = 0
         self.max_speed_label.setText("Max speed: 0.00 bytes/second")
 
-        self.download_manager = DownloadManager(url, save_path, num_threads)
-        self.download_manager.progress.connect(self.update_progress)
+        global_rate_limiter.set_rate(total_limit)
+        if len(urls) > 1:
+            self.download_manager = QtDownloadQueue(urls, directory, num_threads, rate_limit=file_limit)
+        else:
+            self.download_manager = QtDownloadManager(urls[0], save_path, num_threads, rate_limit=file_limit)
+            self.download_manager.progress.connect(self.update_progress)
         self.download_manager.progress_percent.connect(self.update_progress_percent)
         self.download_manager.speed.connect(self.update_speed)
         self.download_manager.max_speed.connect(self.update_max_speed)
         self.download_manager.time_remaining.connect(self.update_time_remaining)
         self.download_manager.finished_download.connect(self.download_finished)
-        self.download_manager.error_occurred.connect(self.download_error)
+        if len(urls) > 1:
+            self.failed_downloads = []
+            self.download_manager.error_occurred.connect(self.failed_downloads.append)
+        else:
+            self.download_manager.error_occurred.connect(self.download_error)
         self.download_manager.start()
 
+    def read_speed_limits(self):
+        """
+        Reads the speed limits entered by the user.
+
+        An empty field or 0 means no limit. If a field holds anything else that is not a
+        number, a warning message box will pop up.
+
+        :return: The limit per file and the total limit in bytes per second, each None for
+            no limit, or None if a field is invalid.
+        :rtype: tuple
+        """
+        limits = []
+        for entry in (self.file_limit_entry, self.total_limit_entry):
+            text = entry.text().strip()
+            try:
+                limit = float(text) if text else 0
+                if limit < 0:
+                    raise ValueError
+            except ValueError:
+                QMessageBox.warning(self, "Input Error", "Please enter a valid speed limit in KiB/s.")
+                return None
+            limits.append(limit * 1024 or None)
+        return tuple(limits)
+
+    def apply_speed_limits(self):
+        """
+        Slot function that is connected to the editingFinished signals of the speed limit entries.
+
+        Applies the limits to the running download, if there is one, so the user can
+        throttle or unthrottle it without restarting. Otherwise they are applied when the
+        next download starts.
+        """
+        if self.download_manager and self.download_manager.isRunning():
+            limits = self.read_speed_limits()
+            if limits is not None:
+                self.download_manager.set_rate_limit(limits[0])
+                global_rate_limiter.set_rate(limits[1])
+
     def cancel_download(self):
         """
         Slot function that is connected to the Cancel button's clicked signal.
@@ -199,7 +281,7 @@ class Downloader(QMainWindow):
         :type downloaded: int
         """
         percent = (downloaded / self.download_manager.total_size) * 100
-        self.progress_bar.setValue(percent)
+        self.progress_bar.setValue(int(percent))
 
     def update_progress_percent(self, percent):
         """
@@ -243,11 +325,17 @@ class Downloader(QMainWindow):
         """
         Slot function that is called when the download is finished or cancelled.
 
-        It pops up a message box to inform the user that the download is finished or cancelled.
+        It pops up a message box to inform the user that the download is finished or cancelled,
+        listing the files that failed if several were downloaded at once.
         It also resets the UI to its initial state.
         """
 
-        QMessageBox.information(self, "Download", "Download completed or cancelled.")
+        if self.failed_downloads:
+            QMessageBox.warning(self, "Download", f"{len(self.failed_downloads)} download(s) failed:\n"
+                                + "\n".join(self.failed_downloads[:10]))
+        else:
+            QMessageBox.information(self, "Download", "Download completed or cancelled.")
+        self.failed_downloads = []
         self.download_button.setEnabled(True)
         self.cancel_button.setEnabled(False)
         self.pause_button.setEnabled(False)
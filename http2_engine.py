@@ -0,0 +1,522 @@
+import asyncio
+import ssl
+import time
+from async_engine import AsyncRangeEngine, SLOT_POLL_INTERVAL, THROTTLE_BACKOFF, THROTTLE_STATUS_CODES, check_range
+from retry import StatusError
+
+try:
+    import h2.config
+    import h2.connection
+    import h2.errors
+    import h2.events
+    import h2.exceptions
+    import h2.settings
+except ImportError:  # Optional, only needed for the http2 engine.
+    h2 = None
+
+HTTP2_SUPPORTED = h2 is not None
+
+H2_STREAMS_PER_CONNECTION = 64
+H2_MAX_CONNECTIONS = 4
+H2_STREAM_WINDOW = 4 * 1024 * 1024
+H2_CONNECTION_WINDOW = 32 * 1024 * 1024
+H2_MAX_FRAME_SIZE = 256 * 1024
+H2_READ_SIZE = 256 * 1024
+H2_DEFAULT_WINDOW = 65535
+H2C_PROBE_TIMEOUT = 3.0
+
+
+class Http2Connection:
+    """
+    An HTTP/2 connection that many range requests are multiplexed over, one per stream.
+
+    A task reads the frames from the server and sorts their events into a queue per
+    stream, from which the worker that made the request reads its response until it
+    releases the stream with reset. Received data is acknowledged when the worker takes
+    it from the queue, so the server can only send as far ahead of the workers as the
+    flow-control windows allow.
+
+    The windows are raised from the 64 KiB default to H2_STREAM_WINDOW per stream and
+    H2_CONNECTION_WINDOW for the connection, enough to keep a link of about 1 Gbit/s
+    with a round trip of 250 ms busy over a single connection.
+    """
+
+    def __init__(self, reader, writer, origin):
+        """
+        Initializes an Http2Connection instance.
+
+        :param reader: The reader of the connection.
+        :type reader: asyncio.StreamReader
+        :param writer: The writer of the connection.
+        :type writer: asyncio.StreamWriter
+        :param origin: The server the connection is open to.
+        :type origin: Origin
+        """
+        self.h2 = h2.connection.H2Connection(h2.config.H2Configuration(client_side=True, header_encoding='utf-8'))
+        self.reader = reader
+        self.writer = writer
+        self.origin = origin
+        self.streams = {}
+        self.max_streams = H2_STREAMS_PER_CONNECTION
+        self.closed = False
+        self.task = None
+
+    async def start(self, timeout):
+        """
+        Sends the connection preface and the window sizes, and waits for the header of
+        the first frame of the server, which has to be its SETTINGS.
+
+        :param timeout: The number of seconds to wait for the server.
+        :type timeout: float
+        :return: True if the server speaks HTTP/2, False if it answered something else,
+            such as an HTTP/1.1 error response, or closed the connection.
+        :rtype: bool
+        """
+        self.h2.initiate_connection()
+        self.h2.update_settings({
+            h2.settings.SettingCodes.ENABLE_PUSH: 0,
+            h2.settings.SettingCodes.INITIAL_WINDOW_SIZE: H2_STREAM_WINDOW,
+            h2.settings.SettingCodes.MAX_FRAME_SIZE: H2_MAX_FRAME_SIZE,
+        })
+        self.h2.increment_flow_control_window(H2_CONNECTION_WINDOW - H2_DEFAULT_WINDOW)
+        self.flush()
+        await self.writer.drain()
+        try:
+            data = await asyncio.wait_for(self.reader.readexactly(9), timeout)
+        except asyncio.IncompleteReadError:
+            return False
+        if data.startswith(b'HTTP/1.') or data[3] != 0x4:
+            return False
+        self.receive(data)
+        if self.closed:
+            return False
+        self.task = asyncio.get_running_loop().create_task(self.receive_loop())
+        return True
+
+    def has_capacity(self):
+        """
+        Tells whether another stream can be opened on the connection.
+
+        :rtype: bool
+        """
+        return not self.closed and len(self.streams) < self.max_streams
+
+    def flush(self):
+        """Sends the frames the h2 state machine has queued up."""
+        data = self.h2.data_to_send()
+        if data and not self.writer.is_closing():
+            self.writer.write(data)
+
+    async def receive_loop(self):
+        """Reads frames from the server until the connection is closed."""
+        try:
+            while True:
+                data = await self.reader.read(H2_READ_SIZE)
+                if not data:
+                    raise ConnectionError("The server closed the connection.")
+                self.receive(data)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.fail(e)
+
+    def receive(self, data):
+        """
+        Feeds bytes received from the server to the h2 state machine and hands the events
+        to the streams they belong to.
+
+        :param data: The bytes received.
+        :type data: bytes
+        """
+        try:
+            events = self.h2.receive_data(data)
+        except h2.exceptions.ProtocolError as e:
+            self.fail(ConnectionError(f"HTTP/2 protocol error: {e}"))
+            return
+        for event in events:
+            if isinstance(event, h2.events.ResponseReceived):
+                self.deliver(event.stream_id, ('head', dict(event.headers)))
+            elif isinstance(event, h2.events.DataReceived):
+                if event.stream_id in self.streams:
+                    self.deliver(event.stream_id, ('data', event.data, event.flow_controlled_length))
+                else:
+                    self.h2.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+            elif isinstance(event, h2.events.StreamEnded):
+                self.deliver(event.stream_id, ('end',))
+            elif isinstance(event, h2.events.StreamReset):
+                error = ConnectionError(f"The server reset the stream with error code {event.error_code}.")
+                self.deliver(event.stream_id, ('error', error))
+            elif isinstance(event, h2.events.RemoteSettingsChanged):
+                self.max_streams = min(H2_STREAMS_PER_CONNECTION, self.h2.remote_settings.max_concurrent_streams)
+            elif isinstance(event, h2.events.ConnectionTerminated):
+                # h2 sends nothing more after a GOAWAY, not even window updates, so the
+                # streams still open are retried on another connection.
+                self.fail(ConnectionError(f"The server closed the HTTP/2 connection with error code "
+                                          f"{event.error_code}."))
+                return
+        self.flush()
+
+    def deliver(self, stream_id, item):
+        """
+        Puts an event into the queue of a stream, if the stream is still open.
+
+        :param stream_id: The stream.
+        :type stream_id: int
+        :param item: The event: ('head', headers), ('data', bytes, flow-controlled
+            length), ('end',) or ('error', exception).
+        :type item: tuple
+        """
+        queue = self.streams.get(stream_id)
+        if queue is not None:
+            queue.put_nowait(item)
+
+    def fail(self, error):
+        """
+        Closes the connection after an error and fails every stream on it.
+
+        :param error: The error to raise in the workers reading the streams.
+        :type error: Exception
+        """
+        self.closed = True
+        for queue in self.streams.values():
+            queue.put_nowait(('error', error))
+        self.streams.clear()
+        self.writer.close()
+
+    def open_stream(self, segment):
+        """
+        Requests a segment on a new stream.
+
+        :param segment: The segment to request.
+        :type segment: Segment
+        :return: The stream ID and the queue its events are put into.
+        :rtype: tuple
+        :raises: ConnectionError if the connection cannot take another stream.
+        """
+        origin = self.origin
+        try:
+            stream_id = self.h2.get_next_available_stream_id()
+            self.h2.send_headers(stream_id, [
+                (':method', 'GET'),
+                (':scheme', 'https' if origin.tls else 'http'),
+                (':authority', origin.host_header),
+                (':path', origin.path),
+                ('range', f"bytes={segment.position}-{segment.end}"),
+                ('accept-encoding', 'identity'),
+            ], end_stream=True)
+        except h2.exceptions.ProtocolError as e:
+            error = ConnectionError(f"Cannot open another HTTP/2 stream: {e}")
+            self.fail(error)
+            raise error
+        queue = asyncio.Queue()
+        self.streams[stream_id] = queue
+        self.flush()
+        return stream_id, queue
+
+    def acknowledge(self, stream_id, length):
+        """
+        Hands the window space of data a worker has taken back to the server.
+
+        :param stream_id: The stream the data was received on.
+        :type stream_id: int
+        :param length: The flow-controlled length of the data.
+        :type length: int
+        """
+        if not self.closed:
+            self.h2.acknowledge_received_data(length, stream_id)
+            self.flush()
+
+    def reset(self, stream_id, error=None):
+        """
+        Releases a stream once its worker is done with it, cancelling it if it is still
+        open, and hands the window space of the data that was received for it but not
+        read back to the server.
+
+        :param stream_id: The stream.
+        :type stream_id: int
+        :param error: The error to raise in the worker reading the stream, if any.
+        :type error: Exception
+        """
+        queue = self.streams.pop(stream_id, None)
+        if queue is None or self.closed:
+            return
+        try:
+            self.h2.reset_stream(stream_id, h2.errors.ErrorCodes.CANCEL)
+        except h2.exceptions.ProtocolError:
+            pass  # The stream has already been closed.
+        while not queue.empty():
+            item = queue.get_nowait()
+            if item[0] == 'data':
+                self.h2.acknowledge_received_data(item[2], stream_id)
+        if error is not None:
+            queue.put_nowait(('error', error))
+        self.flush()
+
+    def close(self):
+        """
+        Closes the connection, telling the server first if it is still open, and fails
+        the streams still on it.
+        """
+        if self.task is not None:
+            self.task.cancel()
+        if not self.closed:
+            self.h2.close_connection()
+            self.flush()
+        self.fail(ConnectionError("The connection was closed."))
+
+
+class Http2RangeEngine(AsyncRangeEngine):
+    """
+    Downloads the segments of a file as concurrent streams over a few HTTP/2 connections.
+
+    Servers that allow only a few connections per client can still serve many ranges at
+    once this way. Every worker of the AsyncRangeEngine becomes a stream instead of a
+    connection, so the concurrency is the number of streams, and everything else works
+    as with that engine: the scheduling, mirrors, retries, stall watchdog, pausing and
+    tuning the concurrency. Streams share the connections to their mirror: a new one is
+    opened only when all are at H2_STREAMS_PER_CONNECTION streams, or the server's own
+    limit, up to H2_MAX_CONNECTIONS.
+
+    HTTPS servers are offered h2 and HTTP/1.1 through ALPN. Plain HTTP servers are sent
+    the HTTP/2 preface directly, without an upgrade. A server that does not take up
+    HTTP/2 is downloaded from over HTTP/1.1 by the AsyncRangeEngine, one connection per
+    worker, from then on.
+    """
+
+    def __init__(self, *args, **kwargs):
+        """
+        Initializes an Http2RangeEngine instance, with the arguments of AsyncRangeEngine.
+
+        :raises: ValueError if the h2 package is not installed.
+        """
+        if h2 is None:
+            raise ValueError("The http2 engine needs the h2 package.")
+        super().__init__(*args, **kwargs)
+        self.sessions = {}
+        self.opening = set()
+
+    async def main(self):
+        """Runs the workers like AsyncRangeEngine does, then closes the connections."""
+        try:
+            await super().main()
+        finally:
+            self.close_sessions()
+
+    def close_sessions(self):
+        """Closes every HTTP/2 connection."""
+        for sessions in self.sessions.values():
+            for session in sessions:
+                session.close()
+        self.sessions.clear()
+
+    async def park(self):
+        """
+        Closes the HTTP/2 connections, whose streams are being reset by the other workers,
+        and waits while the download is paused like AsyncRangeEngine does.
+        """
+        self.close_sessions()
+        await super().park()
+
+    def origin(self, url):
+        """
+        Returns the parsed origin of a mirror's URL, offering h2 through ALPN for HTTPS.
+
+        :param url: The URL of the mirror.
+        :type url: str
+        :rtype: Origin
+        """
+        origin = self.origins.get(url)
+        if origin is None:
+            origin = super().origin(url)
+            origin.http1 = False
+            if origin.tls:
+                origin.ssl_context.set_alpn_protocols(['h2', 'http/1.1'])
+        return origin
+
+    def fall_back(self, origin):
+        """
+        Downloads from a server over HTTP/1.1 from now on, as it does not speak HTTP/2.
+
+        :param origin: The server.
+        :type origin: Origin
+        """
+        origin.http1 = True
+        if origin.tls:
+            origin.ssl_context = ssl.create_default_context()
+
+    async def session(self, origin, record):
+        """
+        Returns a connection to a server with room for another stream, opening one if
+        needed. Only one connection to a server is opened at a time, so that workers
+        starting together share the first one instead of each opening their own.
+
+        :param origin: The server.
+        :type origin: Origin
+        :param record: The metrics of the request, which get the connection times if a
+            connection is opened.
+        :type record: SegmentMetrics
+        :return: An HTTP/2 connection; or, if the server turned out not to speak HTTP/2,
+            the reader and writer of the HTTP/1.1 connection ALPN settled on, or None.
+        :rtype: Http2Connection or tuple or None
+        """
+        while True:
+            sessions = [session for session in self.sessions.get(origin.url, ()) if not session.closed]
+            self.sessions[origin.url] = sessions
+            free = [session for session in sessions if session.has_capacity()]
+            if free:
+                return min(free, key=lambda session: len(session.streams))
+            if origin.http1:
+                return None
+            if origin.url not in self.opening and len(sessions) < H2_MAX_CONNECTIONS:
+                self.opening.add(origin.url)
+                try:
+                    return await self.open_session(origin, record)
+                finally:
+                    self.opening.discard(origin.url)
+            await asyncio.sleep(SLOT_POLL_INTERVAL)
+
+    async def open_session(self, origin, record):
+        """
+        Opens a connection to a server and starts HTTP/2 on it, see session.
+
+        The engine falls back at once from a plain HTTP server that answers the preface
+        with an HTTP/1.1 response or closes the connection. One that says nothing is given
+        H2C_PROBE_TIMEOUT seconds, since an HTTP/2 server sends its SETTINGS right away.
+
+        :param origin: The server.
+        :type origin: Origin
+        :param record: The metrics of the request the connection is opened for.
+        :type record: SegmentMetrics
+        :rtype: Http2Connection or tuple or None
+        """
+        reader, writer = await self.connect(origin, record)
+        if origin.tls:
+            ssl_object = writer.get_extra_info('ssl_object')
+            if ssl_object is None or ssl_object.selected_alpn_protocol() != 'h2':
+                self.fall_back(origin)
+                return reader, writer
+        session = Http2Connection(reader, writer, origin)
+        timeout = self.mirrors.timeout if origin.tls else min(self.mirrors.timeout, H2C_PROBE_TIMEOUT)
+        try:
+            started = await session.start(timeout)
+        except asyncio.TimeoutError:
+            if origin.tls:
+                writer.close()
+                raise
+            started = False  # A plain HTTP/1.1 server waiting for more of a request.
+        except BaseException:
+            writer.close()
+            raise
+        if not started:
+            writer.close()
+            self.fall_back(origin)
+            return None
+        self.sessions.setdefault(origin.url, []).append(session)
+        return session
+
+    def close(self, connection):
+        """
+        Closes a worker's HTTP/1.1 connection if there is one. HTTP/2 connections are
+        shared and closed by the engine.
+
+        :param connection: The reader and writer of the connection, or None.
+        :type connection: tuple
+        """
+        if isinstance(connection, tuple):
+            super().close(connection)
+
+    async def download_segment(self, connection, segment, origin, record):
+        """
+        Downloads a single segment on a stream of an HTTP/2 connection, or with
+        AsyncRangeEngine.download_segment over HTTP/1.1 if the server does not speak
+        HTTP/2.
+
+        The stream is reset if the worker stops before its end, because another worker
+        has stolen part of the segment or the download is paused or cancelled, and the
+        stall watchdog resets it the same way instead of cutting off the connection the
+        other streams are using.
+
+        :param connection: The HTTP/1.1 connection left open by the previous segment, or
+            None.
+        :type connection: tuple
+        :param segment: The segment to download.
+        :type segment: Segment
+        :param origin: The mirror to download it from.
+        :type origin: Origin
+        :param record: The metrics of the request.
+        :type record: SegmentMetrics
+        :return: The HTTP/1.1 connection if it can be reused for the next segment, or None.
+        :rtype: tuple
+        """
+        if connection is None and not origin.http1:
+            connection = await self.session(origin, record)
+        if not isinstance(connection, Http2Connection):
+            return await super().download_segment(connection, segment, origin, record)
+        session = connection
+        timeout = self.mirrors.timeout
+        started = time.monotonic()
+        stream_id, queue = session.open_stream(segment)
+        try:
+            item = await asyncio.wait_for(queue.get(), timeout)
+            if item[0] == 'error':
+                raise item[1]
+            if item[0] != 'head':
+                raise ConnectionError("The server ended the stream without a response.")
+            status = int(item[1][':status'])
+            record.responded(status, time.monotonic() - started)
+            if self.tuner is not None:
+                if status in THROTTLE_STATUS_CODES:
+                    self.tuner.note_throttled()
+                    record.waited(THROTTLE_BACKOFF)
+                    await asyncio.sleep(THROTTLE_BACKOFF)
+                    return None
+                self.tuner.note_latency(time.monotonic() - started)
+            if status not in (200, 206):
+                raise StatusError(status, f"{status} Error for url: {origin.url}")
+            check_range(status, item[1], segment, self.writer.output.size)
+            record.watch(lambda: self.abort_stream(session, stream_id))
+            await self.write_body(segment, self.read_stream(session, stream_id, queue, timeout, record), record)
+        finally:
+            session.reset(stream_id)
+        return None
+
+    def abort_stream(self, session, stream_id):
+        """
+        Resets a stream from any thread, which makes the read waiting on it fail.
+
+        :param session: The connection the stream is on.
+        :type session: Http2Connection
+        :param stream_id: The stream.
+        :type stream_id: int
+        """
+        try:
+            self.loop.call_soon_threadsafe(session.reset, stream_id, ConnectionError("The stream was aborted."))
+        except RuntimeError:
+            pass  # The loop has already finished.
+
+    async def read_stream(self, session, stream_id, queue, timeout, record):
+        """
+        Yields the body of a response as it arrives on its stream, handing the window
+        space of every chunk back to the server as it is taken.
+
+        :param session: The connection the stream is on.
+        :type session: Http2Connection
+        :param stream_id: The stream.
+        :type stream_id: int
+        :param queue: The queue the events of the stream are put into.
+        :type queue: asyncio.Queue
+        :param timeout: The number of seconds to wait for each chunk.
+        :type timeout: float
+        :param record: The metrics of the request.
+        :type record: SegmentMetrics
+        """
+        while True:
+            started = time.monotonic()
+            item = await asyncio.wait_for(queue.get(), timeout)
+            if item[0] == 'error':
+                raise item[1]
+            if item[0] == 'end':
+                return
+            session.acknowledge(stream_id, item[2])
+            record.read(len(item[1]), time.monotonic() - started)
+            yield item[1]
@@ -0,0 +1,312 @@
+import hashlib
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+HASH_BLOCK_SIZE = 4 * 1024 * 1024
+HASH_POLL_INTERVAL = 0.05
+HASH_WORKERS = 4
+CHUNK_RETRIES = 3
+DIGEST_LENGTHS = {32: 'md5', 40: 'sha1', 64: 'sha256', 128: 'sha512'}
+
+
+def parse_digest(text):
+    """
+    Parses an expected digest of a whole file.
+
+    :param text: The digest as "algorithm:hex", e.g. "sha256:9f86d0...", or just the hex
+        digits, in which case the algorithm is guessed from their number: 32 for MD5, 40
+        for SHA-1, 64 for SHA-256 and 128 for SHA-512.
+    :type text: str
+    :return: The name of the hashlib algorithm and the lower-cased hex digest.
+    :rtype: tuple
+    :raises: ValueError if the algorithm is unknown or the digest has the wrong length.
+    """
+    algorithm, _, digest = text.strip().rpartition(':')
+    digest = digest.lower()
+    algorithm = algorithm.lower().replace('-', '') or DIGEST_LENGTHS.get(len(digest))
+    if algorithm is None:
+        raise ValueError(f"Cannot tell the algorithm of the digest {text!r}, write it as algorithm:hex.")
+    try:
+        expected_length = hashlib.new(algorithm).digest_size * 2
+    except ValueError:
+        raise ValueError(f"Unknown hash algorithm {algorithm!r}.")
+    if len(digest) != expected_length or any(c not in '0123456789abcdef' for c in digest):
+        raise ValueError(f"Invalid {algorithm} digest {digest!r}.")
+    return algorithm, digest
+
+
+class ChunkHashList:
+    """
+    The expected digests of the consecutive fixed-size chunks of a file.
+
+    The last chunk may be shorter than chunk_size.
+    """
+
+    def __init__(self, algorithm, chunk_size, digests):
+        """
+        Initializes a ChunkHashList instance.
+
+        :param algorithm: The name of the hashlib algorithm the digests were made with.
+        :type algorithm: str
+        :param chunk_size: The size of every chunk but the last, in bytes.
+        :type chunk_size: int
+        :param digests: The hex digest of every chunk, in order.
+        :type digests: list
+        """
+        hashlib.new(algorithm)  # Raises ValueError for an unknown algorithm.
+        if chunk_size < 1:
+            raise ValueError("The chunk size must be at least 1 byte.")
+        self.algorithm = algorithm
+        self.chunk_size = chunk_size
+        self.digests = [digest.lower() for digest in digests]
+
+    @classmethod
+    def load(cls, path):
+        """
+        Reads a chunk hash list from a JSON file of the form
+        {"algorithm": "sha256", "chunk_size": 1048576, "digests": ["...", ...]}.
+
+        :param path: The path of the file.
+        :type path: str
+        :rtype: ChunkHashList
+        :raises: ValueError if the file is not a valid chunk hash list.
+        """
+        with open(path, 'r') as f:
+            data = json.load(f)
+        try:
+            return cls(data['algorithm'], int(data['chunk_size']), data['digests'])
+        except (KeyError, TypeError) as e:
+            raise ValueError(f"Invalid chunk hash list {path!r}: {e}")
+
+    def check_size(self, total_size):
+        """
+        Checks that the list covers a file of the given size exactly.
+
+        :param total_size: The size of the file in bytes.
+        :type total_size: int
+        :raises: ValueError if the number of digests does not match.
+        """
+        expected = -(-total_size // self.chunk_size)
+        if len(self.digests) != expected:
+            raise ValueError(f"The chunk hash list has {len(self.digests)} digests, "
+                             f"but a file of {total_size} bytes has {expected} chunks.")
+
+
+class PrefixHasher(threading.Thread):
+    """
+    Hashes a file while it is being downloaded, in order, as far as it is complete.
+
+    The workers write the file out of order, so the thread follows the contiguous prefix
+    of the file recorded in the journal and reads each newly completed part back while
+    it is still in the page cache, instead of reading the whole file from disk after the
+    download. The workers never wait for it.
+    """
+
+    def __init__(self, algorithm, output, journal):
+        """
+        Initializes a PrefixHasher instance.
+
+        :param algorithm: The name of the hashlib algorithm.
+        :type algorithm: str
+        :param output: The file being downloaded into.
+        :type output: OutputFile
+        :param journal: The journal whose contiguous prefix is safe to hash.
+        :type journal: ResumeJournal
+        """
+        super().__init__(daemon=True)
+        self.hash = hashlib.new(algorithm)
+        self.output = output
+        self.journal = journal
+        self.position = 0
+        self.error = None
+        self.cancelled = False
+        self.stopping = threading.Event()
+
+    def run(self):
+        """
+        Hashes the prefix as it grows until finish is called, then hashes the rest of
+        the file.
+        """
+        try:
+            while True:
+                stopping = self.stopping.is_set()
+                end = self.output.size if stopping else self.journal.prefix()
+                while self.position < end and not self.cancelled:
+                    data = self.output.read_at(self.position, min(HASH_BLOCK_SIZE, end - self.position))
+                    if not data:
+                        raise OSError("The output file is shorter than expected.")
+                    self.hash.update(data)
+                    self.position += len(data)
+                if stopping or self.cancelled:
+                    return
+                self.stopping.wait(HASH_POLL_INTERVAL)
+        except Exception as e:
+            self.error = e
+
+    def finish(self):
+        """
+        Hashes what is left of the file once every byte has been written.
+
+        :return: The hex digest of the whole file.
+        :rtype: str
+        :raises: The error the thread ran into, if any.
+        """
+        self.stopping.set()
+        self.join()
+        if self.error is not None:
+            raise self.error
+        return self.hash.hexdigest()
+
+    def stop(self):
+        """Stops the thread without hashing the rest of the file and waits for it."""
+        self.cancelled = True
+        self.stopping.set()
+        self.join()
+
+
+class ChunkVerifier:
+    """
+    Checks every chunk of a ChunkHashList as soon as all of its bytes have been written.
+
+    Bytes are counted off per chunk as the workers write them. A complete chunk is read
+    back and hashed on a small thread pool, so verifying never holds up the workers;
+    hashlib releases the GIL while hashing. Only verified chunks are recorded in the
+    journal. A chunk that does not match is handed back to the scheduler and downloaded
+    again on its own, up to CHUNK_RETRIES times.
+    """
+
+    def __init__(self, hashes, scheduler, output, journal, missing, on_error=None):
+        """
+        Initializes a ChunkVerifier instance.
+
+        :param hashes: The expected digests of the chunks.
+        :type hashes: ChunkHashList
+        :param scheduler: The scheduler to hand failed chunks back to.
+        :type scheduler: SegmentScheduler
+        :param output: The file being downloaded into.
+        :type output: OutputFile
+        :param journal: The journal to record verified chunks in.
+        :type journal: ResumeJournal
+        :param missing: The (start, end) ranges still to be downloaded. Chunks outside
+            them were verified by an earlier attempt.
+        :type missing: list
+        :param on_error: Called with the error message if a chunk keeps failing.
+        :type on_error: callable
+        """
+        self.hashes = hashes
+        self.chunk_size = hashes.chunk_size
+        self.scheduler = scheduler
+        self.output = output
+        self.journal = journal
+        self.on_error = on_error
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.remaining = {}
+        self.failures = {}
+        self.pending = 0
+        self.discarded = 0
+        self.executor = ThreadPoolExecutor(HASH_WORKERS, thread_name_prefix='verify')
+        for start, end in missing:
+            self.count(start, end - start + 1, 1)
+
+    def chunk_range(self, index):
+        """
+        Returns the byte range of a chunk.
+
+        :param index: The number of the chunk.
+        :type index: int
+        :return: The first and last byte of the chunk.
+        :rtype: tuple
+        """
+        start = index * self.chunk_size
+        return start, min(start + self.chunk_size, self.output.size) - 1
+
+    def count(self, offset, length, sign):
+        """
+        Adds or subtracts the bytes of a range from the chunks they fall in. Must be
+        called with the lock held, except from __init__.
+
+        :param offset: The first byte of the range.
+        :type offset: int
+        :param length: The number of bytes.
+        :type length: int
+        :param sign: 1 to count the bytes as missing, -1 to count them as written.
+        :type sign: int
+        :return: The chunks that have no missing bytes left.
+        :rtype: list
+        """
+        complete = []
+        end = offset + length
+        for index in range(offset // self.chunk_size, (end - 1) // self.chunk_size + 1):
+            chunk_start, chunk_end = self.chunk_range(index)
+            overlap = min(end, chunk_end + 1) - max(offset, chunk_start)
+            left = self.remaining.get(index, 0) + sign * overlap
+            if left > 0:
+                self.remaining[index] = left
+            else:
+                self.remaining.pop(index, None)
+                complete.append(index)
+        return complete
+
+    def written(self, offset, length):
+        """
+        Counts bytes written by a worker and queues the chunks they complete for checking.
+
+        :param offset: The offset the bytes were written at.
+        :type offset: int
+        :param length: The number of bytes.
+        :type length: int
+        """
+        with self.lock:
+            complete = self.count(offset, length, -1)
+            self.pending += len(complete)
+        for index in complete:
+            self.executor.submit(self.verify, index)
+
+    def verify(self, index):
+        """
+        Reads a complete chunk back, checks its digest, and records it in the journal or
+        hands it back to the scheduler.
+
+        :param index: The number of the chunk.
+        :type index: int
+        """
+        start, end = self.chunk_range(index)
+        try:
+            digest = hashlib.new(self.hashes.algorithm)
+            position = start
+            while position <= end:
+                data = self.output.read_at(position, min(HASH_BLOCK_SIZE, end - position + 1))
+                if not data:
+                    raise OSError("The output file is shorter than expected.")
+                digest.update(data)
+                position += len(data)
+            if digest.hexdigest() == self.hashes.digests[index]:
+                self.journal.record(start, end)
+            else:
+                with self.lock:
+                    failures = self.failures[index] = self.failures.get(index, 0) + 1
+                    if failures <= CHUNK_RETRIES:
+                        self.count(start, end - start + 1, 1)
+                        self.discarded += end - start + 1
+                if failures > CHUNK_RETRIES:
+                    raise ValueError(f"Chunk {index} (bytes {start}-{end}) failed verification "
+                                     f"{failures} times.")
+                self.scheduler.add(start, end)
+        except Exception as e:
+            if self.on_error is not None:
+                self.on_error(str(e))
+        finally:
+            with self.lock:
+                self.pending -= 1
+                self.idle.notify_all()
+
+    def drain(self):
+        """Waits until every complete chunk has been checked."""
+        with self.lock:
+            self.idle.wait_for(lambda: self.pending == 0)
+
+    def close(self):
+        """Stops the thread pool once the queued checks are done."""
+        self.executor.shutdown(wait=True)
@@ -1,4 +1,7 @@
 if __name__ == "__main__":
     import sys
+    if '--headless' in sys.argv[1:]:
+        from cli import main
+        sys.exit(main([arg for arg in sys.argv[1:] if arg != '--headless']))
     from gui import main
     sys.exit(main())
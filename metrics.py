@@ -0,0 +1,520 @@
+import json
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SAMPLE_INTERVAL = 1.0
+STALL_TIME = 5.0
+HISTORY_SIZE = 1000
+PHASES = ('dns', 'connect', 'tls', 'ttfb')
+
+
+class SegmentMetrics:
+    """
+    What happened during one attempt at downloading a segment: one request to a mirror.
+
+    Latencies are in seconds. dns, connect and tls are None when the request went over a
+    connection that was already open. ttfb is the time from sending the request to
+    receiving the response headers. A read that waited STALL_TIME seconds or longer for
+    data counts as a stall.
+
+    Once the response has arrived, the worker hands the record a way to abort the
+    request with watch, so the stall watchdog of the DownloadManager can cut off a
+    connection that stays open but stops sending data.
+    """
+
+    def __init__(self, worker, url, start, end, retry=False):
+        """
+        Initializes a SegmentMetrics instance.
+
+        :param worker: The number of the worker making the request.
+        :type worker: int
+        :param url: The URL of the mirror.
+        :type url: str
+        :param start: The first byte requested.
+        :type start: int
+        :param end: The last byte requested.
+        :type end: int
+        :param retry: Whether an earlier attempt at this range failed.
+        :type retry: bool
+        """
+        self.worker = worker
+        self.url = url
+        self.start = start
+        self.end = end
+        self.retry = retry
+        self.time = time.time()
+        self.started = time.monotonic()
+        self.finished = None
+        self.dns = None
+        self.connect = None
+        self.tls = None
+        self.ttfb = None
+        self.status = None
+        self.bytes = 0
+        self.read_seconds = 0.0
+        self.write_seconds = 0.0
+        self.wait_seconds = 0.0
+        self.stalls = 0
+        self.stall_seconds = 0.0
+        self.samples = []
+        self.last_sample = self.started
+        self.outcome = None
+        self.error = None
+        self.abort = None
+        self.last_data = self.started
+        self.stalled = False
+
+    def connected(self, dns, connect, tls):
+        """
+        Records how long opening a new connection took.
+
+        :param dns: The seconds spent resolving the host name.
+        :type dns: float
+        :param connect: The seconds spent on the TCP handshake.
+        :type connect: float
+        :param tls: The seconds spent on the TLS handshake, or None for plain HTTP.
+        :type tls: float
+        """
+        self.dns = dns
+        self.connect = connect
+        self.tls = tls
+
+    def responded(self, status, ttfb):
+        """
+        Records the response headers arriving.
+
+        :param status: The HTTP status code.
+        :type status: int
+        :param ttfb: The seconds from sending the request to receiving the headers.
+        :type ttfb: float
+        """
+        self.status = status
+        self.ttfb = ttfb
+
+    def read(self, length, seconds):
+        """
+        Records a read from the connection, and every SAMPLE_INTERVAL seconds a sample of
+        the bytes received so far.
+
+        :param length: The number of bytes read.
+        :type length: int
+        :param seconds: How long the read waited.
+        :type seconds: float
+        """
+        self.bytes += length
+        self.read_seconds += seconds
+        if seconds >= STALL_TIME:
+            self.stalls += 1
+            self.stall_seconds += seconds
+        now = time.monotonic()
+        if length:
+            self.last_data = now
+        if now - self.last_sample >= SAMPLE_INTERVAL:
+            self.samples.append((round(now - self.started, 3), self.bytes))
+            self.last_sample = now
+
+    def wrote(self, seconds):
+        """
+        Records the time spent writing received bytes to the output file.
+
+        :param seconds: How long the write took.
+        :type seconds: float
+        """
+        self.write_seconds += seconds
+
+    def waited(self, seconds):
+        """
+        Records the time spent waiting for a rate limiter or a throttling server.
+
+        :param seconds: How long the worker waited.
+        :type seconds: float
+        """
+        self.wait_seconds += seconds
+        self.last_data = max(self.last_data, time.monotonic() + seconds)
+
+    def watch(self, abort):
+        """
+        Lets the stall watchdog abort the request from now on.
+
+        :param abort: Called from the watchdog's thread to cut the connection off, which
+            makes the worker's next read fail.
+        :type abort: callable
+        """
+        self.last_data = time.monotonic()
+        self.abort = abort
+
+    def abort_stalled(self):
+        """Marks the request as stalled and aborts it."""
+        self.stalled = True
+        self.abort()
+
+    @property
+    def seconds(self):
+        """The duration of the attempt so far, or in total once it is over."""
+        return (self.finished or time.monotonic()) - self.started
+
+    def as_dict(self):
+        """
+        Returns the metrics as a dict that can be serialized to JSON.
+
+        :rtype: dict
+        """
+        seconds = self.seconds
+        return {
+            'worker': self.worker, 'url': self.url, 'start': self.start, 'end': self.end,
+            'retry': self.retry, 'time': self.time, 'seconds': seconds, 'dns': self.dns,
+            'connect': self.connect, 'tls': self.tls, 'ttfb': self.ttfb, 'status': self.status,
+            'bytes': self.bytes, 'speed': self.bytes / seconds if seconds > 0 else 0.0,
+            'read_seconds': self.read_seconds, 'write_seconds': self.write_seconds,
+            'wait_seconds': self.wait_seconds, 'stalls': self.stalls, 'stall_seconds': self.stall_seconds,
+            'samples': self.samples, 'outcome': self.outcome, 'error': self.error,
+        }
+
+
+class TraceWriter:
+    """
+    Writes the metrics of downloads to a file as JSON lines, one object per event.
+
+    Can be shared by several downloads; every line is written whole and flushed.
+    """
+
+    def __init__(self, path):
+        """
+        Initializes a TraceWriter instance and opens the file for appending.
+
+        :param path: The path of the trace file.
+        :type path: str
+        """
+        self.file = open(path, 'a')
+        self.lock = threading.Lock()
+
+    def write(self, event, record):
+        """
+        Writes an event to the trace.
+
+        :param event: The name of the event: 'download_started', 'segment' or
+            'download_finished'.
+        :type event: str
+        :param record: The data of the event.
+        :type record: dict
+        """
+        line = json.dumps({'event': event, **record})
+        with self.lock:
+            if not self.file.closed:
+                self.file.write(line + '\n')
+                self.file.flush()
+
+    def close(self):
+        """Closes the trace file."""
+        with self.lock:
+            self.file.close()
+
+
+class DownloadMetrics:
+    """
+    Collects the SegmentMetrics of every request of a download and adds them up.
+
+    The workers start a record per request with segment and hand it back with finish.
+    The most recent HISTORY_SIZE records are kept for stats; all of them go to the
+    trace, if there is one.
+    """
+
+    def __init__(self, url=None, save_path=None, trace=None):
+        """
+        Initializes a DownloadMetrics instance.
+
+        :param url: The URL of the download.
+        :type url: str
+        :param save_path: The path the file is saved to.
+        :type save_path: str
+        :param trace: The trace to write every finished request to.
+        :type trace: TraceWriter
+        """
+        self.url = url
+        self.save_path = save_path
+        self.trace = trace
+        self.lock = threading.Lock()
+        self.active = set()
+        self.history = deque(maxlen=HISTORY_SIZE)
+        self.failed_at = set()
+        self.started = None
+        self.finished = None
+        self.engine = None
+        self.total_size = 0
+        self.error = None
+        self.totals = dict.fromkeys(('bytes', 'requests', 'retries', 'failed', 'throttled', 'stalls',
+                                     'aborted', 'connections'), 0)
+        self.totals.update(dict.fromkeys(('read_seconds', 'write_seconds', 'wait_seconds', 'stall_seconds'), 0.0))
+        self.latency = {phase: {'count': 0, 'sum': 0.0, 'max': 0.0} for phase in PHASES}
+
+    def start(self, total_size, engine, connections):
+        """
+        Records the start of the download.
+
+        :param total_size: The size of the file in bytes.
+        :type total_size: int
+        :param engine: The engine downloading it.
+        :type engine: str
+        :param connections: The number of connections, or AUTO.
+        :type connections: int or str
+        """
+        self.started = time.monotonic()
+        self.total_size = total_size
+        self.engine = engine
+        if self.trace is not None:
+            self.trace.write('download_started', {'time': time.time(), 'url': self.url, 'save_path': self.save_path,
+                                                  'size': total_size, 'engine': engine, 'connections': connections})
+
+    def segment(self, worker, url, start, end):
+        """
+        Starts the record of a request.
+
+        :param worker: The number of the worker making the request.
+        :type worker: int
+        :param url: The URL of the mirror.
+        :type url: str
+        :param start: The first byte requested.
+        :type start: int
+        :param end: The last byte requested.
+        :type end: int
+        :rtype: SegmentMetrics
+        """
+        with self.lock:
+            retry = start in self.failed_at
+            self.failed_at.discard(start)
+            record = SegmentMetrics(worker, url, start, end, retry)
+            self.active.add(record)
+        return record
+
+    def finish(self, record, outcome, error=None, position=None):
+        """
+        Ends the record of a request and adds it to the totals.
+
+        :param record: The record returned by segment.
+        :type record: SegmentMetrics
+        :param outcome: How the request ended: 'done', 'retired', 'paused', 'cancelled',
+            'throttled', 'stalled' if the watchdog aborted it, or 'failed'.
+        :type outcome: str
+        :param error: The error message if it failed.
+        :type error: str
+        :param position: The first byte not downloaded yet, which the next attempt at the
+            range starts from if this one was throttled or failed.
+        :type position: int
+        """
+        record.finished = time.monotonic()
+        record.abort = None
+        record.outcome = outcome
+        record.error = error
+        totals = self.totals
+        with self.lock:
+            self.active.discard(record)
+            self.history.append(record)
+            if outcome in ('throttled', 'stalled', 'failed') and position is not None:
+                self.failed_at.add(position)
+            totals['requests'] += 1
+            totals['retries'] += record.retry
+            totals['failed'] += outcome in ('stalled', 'failed')
+            totals['aborted'] += outcome == 'stalled'
+            totals['throttled'] += outcome == 'throttled'
+            totals['connections'] += record.connect is not None
+            for key in ('bytes', 'stalls', 'read_seconds', 'write_seconds', 'wait_seconds', 'stall_seconds'):
+                totals[key] += getattr(record, key)
+            for phase in PHASES:
+                value = getattr(record, phase)
+                if value is not None:
+                    latency = self.latency[phase]
+                    latency['count'] += 1
+                    latency['sum'] += value
+                    latency['max'] = max(latency['max'], value)
+        if self.trace is not None:
+            self.trace.write('segment', {'download': self.url, **record.as_dict()})
+
+    def stalled(self, timeout):
+        """
+        Returns the requests that can be aborted and have received no data for a while.
+
+        :param timeout: The number of seconds without data.
+        :type timeout: float
+        :rtype: list
+        """
+        now = time.monotonic()
+        with self.lock:
+            return [record for record in self.active
+                    if record.abort is not None and not record.stalled and now - record.last_data >= timeout]
+
+    def fail(self, error):
+        """
+        Records the error the download failed with. Only the first error is kept, since
+        the others usually follow from it.
+
+        :param error: The error message.
+        :type error: str
+        """
+        with self.lock:
+            if self.error is None:
+                self.error = error
+
+    def done(self, error=None):
+        """
+        Records the end of the download.
+
+        :param error: The error message if it failed, unless it was recorded with fail.
+        :type error: str
+        """
+        if error is not None:
+            self.fail(error)
+        self.finished = time.monotonic()
+        if self.trace is not None:
+            stats = self.stats()
+            del stats['active'], stats['segments']
+            self.trace.write('download_finished', {'time': time.time(), **stats})
+
+    def stats(self):
+        """
+        Returns a snapshot of the metrics of the download.
+
+        :return: The totals over all requests, the count, sum and maximum of every
+            latency phase, the error the download failed with if any, and the records of
+            the active and recent requests as dicts under active and segments.
+        :rtype: dict
+        """
+        with self.lock:
+            totals = dict(self.totals)
+            latency = {phase: dict(values) for phase, values in self.latency.items()}
+            active = [record.as_dict() for record in self.active]
+            segments = [record.as_dict() for record in self.history]
+        elapsed = 0.0
+        if self.started is not None:
+            elapsed = (self.finished or time.monotonic()) - self.started
+        return {'url': self.url, 'save_path': self.save_path, 'engine': self.engine,
+                'total_size': self.total_size, 'elapsed': elapsed, 'error': self.error,
+                'speed': totals['bytes'] / elapsed if elapsed > 0 else 0.0,
+                **totals, 'latency': latency, 'active': active, 'segments': segments}
+
+
+def escape_label(value):
+    """
+    Escapes a label value for the Prometheus text format.
+
+    :param value: The value.
+    :type value: str
+    :rtype: str
+    """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def series_labels(stats):
+    """
+    Returns the labels that tell the series of a download apart: its URL and the path it
+    is saved to, since the same URL may be downloaded to several files at once.
+
+    :param stats: The stats of the download.
+    :type stats: dict
+    :return: The labels in the Prometheus text format, without the braces.
+    :rtype: str
+    """
+    return f'url="{escape_label(stats["url"])}",path="{escape_label(stats["save_path"])}"'
+
+
+def prometheus_text(stats_list):
+    """
+    Formats the stats of downloads in the Prometheus text exposition format, labelled
+    with series_labels.
+
+    :param stats_list: The stats of every download, as returned by DownloadMetrics.stats
+        or DownloadManager.stats.
+    :type stats_list: list
+    :rtype: str
+    """
+    metrics = [
+        ('bytes_total', 'counter', "Bytes received.", 'bytes'),
+        ('downloaded_bytes', 'gauge', "Bytes of the file downloaded, including resumed ones.", 'downloaded'),
+        ('size_bytes', 'gauge', "Size of the file.", 'total_size'),
+        ('requests_total', 'counter', "Range requests made.", 'requests'),
+        ('retries_total', 'counter', "Requests retrying a range an earlier request failed on.", 'retries'),
+        ('failed_requests_total', 'counter', "Requests that failed.", 'failed'),
+        ('throttled_requests_total', 'counter', "Requests the server throttled.", 'throttled'),
+        ('connections_total', 'counter', "Connections opened.", 'connections'),
+        ('stalls_total', 'counter', "Reads that waited too long for data.", 'stalls'),
+        ('aborted_requests_total', 'counter', "Requests aborted for receiving no data.", 'aborted'),
+        ('stall_seconds_total', 'counter', "Seconds spent in stalled reads.", 'stall_seconds'),
+        ('read_seconds_total', 'counter', "Seconds spent reading from the network.", 'read_seconds'),
+        ('write_seconds_total', 'counter', "Seconds spent writing to disk.", 'write_seconds'),
+        ('wait_seconds_total', 'counter', "Seconds spent waiting for rate limits and backoff.", 'wait_seconds'),
+    ]
+    lines = []
+    for name, kind, help_text, key in metrics:
+        lines.append(f"# HELP quickdownloader_{name} {help_text}")
+        lines.append(f"# TYPE quickdownloader_{name} {kind}")
+        for stats in stats_list:
+            if key in stats:
+                lines.append(f"quickdownloader_{name}{{{series_labels(stats)}}} {stats[key]}")
+    lines.append("# HELP quickdownloader_active_requests Range requests in progress.")
+    lines.append("# TYPE quickdownloader_active_requests gauge")
+    for stats in stats_list:
+        lines.append(f"quickdownloader_active_requests{{{series_labels(stats)}}} {len(stats['active'])}")
+    lines.append("# HELP quickdownloader_latency_seconds Latency of the phases of a request.")
+    lines.append("# TYPE quickdownloader_latency_seconds summary")
+    for stats in stats_list:
+        for phase, values in stats['latency'].items():
+            labels = f'{series_labels(stats)},phase="{phase}"'
+            lines.append(f"quickdownloader_latency_seconds_sum{{{labels}}} {values['sum']}")
+            lines.append(f"quickdownloader_latency_seconds_count{{{labels}}} {values['count']}")
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    """Serves /metrics in the Prometheus text format and /stats as JSON."""
+
+    def log_message(self, format, *args):
+        """Keeps the output of the downloader free of request logs."""
+
+    def do_GET(self):
+        """Answers a GET request for /metrics or /stats."""
+        path = self.path.split('?', 1)[0]
+        if path == '/metrics':
+            body = prometheus_text(self.server.source()).encode('utf-8')
+            content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        elif path == '/stats':
+            body = json.dumps(self.server.source()).encode('utf-8')
+            content_type = 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class MetricsServer(ThreadingHTTPServer):
+    """
+    An HTTP endpoint for scraping the metrics of a long-running process, served from a
+    daemon thread.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, port, source, host='127.0.0.1'):
+        """
+        Initializes a MetricsServer instance and starts serving.
+
+        :param port: The port to listen on; 0 picks a free one.
+        :type port: int
+        :param source: Called for every request; returns the stats of every download as
+            a list of dicts.
+        :type source: callable
+        :param host: The address to listen on. Defaults to localhost only.
+        :type host: str
+        """
+        super().__init__((host, port), MetricsRequestHandler)
+        self.source = source
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def close(self):
+        """Stops serving and closes the socket."""
+        self.shutdown()
+        self.server_close()
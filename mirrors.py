@@ -0,0 +1,176 @@
+import threading
+
+SPEED_SMOOTHING = 0.3
+MIRROR_TIMEOUT = 15
+MIRROR_MAX_FAILURES = 3
+TIMEOUT = 120
+
+
+class Mirror:
+    """A URL the file can be downloaded from, and how fast it has been so far."""
+
+    def __init__(self, url):
+        """
+        Initializes a Mirror instance.
+
+        :param url: The URL of the file on this mirror.
+        :type url: str
+        """
+        self.url = url
+        self.speed = None
+        self.active = 0
+        self.downloaded = 0
+        self.failures = 0
+        self.dropped = False
+
+
+class MirrorSet:
+    """
+    The mirrors a file is downloaded from, shared by all workers of a download.
+
+    Every segment goes to the mirror with the highest expected speed for one more
+    connection: its measured speed per connection, divided among the connections it
+    would then have. Faster mirrors therefore end up serving a share of the file in
+    proportion to their speed. Mirrors whose speed is not known yet are tried as if they
+    were as fast as the fastest one.
+
+    A mirror that fails MIRROR_MAX_FAILURES times in a row, or in a way retrying cannot
+    fix, is dropped and the workers move on to the others. The last mirror is never
+    dropped; what happens when it fails is up to the ErrorBudget of the download.
+    """
+
+    def __init__(self, urls, on_drop=None):
+        """
+        Initializes a MirrorSet instance.
+
+        :param urls: The URLs of the file, the primary one first.
+        :type urls: list
+        :param on_drop: Called with the URL and the reason when a mirror is dropped.
+        :type on_drop: callable
+        """
+        self.mirrors = [Mirror(url) for url in urls]
+        self.on_drop = on_drop
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        """The number of mirrors that have not been dropped."""
+        return len(self.live())
+
+    def live(self):
+        """
+        Returns the mirrors that have not been dropped.
+
+        :rtype: list
+        """
+        return [mirror for mirror in self.mirrors if not mirror.dropped]
+
+    def expected_speed(self, mirror):
+        """
+        Returns the speed per connection to expect from a mirror.
+
+        :param mirror: The mirror.
+        :type mirror: Mirror
+        :return: The measured speed in bytes per second, or for a mirror not measured yet
+            the speed of the fastest one, or 1.0 if none has been measured.
+        :rtype: float
+        """
+        if mirror.speed:
+            return mirror.speed
+        return max((m.speed for m in self.mirrors if m.speed), default=1.0)
+
+    def segment_speed(self, segment):
+        """
+        Returns the speed to expect for a segment being downloaded, for SegmentScheduler.
+
+        :param segment: A segment with the mirror it is downloaded from in its mirror
+            attribute, if any.
+        :type segment: Segment
+        :rtype: float
+        """
+        mirror = getattr(segment, 'mirror', None)
+        return self.expected_speed(mirror) if mirror is not None else 1.0
+
+    def pick(self, url=None):
+        """
+        Picks the mirror to download the next segment from and counts the connection.
+
+        :param url: The URL of the mirror to take if it has not been dropped, for a
+            request that has already been made. Defaults to the fastest one.
+        :type url: str
+        :return: The mirror; give it back with put_back afterwards.
+        :rtype: Mirror
+        """
+        with self.lock:
+            live = self.live()
+            chosen = [mirror for mirror in live if mirror.url == url]
+            mirror = chosen[0] if chosen else max(live, key=lambda m: self.expected_speed(m) / (m.active + 1))
+            mirror.active += 1
+            return mirror
+
+    def put_back(self, mirror, length=0, seconds=0.0):
+        """
+        Ends a connection to a mirror and updates its speed.
+
+        :param mirror: The mirror returned by pick.
+        :type mirror: Mirror
+        :param length: The number of bytes downloaded from it.
+        :type length: int
+        :param seconds: How long the download took.
+        :type seconds: float
+        """
+        with self.lock:
+            mirror.active -= 1
+            mirror.downloaded += length
+            if length:
+                mirror.failures = 0
+            if length and seconds > 0:
+                speed = length / seconds
+                mirror.speed = speed if mirror.speed is None \
+                    else mirror.speed + SPEED_SMOOTHING * (speed - mirror.speed)
+
+    def drop(self, mirror, reason):
+        """
+        Stops using a mirror that failed, unless it is the last one left.
+
+        :param mirror: The mirror that failed.
+        :type mirror: Mirror
+        :param reason: Why it failed.
+        :type reason: str
+        :return: True if the mirror was dropped and the download can go on without it,
+            False if it is the last one and the download has failed.
+        :rtype: bool
+        """
+        with self.lock:
+            if mirror.dropped:
+                return True
+            if len(self.live()) <= 1:
+                return False
+            mirror.dropped = True
+        if self.on_drop is not None:
+            self.on_drop(mirror.url, reason)
+        return True
+
+    def failed(self, mirror, reason):
+        """
+        Counts a failed request to a mirror and drops the mirror if it has failed
+        MIRROR_MAX_FAILURES times in a row, unless it is the last one left.
+
+        :param mirror: The mirror that failed.
+        :type mirror: Mirror
+        :param reason: Why it failed.
+        :type reason: str
+        :return: True if the mirror was dropped.
+        :rtype: bool
+        """
+        with self.lock:
+            mirror.failures += 1
+            failures = mirror.failures
+        return failures >= MIRROR_MAX_FAILURES and self.drop(mirror, reason)
+
+    @property
+    def timeout(self):
+        """
+        The number of seconds to wait for a mirror before giving up on it: short while
+        there are others to fall back on, long for the last one.
+        """
+        return MIRROR_TIMEOUT if len(self) > 1 else TIMEOUT
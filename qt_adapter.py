@@ -0,0 +1,110 @@
+from PyQt6.QtCore import QThread, pyqtSignal
+from core import DownloadManager
+from download_queue import DownloadQueue
+
+
+class QtDownloadManager(QThread):
+    """
+    Runs a core DownloadManager on a QThread and re-emits its events as Qt signals.
+
+    The signals have the same names as the events of DownloadManager, so the GUI can
+    connect to them like to any other Qt signal.
+    """
+
+    progress = pyqtSignal(int)
+    progress_percent = pyqtSignal(float)
+    speed = pyqtSignal(float)
+    max_speed = pyqtSignal(float)
+    time_remaining = pyqtSignal(float)
+    part_done = pyqtSignal(int)
+    mirror_dropped = pyqtSignal(str, str)
+    finished_download = pyqtSignal()
+    error_occurred = pyqtSignal(str)
+
+    def __init__(self, *args, **kwargs):
+        """
+        Initializes a QtDownloadManager instance.
+
+        All arguments are passed on to DownloadManager.
+        """
+        super().__init__()
+        self.manager = self.create_manager(*args, **kwargs)
+        self.manager.add_listener(self.forward)
+
+    def create_manager(self, *args, **kwargs):
+        """
+        Creates the object that does the downloading.
+
+        :return: The DownloadManager to run.
+        :rtype: DownloadManager
+        """
+        return DownloadManager(*args, **kwargs)
+
+    def forward(self, event, *args):
+        """
+        Emits the signal named after a DownloadManager event.
+
+        :param event: The name of the event.
+        :type event: str
+        """
+        getattr(self, event).emit(*args)
+
+    @property
+    def total_size(self):
+        """The total size of the file being downloaded, in bytes."""
+        return self.manager.total_size
+
+    def run(self):
+        """Runs the download on this thread."""
+        self.manager.run()
+
+    def set_rate_limit(self, rate):
+        """
+        Changes the bandwidth limit of the download.
+
+        :param rate: The limit in bytes per second, or None for no limit.
+        :type rate: float
+        """
+        self.manager.set_rate_limit(rate)
+
+    def pause(self):
+        """Pauses the download."""
+        self.manager.pause()
+
+    def resume(self):
+        """Resumes the download."""
+        self.manager.resume()
+
+    def cancel(self):
+        """Cancels the download."""
+        self.manager.cancel()
+
+
+class QtDownloadQueue(QtDownloadManager):
+    """
+    Runs a DownloadQueue on a QThread and re-emits its events as Qt signals.
+
+    The queue emits no time_remaining events, and its progress counts bytes over files
+    of different sizes, so the GUI only shows its percentage and speed.
+    """
+
+    job_started = pyqtSignal(str)
+    job_finished = pyqtSignal(str, object)
+
+    def create_manager(self, urls, directory, *args, **kwargs):
+        """
+        Creates a DownloadQueue with the given URLs.
+
+        :param urls: The URLs of the files to download.
+        :type urls: list
+        :param directory: The directory to save the files to.
+        :type directory: str
+
+        The remaining arguments are passed on to DownloadQueue.
+
+        :rtype: DownloadQueue
+        """
+        queue = DownloadQueue(directory, *args, **kwargs)
+        for url in urls:
+            queue.add(url)
+        return queue
@@ -0,0 +1,149 @@
+import http.client
+import random
+import threading
+import requests
+import urllib3
+
+RETRY_BACKOFF = 0.5
+MAX_RETRY_BACKOFF = 30.0
+ERROR_BUDGET = 20
+STALL_TIMEOUT = 20.0
+STALL_CHECK_INTERVAL = 1.0
+RETRY_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+RETRYABLE_ERRORS = (ConnectionError, TimeoutError, EOFError, http.client.HTTPException,
+                    requests.RequestException, urllib3.exceptions.HTTPError)
+
+
+class DownloadCancelled(Exception):
+    """Raised in a worker waiting for a connection slot when its download is cancelled."""
+
+
+class StatusError(Exception):
+    """An HTTP response with an error status."""
+
+    def __init__(self, status, message):
+        """
+        Initializes a StatusError instance.
+
+        :param status: The HTTP status code.
+        :type status: int
+        :param message: The error message.
+        :type message: str
+        """
+        super().__init__(message)
+        self.status = status
+
+
+def is_retryable(error):
+    """
+    Tells whether a failed request may succeed when it is made again.
+
+    Connection errors, timeouts, responses cut off early and the statuses in
+    RETRY_STATUS_CODES are worth retrying. Other error statuses, such as 404, and errors
+    that have nothing to do with the network, such as a full disk, are not.
+
+    :param error: The exception the request failed with.
+    :type error: Exception
+    :rtype: bool
+    """
+    status = getattr(error, 'status', None)
+    if status is None:
+        status = getattr(getattr(error, 'response', None), 'status_code', None)
+    if status is not None:
+        return status in RETRY_STATUS_CODES
+    return isinstance(error, RETRYABLE_ERRORS)
+
+
+def backoff(failures):
+    """
+    Returns how long to wait before retrying after a number of failures in a row.
+
+    The delay doubles with every failure from RETRY_BACKOFF up to MAX_RETRY_BACKOFF, and
+    is randomized by up to half so that workers that failed together do not retry
+    together.
+
+    :param failures: The number of failures in a row, at least 1.
+    :type failures: int
+    :return: The delay in seconds.
+    :rtype: float
+    """
+    delay = min(RETRY_BACKOFF * 2 ** min(failures - 1, 16), MAX_RETRY_BACKOFF)
+    return delay * random.uniform(0.5, 1.0)
+
+
+def error_message(error, stalled=False, stall_timeout=STALL_TIMEOUT):
+    """
+    Describes why a request failed.
+
+    :param error: The exception the request failed with.
+    :type error: Exception
+    :param stalled: Whether the request was aborted for receiving no data.
+    :type stalled: bool
+    :param stall_timeout: The seconds without data after which it was aborted.
+    :type stall_timeout: float
+    :rtype: str
+    """
+    if stalled:
+        return f"No data received for {stall_timeout:g} seconds."
+    return str(error) or type(error).__name__
+
+
+class ErrorBudget:
+    """
+    Decides what happens to a download when one of its requests fails.
+
+    A request that failed in a way retrying can fix spends one error of the budget; the
+    worker then waits a backoff and the rest of the segment, from the last byte written,
+    is requested again. A mirror that keeps failing is dropped while there are others.
+    Only when the budget is used up, or the last mirror fails in a way retrying cannot
+    fix, does the download fail.
+
+    Every request that completes refills the budget, so it limits the failures in a row
+    across all workers rather than over the whole download: a large download that keeps
+    making progress through occasional resets never runs out, while one whose server has
+    gone away gives up after max_errors attempts with growing backoffs.
+    """
+
+    def __init__(self, max_errors=ERROR_BUDGET):
+        """
+        Initializes an ErrorBudget instance.
+
+        :param max_errors: The number of failed requests in a row the download survives,
+            or None for no limit. Defaults to ERROR_BUDGET.
+        :type max_errors: int
+        """
+        self.max_errors = max_errors
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def succeeded(self):
+        """Refills the budget after a request has completed."""
+        self.errors = 0
+
+    def failed(self, mirrors, mirror, error, message):
+        """
+        Counts a failed request and decides whether the download can go on.
+
+        :param mirrors: The mirrors of the download.
+        :type mirrors: MirrorSet
+        :param mirror: The mirror the request went to.
+        :type mirror: Mirror
+        :param error: The exception the request failed with.
+        :type error: Exception
+        :param message: The description of the failure, see error_message.
+        :type message: str
+        :return: True if the request should be retried after a backoff, False if the
+            mirror was dropped and the next request can go to another one right away.
+        :rtype: bool
+        :raises: Exception if the download should fail.
+        """
+        if not is_retryable(error):
+            if mirrors.drop(mirror, message):
+                return False
+            raise error
+        with self.lock:
+            self.errors += 1
+            errors = self.errors
+        if self.max_errors is not None and errors > self.max_errors:
+            raise Exception(f"Gave up after {errors} failed requests. The last one failed with: {message}")
+        return not mirrors.failed(mirror, message)
@@ -0,0 +1,11 @@
+import pytest
+
+import cli
+
+
+def test_http2_without_h2_is_a_usage_error(monkeypatch, capsys):
+    monkeypatch.setattr(cli, 'HTTP2_SUPPORTED', False)
+    with pytest.raises(SystemExit) as exit_info:
+        cli.main(['--engine', 'http2', 'http://127.0.0.1:1/file.bin'])
+    assert exit_info.value.code == 2
+    assert 'pip install h2' in capsys.readouterr().err
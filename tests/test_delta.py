@@ -0,0 +1,97 @@
+import random
+
+import pytest
+
+import cli
+from bench import BenchServer, make_data
+from delta import DeltaManifest
+
+BLOCK_SIZE = 64 * 1024
+SIZE = 4 * 1024 * 1024
+
+
+def modified(data):
+    """
+    Returns a copy of data with a few bytes changed in one block, and a few bytes inserted
+    further on, which shifts every block after them.
+    """
+    changed = bytearray(data)
+    changed[100000:100010] = bytes(10)
+    return bytes(changed[:2000000]) + b'inserted' + bytes(changed[2000000:])
+
+
+class ManifestServer(BenchServer):
+    """A server that also serves a manifest at /manifest.json."""
+
+    manifest = b''
+
+    def data_for_path(self, path):
+        if path == '/manifest.json':
+            return memoryview(self.manifest)
+        return super().data_for_path(path)
+
+
+def manifest_of(tmp_path, data):
+    path = tmp_path / 'new.bin'
+    path.write_bytes(data)
+    return DeltaManifest.make(str(path), BLOCK_SIZE)
+
+
+def test_match_finds_unchanged_and_shifted_blocks(tmp_path):
+    data = make_data(SIZE)
+    manifest = manifest_of(tmp_path, data)
+    basis = tmp_path / 'old.bin'
+    basis.write_bytes(modified(data))
+    plan = manifest.match(str(basis))
+    blocks = SIZE // BLOCK_SIZE
+    assert set(range(blocks)) - set(plan.found) == {100000 // BLOCK_SIZE, 2000000 // BLOCK_SIZE}
+    assert plan.first_missing() == BLOCK_SIZE
+    assert plan.found[blocks - 1] == (blocks - 1) * BLOCK_SIZE + len(b'inserted')
+
+
+def test_match_without_basis_finds_nothing(tmp_path):
+    manifest = manifest_of(tmp_path, make_data(SIZE))
+    plan = manifest.match(str(tmp_path / 'missing.bin'))
+    assert plan.found == {}
+    assert plan.first_missing() == 0
+
+
+def test_manifest_round_trip(tmp_path):
+    manifest = manifest_of(tmp_path, random.Random(0).randbytes(300000))
+    manifest.save(str(tmp_path / 'manifest.json'))
+    loaded = DeltaManifest.load(str(tmp_path / 'manifest.json'))
+    assert (loaded.size, loaded.block_size, loaded.strong) == (manifest.size, manifest.block_size, manifest.strong)
+
+
+def test_manifest_is_downloaded(make_server, tmp_path):
+    manifest = manifest_of(tmp_path, random.Random(0).randbytes(300000))
+    manifest.save(str(tmp_path / 'manifest.json'))
+    manifest_server = make_server(ManifestServer)
+    manifest_server.manifest = (tmp_path / 'manifest.json').read_bytes()
+    loaded = DeltaManifest.load(f"{manifest_server.url}/manifest.json")
+    assert (loaded.size, loaded.block_size, loaded.strong) == (manifest.size, manifest.block_size, manifest.strong)
+
+
+def test_manifest_url_with_an_error_status_is_a_value_error(server):
+    with pytest.raises(ValueError, match='404'):
+        DeltaManifest.load(f"{server}/manifest.json")
+
+
+def test_missing_manifest_is_a_usage_error(server, tmp_path, capsys):
+    with pytest.raises(SystemExit) as exit_info:
+        cli.main(['-q', '--delta', f"{server}/manifest.json", '-o', str(tmp_path / 'file.bin'), f"{server}/{SIZE}.bin"])
+    assert exit_info.value.code == 2
+    assert 'Cannot download the delta manifest' in capsys.readouterr().err
+
+
+def test_delta_download_fetches_only_changed_blocks(server, download, engine, tmp_path):
+    data = make_data(SIZE)
+    manifest = manifest_of(tmp_path, data)
+    basis = tmp_path / 'old.bin'
+    basis.write_bytes(modified(data))
+    manager = download(f"{server}/{SIZE}.bin", str(tmp_path / 'file.bin'), engine=engine, num_threads=4,
+                       delta=manifest, basis=str(basis))
+    assert manager.errors == []
+    assert manager.stats()['bytes'] <= 3 * BLOCK_SIZE
+    with open(manager.save_path, 'rb') as f:
+        assert f.read() == data
@@ -0,0 +1,220 @@
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+from bench import H2_PREFACE, SEND_BLOCK_SIZE, BenchServer, make_data, select_range
+from http2_engine import H2C_PROBE_TIMEOUT, HTTP2_SUPPORTED
+from mirrors import MIRROR_MAX_FAILURES, MirrorSet
+from retry import ErrorBudget, StatusError
+
+SIZE = 8 * 1024 * 1024
+PIECE_SIZE = 256 * 1024
+
+
+def test_download(server, download, engine):
+    manager = download(f"{server}/{SIZE}.bin", engine=engine, num_threads=4, piece_size=PIECE_SIZE)
+    assert manager.errors == []
+    with open(manager.save_path, 'rb') as f:
+        assert f.read() == make_data(SIZE)
+
+
+def test_connections_are_reused(server, download, engine):
+    manager = download(f"{server}/{SIZE}.bin", engine=engine, num_threads=4, piece_size=PIECE_SIZE)
+    stats = manager.stats()
+    assert manager.errors == []
+    assert stats['requests'] >= SIZE // PIECE_SIZE
+    assert stats['connections'] <= 4 + 2
+
+
+def test_failed_requests_are_retried(make_server, download, engine):
+    flaky = make_server(error_rate=0.1, seed=1)
+    manager = download(f"{flaky.url}/{SIZE}.bin", engine=engine, num_threads=4, piece_size=PIECE_SIZE)
+    assert manager.errors == []
+    assert manager.stats()['failed'] > 0
+    with open(manager.save_path, 'rb') as f:
+        assert f.read() == make_data(SIZE)
+
+
+def test_error_budget_counts_failures_in_a_row():
+    budget = ErrorBudget(max_errors=2)
+    mirrors = MirrorSet(['http://a/a.bin'])
+    mirror = mirrors.mirrors[0]
+    assert budget.failed(mirrors, mirror, ConnectionError(), 'reset')
+    assert budget.failed(mirrors, mirror, StatusError(503, '503'), '503')
+    budget.succeeded()
+    assert budget.failed(mirrors, mirror, TimeoutError(), 'timeout')
+    assert budget.failed(mirrors, mirror, ConnectionError(), 'reset')
+    with pytest.raises(Exception, match='Gave up after 3 failed requests'):
+        budget.failed(mirrors, mirror, ConnectionError(), 'reset')
+
+
+def test_error_that_retrying_cannot_fix_fails_the_last_mirror():
+    mirrors = MirrorSet(['http://a/a.bin', 'http://b/a.bin'])
+    first, second = mirrors.mirrors
+    budget = ErrorBudget()
+    assert not budget.failed(mirrors, first, StatusError(404, '404'), '404')
+    assert first.dropped
+    with pytest.raises(StatusError):
+        budget.failed(mirrors, second, StatusError(404, '404'), '404')
+    assert budget.errors == 0
+
+
+class SilentServer(BenchServer):
+    """An HTTP/1.1 server that waits for more of a request after the HTTP/2 preface."""
+
+    def finish_request(self, request, client_address):
+        if request.recv(len(H2_PREFACE), socket.MSG_PEEK | socket.MSG_WAITALL) == H2_PREFACE:
+            while request.recv(SEND_BLOCK_SIZE):
+                pass
+            return
+        super().finish_request(request, client_address)
+
+
+def test_http2_falls_back_to_http1(http1_server, download, engine):
+    started = time.monotonic()
+    manager = download(f"{http1_server}/{SIZE}.bin", engine=engine, num_threads=4, piece_size=PIECE_SIZE)
+    assert time.monotonic() - started < 2
+    assert manager.errors == []
+    with open(manager.save_path, 'rb') as f:
+        assert f.read() == make_data(SIZE)
+
+
+@pytest.mark.skipif(not HTTP2_SUPPORTED, reason="needs the h2 package")
+def test_http2_falls_back_from_a_silent_server(make_server, download):
+    silent = make_server(SilentServer, http2=False)
+    started = time.monotonic()
+    manager = download(f"{silent.url}/{SIZE}.bin", engine='http2', num_threads=4, piece_size=PIECE_SIZE)
+    assert time.monotonic() - started < H2C_PROBE_TIMEOUT + 2
+    assert manager.errors == []
+    with open(manager.save_path, 'rb') as f:
+        assert f.read() == make_data(SIZE)
+
+
+class TruncatingServer(BenchServer):
+    """A server, or proxy, that cuts every response off halfway and ends it cleanly."""
+
+    def respond(self, data, range_header):
+        status, headers, body = select_range(data, range_header)
+        body = body[:len(body) // 2]
+        headers = [(name, str(len(body)) if name == 'Content-Length' else value) for name, value in headers]
+        return status, headers, body
+
+
+def test_truncated_bodies_use_up_the_error_budget(make_server, make_manager, engine):
+    truncating = make_server(TruncatingServer)
+    manager = make_manager(f"{truncating.url}/{SIZE}.bin", engine=engine, num_threads=4,
+                           piece_size=PIECE_SIZE, max_errors=3)
+    thread = threading.Thread(target=manager.run, daemon=True)
+    thread.start()
+    thread.join(60)
+    assert not thread.is_alive()
+    assert manager.errors
+
+
+def test_cancel_during_first_request(make_server, make_manager, engine):
+    slow = make_server(latency=0.5)
+    manager = make_manager(f"{slow.url}/{SIZE}.bin", engine=engine, num_threads=4, piece_size=PIECE_SIZE)
+    thread = threading.Thread(target=manager.run, daemon=True)
+    thread.start()
+    time.sleep(0.1)
+    manager.cancel()
+    thread.join(30)
+    assert not thread.is_alive()
+    assert not os.path.exists(manager.save_path)
+    assert manager.stats()['requests'] == 1
+
+
+class WrongRangeServer(BenchServer):
+    """A mirror that answers every range request but the first byte with a range starting earlier."""
+
+    def respond(self, data, range_header):
+        start, _, end = range_header[len('bytes='):].partition('-')
+        if range_header.startswith('bytes=') and int(start) > 0:
+            range_header = f"bytes={int(start) // 2}-{end}"
+        return select_range(data, range_header)
+
+
+class FailingServer(BenchServer):
+    """A mirror that answers the first byte, for the mirror check, and fails every other request."""
+
+    def respond(self, data, range_header):
+        if range_header == 'bytes=0-0':
+            return select_range(data, range_header)
+        return 500, [('Content-Length', '0')], data[:0]
+
+
+def download_with_mirror(make_server, make_manager, engine, mirror_class):
+    """
+    Downloads from a server slow enough for the mirror to fail a few times, with a mirror
+    of the given class, and returns the manager, with the mirror_dropped events in its
+    dropped attribute, and the mirror.
+    """
+    primary = make_server(latency=0.2)
+    mirror = make_server(mirror_class)
+    manager = make_manager(f"{primary.url}/{SIZE}.bin", engine=engine, num_threads=4, piece_size=PIECE_SIZE,
+                           mirrors=[f"{mirror.url}/{SIZE}.bin"])
+    manager.dropped = []
+    manager.add_listener(lambda event, *args: manager.dropped.append(args)
+                         if event == 'mirror_dropped' else None)
+    manager.run()
+    return manager, mirror
+
+
+def test_mirror_sending_the_wrong_range_is_dropped(make_server, make_manager, engine):
+    manager, mirror = download_with_mirror(make_server, make_manager, engine, WrongRangeServer)
+    assert manager.errors == []
+    assert [url for url, reason in manager.dropped] == [f"{mirror.url}/{SIZE}.bin"]
+    assert 'instead of' in manager.dropped[0][1]
+    with open(manager.save_path, 'rb') as f:
+        assert f.read() == make_data(SIZE)
+
+
+def test_wrong_range_from_the_only_server_is_an_error(make_server, download, engine):
+    wrong = make_server(WrongRangeServer)
+    manager = download(f"{wrong.url}/{SIZE}.bin", engine=engine, num_threads=4, piece_size=PIECE_SIZE)
+    assert manager.errors
+    assert not os.path.exists(manager.save_path)
+
+
+def test_failing_mirror_is_dropped(make_server, make_manager, engine):
+    manager, mirror = download_with_mirror(make_server, make_manager, engine, FailingServer)
+    assert manager.errors == []
+    assert [url for url, reason in manager.dropped] == [f"{mirror.url}/{SIZE}.bin"]
+    assert manager.mirrors.mirrors[1].dropped
+    with open(manager.save_path, 'rb') as f:
+        assert f.read() == make_data(SIZE)
+
+
+def test_segments_follow_the_mirror_speeds():
+    mirrors = MirrorSet(['http://fast/a.bin', 'http://slow/a.bin'])
+    fast, slow = mirrors.mirrors
+    mirrors.put_back(mirrors.pick(fast.url), 300, 1.0)
+    mirrors.put_back(mirrors.pick(slow.url), 100, 1.0)
+    picked = [mirrors.pick() for _ in range(4)]
+    assert [mirror.url for mirror in picked].count(fast.url) == 3
+    assert fast.active == 3 and slow.active == 1
+
+
+def test_faster_mirror_serves_more(make_server, make_manager):
+    primary = make_server(bandwidth=512 * 1024)
+    mirror = make_server()
+    manager = make_manager(f"{primary.url}/{SIZE}.bin", num_threads=4, piece_size=PIECE_SIZE,
+                           mirrors=[f"{mirror.url}/{SIZE}.bin"])
+    manager.run()
+    assert manager.errors == []
+    slow, fast = manager.mirrors.mirrors
+    assert fast.downloaded > 2 * slow.downloaded
+
+
+def test_mirror_failing_in_a_row_is_dropped_unless_last():
+    dropped = []
+    mirrors = MirrorSet(['http://a/a.bin', 'http://b/a.bin'], lambda url, reason: dropped.append(url))
+    first, second = mirrors.mirrors
+    assert [mirrors.failed(first, '500') for _ in range(MIRROR_MAX_FAILURES)] == \
+        [False] * (MIRROR_MAX_FAILURES - 1) + [True]
+    assert dropped == [first.url]
+    assert not any(mirrors.failed(second, '500') for _ in range(MIRROR_MAX_FAILURES))
+    assert len(mirrors) == 1
@@ -0,0 +1,121 @@
+import gzip
+import io
+import os
+import tarfile
+
+import pytest
+
+import extract
+from core import OutputFile, ResumeJournal
+from extract import PrefixExtractor, check_member
+
+
+def tar_archive(members):
+    """
+    Builds a tar archive in memory.
+
+    :param members: (TarInfo, data) pairs, data None for members without a body.
+    :type members: list
+    :rtype: bytes
+    """
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w') as archive:
+        for info, data in members:
+            if data is not None:
+                info.size = len(data)
+            archive.addfile(info, io.BytesIO(data) if data is not None else None)
+    return buffer.getvalue()
+
+
+def file_member(name, data=b'data'):
+    info = tarfile.TarInfo(name)
+    info.mode = 0o644
+    return info, data
+
+
+def link_member(name, target, kind=tarfile.SYMTYPE):
+    info = tarfile.TarInfo(name)
+    info.type = kind
+    info.linkname = target
+    return info, None
+
+
+def extract_file(tmp_path, data, destination):
+    """
+    Runs a PrefixExtractor over a complete file as if it had just been downloaded.
+
+    :return: The error the extractor reported, or None.
+    """
+    save_path = str(tmp_path / 'archive')
+    output = OutputFile(save_path, len(data), False)
+    output.write_at(data, 0)
+    journal = ResumeJournal(save_path, len(data))
+    journal.record(0, len(data) - 1)
+    extractor = PrefixExtractor(output, journal, str(destination))
+    extractor.start()
+    try:
+        extractor.finish()
+    except Exception as e:
+        return e
+    finally:
+        output.close()
+    return None
+
+
+@pytest.fixture(params=['filter', 'check_member'])
+def tar_filter(request, monkeypatch):
+    """Unpacks with tarfile's data filter, and as on Pythons without it."""
+    if request.param == 'check_member':
+        monkeypatch.delattr(extract.tarfile, 'data_filter', raising=False)
+    elif not hasattr(tarfile, 'data_filter'):
+        pytest.skip("tarfile has no extraction filters")
+    return request.param
+
+
+def test_tar_gz_is_unpacked(tmp_path, tar_filter):
+    data = gzip.compress(tar_archive([file_member('dir/a.txt', b'a' * 100000), file_member('b.txt', b'b')]))
+    assert extract_file(tmp_path, data, tmp_path / 'out') is None
+    assert (tmp_path / 'out' / 'dir' / 'a.txt').read_bytes() == b'a' * 100000
+    assert (tmp_path / 'out' / 'b.txt').read_bytes() == b'b'
+
+
+def test_single_file_is_decompressed(tmp_path):
+    assert extract_file(tmp_path, gzip.compress(b'x' * 100000), tmp_path / 'out.bin') is None
+    assert (tmp_path / 'out.bin').read_bytes() == b'x' * 100000
+
+
+def test_unknown_format_is_refused(tmp_path):
+    assert isinstance(extract_file(tmp_path, b'PK\x03\x04' + bytes(600), tmp_path / 'out'), ValueError)
+
+
+@pytest.mark.parametrize('member', [
+    file_member('../escape.txt'),
+    link_member('link', '/etc/passwd'),
+    link_member('link', '../../outside'),
+    link_member('hard', '../outside', tarfile.LNKTYPE),
+], ids=['parent', 'absolute-link', 'relative-link', 'hard-link'])
+def test_unsafe_members_are_refused(tmp_path, tar_filter, member):
+    destination = tmp_path / 'out'
+    assert extract_file(tmp_path, tar_archive([member]), destination) is not None
+    assert not (tmp_path / 'escape.txt').exists()
+    assert not os.path.lexists(destination / 'link')
+
+
+def test_absolute_paths_stay_inside(tmp_path, tar_filter):
+    name = str(tmp_path / 'absolute.txt')
+    extract_file(tmp_path, tar_archive([file_member(name)]), tmp_path / 'out')
+    assert not os.path.exists(name)
+
+
+def test_device_files_are_refused():
+    info = tarfile.TarInfo('device')
+    info.type = tarfile.CHRTYPE
+    with pytest.raises(ValueError):
+        check_member(info, '/tmp/out')
+
+
+def test_set_user_id_bit_is_dropped(tmp_path, tar_filter):
+    info, data = file_member('tool')
+    info.mode = 0o4777
+    assert extract_file(tmp_path, tar_archive([(info, data)]), tmp_path / 'out') is None
+    assert os.stat(tmp_path / 'out' / 'tool').st_mode & 0o7777 == 0o755
@@ -0,0 +1,21 @@
+import os
+
+from bench import make_data
+
+SIZE = 16 * 1024 * 1024
+PIECE_SIZE = 1024 * 1024
+
+
+def test_empty_file(server, download, engine):
+    manager = download(f"{server}/0.bin", engine=engine)
+    assert manager.errors == []
+    assert manager.total_size == 0
+    assert os.path.getsize(manager.save_path) == 0
+
+
+def test_first_request_stops_at_first_segment(server, download, engine):
+    manager = download(f"{server}/{SIZE}.bin", engine=engine, num_threads=4, piece_size=PIECE_SIZE)
+    assert manager.errors == []
+    with open(manager.save_path, 'rb') as f:
+        assert f.read() == make_data(SIZE)
+    assert manager.stats()['bytes'] < SIZE + PIECE_SIZE
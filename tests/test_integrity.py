@@ -0,0 +1,88 @@
+import hashlib
+import os
+
+from bench import BenchServer, make_data
+from integrity import CHUNK_RETRIES, ChunkHashList
+
+SIZE = 8 * 1024 * 1024
+CHUNK_SIZE = 256 * 1024
+CORRUPT_OFFSET = 5 * CHUNK_SIZE + 1000
+
+
+class CorruptingServer(BenchServer):
+    """
+    A server flipping the byte at CORRUPT_OFFSET in the first few responses to a range
+    starting at its chunk. Downloaded in pieces of CHUNK_SIZE, such a response is read in
+    full.
+    """
+
+    corruptions = 1
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.corrupted = 0
+
+    def respond(self, data, range_header):
+        status, headers, body = super().respond(data, range_header)
+        start = CORRUPT_OFFSET // CHUNK_SIZE * CHUNK_SIZE
+        if range_header.startswith(f"bytes={start}-"):
+            with self.lock:
+                corrupt = self.corrupted < self.corruptions
+                self.corrupted += corrupt
+            if corrupt:
+                body = bytearray(body)
+                body[CORRUPT_OFFSET - start] ^= 0xff
+        return status, headers, body
+
+
+class AlwaysCorruptingServer(CorruptingServer):
+    """A server that never sends the byte at CORRUPT_OFFSET right."""
+
+    corruptions = float('inf')
+
+
+def chunk_hashes(data):
+    """Returns the SHA-256 chunk hash list of the data."""
+    return ChunkHashList('sha256', CHUNK_SIZE, [hashlib.sha256(data[start:start + CHUNK_SIZE]).hexdigest()
+                                                for start in range(0, len(data), CHUNK_SIZE)])
+
+
+def test_corrupted_chunk_is_downloaded_again(make_server, download, engine):
+    bench_server = make_server(CorruptingServer)
+    data = make_data(SIZE)
+    manager = download(f"{bench_server.url}/{SIZE}.bin", engine=engine, num_threads=4,
+                       piece_size=CHUNK_SIZE, chunk_hashes=chunk_hashes(data))
+    assert manager.errors == []
+    assert bench_server.corrupted == 1
+    assert manager.verifier.failures == {CORRUPT_OFFSET // CHUNK_SIZE: 1}
+    with open(manager.save_path, 'rb') as f:
+        assert f.read() == data
+
+
+def test_chunk_failing_every_time_is_an_error(make_server, download):
+    bench_server = make_server(AlwaysCorruptingServer)
+    manager = download(f"{bench_server.url}/{SIZE}.bin", num_threads=4, piece_size=CHUNK_SIZE,
+                       chunk_hashes=chunk_hashes(make_data(SIZE)))
+    assert manager.errors
+    assert f"failed verification {CHUNK_RETRIES + 1} times" in manager.errors[0]
+    assert not os.path.exists(manager.save_path)
+
+
+def test_digest_mismatch_discards_the_download(server, download, engine):
+    data = make_data(SIZE)
+    wrong = hashlib.sha256(data + b'x').hexdigest()
+    manager = download(f"{server}/{SIZE}.bin", engine=engine, num_threads=4, digest=f"sha256:{wrong}")
+    assert len(manager.errors) == 1
+    assert f"got {hashlib.sha256(data).hexdigest()}" in manager.errors[0]
+    for suffix in ('', '.part', '.journal'):
+        assert not os.path.exists(manager.save_path + suffix)
+
+
+def test_matching_digest_keeps_the_download(server, download, engine):
+    data = make_data(SIZE)
+    manager = download(f"{server}/{SIZE}.bin", engine=engine, num_threads=4,
+                       digest=hashlib.sha256(data).hexdigest())
+    assert manager.errors == []
+    with open(manager.save_path, 'rb') as f:
+        assert f.read() == data
+    assert not os.path.exists(manager.save_path + '.journal')
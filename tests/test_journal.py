@@ -0,0 +1,85 @@
+import time
+
+from bench import make_data
+from core import JOURNAL_INTERVAL, ResumeJournal
+
+SIZE = 4 * 1024 * 1024
+PIECE_SIZE = 256 * 1024
+
+
+class SlowOutput:
+    """An output file whose fsync takes a while, like one on a slow disk."""
+
+    def __init__(self):
+        self.synced = 0
+
+    def sync(self):
+        time.sleep(0.5)
+        self.synced += 1
+
+
+def test_record_does_not_wait_for_flush(tmp_path):
+    journal = ResumeJournal(str(tmp_path / 'file.bin'), 100)
+    journal.output = SlowOutput()
+    journal.last_flush -= JOURNAL_INTERVAL
+    started = time.monotonic()
+    journal.record(0, 49)
+    assert time.monotonic() - started < 0.25
+    journal.wait()
+    assert journal.output.synced == 1
+    loaded = ResumeJournal.load(str(tmp_path / 'file.bin'))
+    assert loaded.done.ranges == [(0, 49)]
+
+
+def test_journal_round_trip(tmp_path):
+    journal = ResumeJournal(str(tmp_path / 'file.bin'), 100, '"etag"', 'Mon, 01 Jan 2024 00:00:00 GMT')
+    journal.record(50, 59)
+    journal.record(0, 9)
+    journal.record(10, 19)
+    with journal.flush_lock:
+        journal.flush()
+    loaded = ResumeJournal.load(str(tmp_path / 'file.bin'))
+    assert loaded.done.ranges == [(0, 19), (50, 59)]
+    assert loaded.prefix() == 20
+    assert loaded.matches(100, '"etag"', 'Mon, 01 Jan 2024 00:00:00 GMT')
+    assert not loaded.matches(100, '"other"', 'Mon, 01 Jan 2024 00:00:00 GMT')
+    loaded.remove()
+    assert ResumeJournal.load(str(tmp_path / 'file.bin')) is None
+
+
+def leave_partial_download(save_path, data, done, etag='"bench"'):
+    """
+    Leaves what an interrupted download of data would have: the output file with the
+    done ranges written, and a journal recording them.
+    """
+    with open(f"{save_path}.part", 'wb') as f:
+        f.truncate(len(data))
+        for start, end in done:
+            f.seek(start)
+            f.write(data[start:end + 1])
+    journal = ResumeJournal(save_path, len(data), etag, None, done)
+    journal.flush()
+
+
+def test_download_resumes_from_journal(server, download, engine, tmp_path):
+    data = make_data(SIZE)
+    save_path = str(tmp_path / 'file.bin')
+    leave_partial_download(save_path, data, [(0, SIZE // 2 - 1)])
+    manager = download(f"{server}/{SIZE}.bin", save_path, engine=engine, num_threads=4, piece_size=PIECE_SIZE)
+    assert manager.errors == []
+    assert manager.resumed_bytes == SIZE // 2
+    assert manager.stats()['bytes'] <= SIZE // 2 + PIECE_SIZE
+    with open(save_path, 'rb') as f:
+        assert f.read() == data
+    assert ResumeJournal.load(save_path) is None
+
+
+def test_changed_file_is_not_resumed(server, download, engine, tmp_path):
+    data = make_data(SIZE)
+    save_path = str(tmp_path / 'file.bin')
+    leave_partial_download(save_path, bytes(SIZE), [(0, SIZE // 2 - 1)], etag='"older"')
+    manager = download(f"{server}/{SIZE}.bin", save_path, engine=engine, num_threads=4, piece_size=PIECE_SIZE)
+    assert manager.errors == []
+    assert manager.resumed_bytes == 0
+    with open(save_path, 'rb') as f:
+        assert f.read() == data
@@ -0,0 +1,64 @@
+import json
+
+import requests
+
+import cli
+from bench import make_data
+from metrics import DownloadMetrics, MetricsServer, prometheus_text
+
+SIZE = 8 * 1024 * 1024
+PIECE_SIZE = 256 * 1024
+
+
+def test_series_of_downloads_of_the_same_url_stay_apart():
+    stats_list = [DownloadMetrics('http://example.com/a.bin', path).stats() for path in ('/tmp/a', '/tmp/b')]
+    lines = prometheus_text(stats_list).splitlines()
+    assert 'quickdownloader_bytes_total{url="http://example.com/a.bin",path="/tmp/a"} 0' in lines
+    assert 'quickdownloader_bytes_total{url="http://example.com/a.bin",path="/tmp/b"} 0' in lines
+    assert 'quickdownloader_latency_seconds_count{url="http://example.com/a.bin",path="/tmp/b",phase="ttfb"} 0' \
+        in lines
+
+
+def test_labels_are_escaped():
+    text = prometheus_text([DownloadMetrics('http://example.com/"a"', 'C:\\a\nb').stats()])
+    assert 'url="http://example.com/\\"a\\"",path="C:\\\\a\\nb"' in text
+
+
+def test_metrics_server(server, download):
+    manager = download(f"{server}/{SIZE}.bin", num_threads=4, piece_size=PIECE_SIZE)
+    metrics_server = MetricsServer(0, lambda: [manager.stats()])
+    base = f"http://127.0.0.1:{metrics_server.server_address[1]}"
+    try:
+        stats = requests.get(f"{base}/stats", timeout=10).json()
+        assert stats[0]['url'] == manager.url
+        assert stats[0]['save_path'] == manager.save_path
+        assert stats[0]['bytes'] == SIZE
+        assert stats[0]['requests'] >= SIZE // PIECE_SIZE
+
+        response = requests.get(f"{base}/metrics", timeout=10)
+        assert response.headers['Content-Type'].startswith('text/plain')
+        labels = f'url="{manager.url}",path="{manager.save_path}"'
+        assert f"quickdownloader_bytes_total{{{labels}}} {SIZE}" in response.text.splitlines()
+
+        assert requests.get(f"{base}/other", timeout=10).status_code == 404
+    finally:
+        metrics_server.close()
+
+
+def test_trace(server, tmp_path, monkeypatch):
+    monkeypatch.setattr('sys.stdin', None)
+    url = f"{server}/{SIZE}.bin"
+    trace_path = tmp_path / 'trace.jsonl'
+    save_path = tmp_path / 'file.bin'
+    assert cli.main(['-q', '--trace', str(trace_path), '-o', str(save_path), url]) == 0
+    assert save_path.read_bytes() == make_data(SIZE)
+
+    events = [json.loads(line) for line in trace_path.read_text().splitlines()]
+    assert events[0]['event'] == 'download_started'
+    assert events[0]['url'] == url and events[0]['save_path'] == str(save_path) and events[0]['size'] == SIZE
+    assert events[-1]['event'] == 'download_finished'
+    assert events[-1]['bytes'] == SIZE and events[-1]['error'] is None
+    segments = [event for event in events if event['event'] == 'segment']
+    assert len(segments) == events[-1]['requests']
+    assert sum(segment['bytes'] for segment in segments) == SIZE
+    assert all(segment['download'] == url and segment['outcome'] == 'done' for segment in segments)
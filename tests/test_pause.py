@@ -0,0 +1,40 @@
+import os
+import threading
+import time
+
+from bench import make_data
+
+SIZE = 8 * 1024 * 1024
+PIECE_SIZE = 256 * 1024
+
+
+def wait_until(condition, timeout=30):
+    """Waits until the condition holds, for at most timeout seconds."""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_pause_and_resume(make_server, make_manager, engine):
+    slow = make_server(bandwidth=2 * 1024 * 1024)
+    manager = make_manager(f"{slow.url}/{SIZE}.bin", engine=engine, num_threads=4, piece_size=PIECE_SIZE)
+    thread = threading.Thread(target=manager.run, daemon=True)
+    thread.start()
+    wait_until(lambda: manager.bytes_downloaded() > SIZE // 4)
+
+    manager.pause()
+    wait_until(lambda: not manager.stats()['active'])
+    paused_at = manager.bytes_downloaded()
+    time.sleep(0.5)
+    assert manager.bytes_downloaded() == paused_at < SIZE
+    assert not manager.stats()['active']
+    assert os.path.exists(manager.save_path + '.journal')
+
+    manager.resume()
+    thread.join(60)
+    assert not thread.is_alive()
+    assert manager.errors == []
+    assert manager.stats()['bytes'] == SIZE
+    with open(manager.save_path, 'rb') as f:
+        assert f.read() == make_data(SIZE)
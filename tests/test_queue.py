@@ -0,0 +1,79 @@
+import threading
+import time
+
+from bench import make_data
+from core import ConnectionLimiter
+from download_queue import DownloadQueue
+
+SIZE = 2 * 1024 * 1024
+
+
+def record_peaks(limiter):
+    """
+    Makes a limiter remember the most slots it ever had taken, overall and per host.
+
+    :return: The peaks: 'total' and one entry per host key.
+    :rtype: dict
+    """
+    peaks = {'total': 0}
+    take = limiter.take
+
+    def counting_take(key):
+        take(key)
+        peaks['total'] = max(peaks['total'], limiter.active)
+        peaks[key] = max(peaks.get(key, 0), limiter.active_per_host[key])
+    limiter.take = counting_take
+    return peaks
+
+
+def test_queue_keeps_to_the_limits(make_server, tmp_path):
+    slow = make_server(latency=0.02)
+    port = slow.server_address[1]
+    queue = DownloadQueue(str(tmp_path), num_threads=4, max_downloads=4, max_connections=3, max_per_host=2,
+                          update_interval=None)
+    peaks = record_peaks(queue.limiter)
+    for number, host in enumerate(('127.0.0.1', 'localhost', '127.0.0.1', 'localhost')):
+        queue.add(f"http://{host}:{port}/{SIZE}.bin", str(tmp_path / f"{number}.bin"))
+    queue.run()
+    assert [job.error for job in queue.jobs] == [None] * 4
+    assert peaks['total'] == 3
+    assert max(value for key, value in peaks.items() if key != 'total') == 2
+    for number in range(4):
+        assert (tmp_path / f"{number}.bin").read_bytes() == make_data(SIZE)
+
+
+def test_cancel_wakes_a_download_waiting_for_a_slot(make_server, make_manager, tmp_path):
+    slow = make_server(bandwidth=256 * 1024)
+    limiter = ConnectionLimiter(max_connections=1)
+    holder = make_manager(f"{slow.url}/{4 * SIZE}.bin", str(tmp_path / 'first.bin'), num_threads=1, limiter=limiter)
+    waiter = make_manager(f"{slow.url}/{4 * SIZE}.bin", str(tmp_path / 'second.bin'), num_threads=1, limiter=limiter)
+    threads = [threading.Thread(target=manager.run, daemon=True) for manager in (holder, waiter)]
+    threads[0].start()
+    time.sleep(0.3)
+    threads[1].start()
+    time.sleep(0.3)
+    waiter.cancel()
+    threads[1].join(5)
+    assert not threads[1].is_alive()
+    holder.cancel()
+    threads[0].join(5)
+
+
+def test_cancelled_acquire_gives_up():
+    limiter = ConnectionLimiter(max_connections=1)
+    limiter.acquire('http://host/a')
+    cancelled = threading.Event()
+    errors = []
+
+    def wait():
+        try:
+            limiter.acquire('http://host/b', cancelled.is_set)
+        except Exception as e:
+            errors.append(e)
+    waiter = threading.Thread(target=wait)
+    waiter.start()
+    cancelled.set()
+    limiter.wake()
+    waiter.join(5)
+    assert not waiter.is_alive()
+    assert errors and limiter.active == 1
@@ -0,0 +1,115 @@
+import pytest
+import requests
+
+from bench import select_range
+from core import RangeSet, SegmentScheduler, content_range
+
+
+def response(status, headers):
+    result = requests.Response()
+    result.status_code = status
+    result.headers.update(headers)
+    return result
+
+
+@pytest.mark.parametrize('status, headers, expected', [
+    (206, {'Content-Range': 'bytes 100-199/1000'}, (100, 1000)),
+    (206, {'Content-Range': 'bytes 0-99/*'}, (0, None)),
+    (416, {'Content-Range': 'bytes */0'}, (0, 0)),
+    (416, {'Content-Range': 'bytes */1000'}, (0, 1000)),
+    (206, {'Content-Range': 'garbage'}, (0, None)),
+    (200, {'Content-Length': '1000'}, (0, 1000)),
+    (200, {}, (0, None)),
+])
+def test_content_range(status, headers, expected):
+    assert content_range(response(status, headers)) == expected
+
+
+def test_range_set_merges_touching_ranges():
+    ranges = RangeSet([(10, 19), (30, 39)])
+    ranges.add(20, 29)
+    assert ranges.ranges == [(10, 39)]
+    assert ranges.size == 30
+
+
+def test_range_set_missing():
+    ranges = RangeSet([(0, 9), (20, 29)])
+    assert ranges.missing(40) == [(10, 19), (30, 39)]
+    assert RangeSet().missing(5) == [(0, 4)]
+    assert RangeSet([(0, 4)]).missing(5) == []
+
+
+def test_select_range():
+    data = memoryview(bytes(range(10)))
+    status, headers, body = select_range(data, 'bytes=2-4')
+    assert status == 206 and bytes(body) == bytes([2, 3, 4])
+    assert ('Content-Range', 'bytes 2-4/10') in headers
+    status, headers, body = select_range(data, 'bytes=8-')
+    assert status == 206 and bytes(body) == bytes([8, 9])
+    status, headers, body = select_range(data, 'bytes=10-')
+    assert status == 416 and ('Content-Range', 'bytes */10') in headers
+    assert select_range(data, '')[0] == 200
+
+
+def test_scheduler_cuts_ranges_into_pieces():
+    scheduler = SegmentScheduler([(0, 249), (500, 599)], 100, min_split=10)
+    pieces = []
+    while scheduler.pending:
+        segment = scheduler.acquire()
+        pieces.append((segment.position, segment.end))
+    assert pieces == [(0, 99), (100, 199), (200, 249), (500, 599)]
+
+
+def test_idle_worker_steals_back_half():
+    scheduler = SegmentScheduler([(0, 999)], 1000, min_split=10)
+    victim = scheduler.acquire()
+    scheduler.claim(victim, 100)
+    thief = scheduler.acquire()
+    assert (thief.position, thief.end) == (550, 999)
+    assert (victim.position, victim.end) == (100, 549)
+    assert scheduler.claim(victim, 1000) == 450
+
+
+def test_steal_takes_the_segment_with_most_left():
+    scheduler = SegmentScheduler([(0, 999), (1000, 1999)], 1000, min_split=10)
+    first = scheduler.acquire()
+    second = scheduler.acquire()
+    scheduler.claim(first, 800)
+    thief = scheduler.acquire()
+    assert second.end == thief.position - 1
+    assert thief.end == 1999
+
+
+def test_no_split_below_min_split():
+    scheduler = SegmentScheduler([(0, 99)], 100, min_split=60)
+    scheduler.acquire()
+    assert scheduler.acquire() is None
+
+
+def test_split_is_aligned():
+    scheduler = SegmentScheduler([(0, 999)], 1000, min_split=10, align=64)
+    victim = scheduler.acquire()
+    thief = scheduler.acquire()
+    assert thief.position % 64 == 0
+    assert victim.end == thief.position - 1
+
+
+def test_split_follows_speeds():
+    scheduler = SegmentScheduler([(0, 999)], 1000, min_split=10, speed_of=lambda segment: 1.0)
+    scheduler.acquire()
+    thief = scheduler.acquire(speed=3.0)
+    assert thief.remaining == 750
+
+
+def test_released_segment_is_requeued_first():
+    scheduler = SegmentScheduler([(0, 299)], 100, min_split=10)
+    segment = scheduler.acquire()
+    scheduler.claim(segment, 40)
+    scheduler.release(segment)
+    requeued = scheduler.acquire()
+    assert (requeued.position, requeued.end) == (40, 99)
+    assert segment not in scheduler.active
+    finished = scheduler.acquire()
+    scheduler.claim(finished, 100)
+    scheduler.release(finished)
+    assert scheduler.acquire().position == 200
@@ -0,0 +1,96 @@
+import io
+import threading
+import time
+
+import pytest
+
+import cli
+from bench import make_data
+from core import MIN_READ_SIZE, RATE_BURST_TIME, RateLimiter, global_rate_limiter
+
+MB = 1024 * 1024
+SIZE = 2 * MB
+TOLERANCE = 0.25
+
+
+@pytest.fixture
+def global_limit():
+    """Sets the limit over all downloads for a test and lifts it afterwards."""
+    yield global_rate_limiter.set_rate
+    global_rate_limiter.set_rate(None)
+
+
+def test_bucket_starts_full_and_goes_into_debt():
+    limiter = RateLimiter(1024 * 1024)
+    capacity = max(1024 * 1024 * RATE_BURST_TIME, MIN_READ_SIZE)
+    assert limiter.reserve(capacity / 2) == 0.0
+    wait = limiter.reserve(capacity)
+    assert wait == pytest.approx(capacity / 2 / (1024 * 1024), rel=0.05)
+
+
+def test_debt_carries_over():
+    limiter = RateLimiter(1024 * 1024)
+    limiter.reserve(limiter.capacity)
+    first = limiter.reserve(MB)
+    second = limiter.reserve(MB)
+    assert second == pytest.approx(first + 1.0, rel=0.05)
+
+
+def test_rate_change_keeps_debt():
+    limiter = RateLimiter(1024 * 1024)
+    limiter.reserve(limiter.capacity + MB)
+    limiter.set_rate(2 * 1024 * 1024)
+    assert limiter.reserve(0) == pytest.approx(0.5, rel=0.05)
+    limiter.set_rate(None)
+    assert limiter.reserve(MB) == 0.0
+
+
+def test_commands_change_the_limits(global_limit):
+    class Manager:
+        rate = None
+
+        def set_rate_limit(self, rate):
+            self.rate = rate
+    manager = Manager()
+    output = io.StringIO()
+    cli.read_commands(manager, io.StringIO("limit 512K\nfile-limit 1M\nspeed 1M\n"), output)
+    assert global_rate_limiter.rate == 512 * 1024
+    assert manager.rate == MB
+    assert "Unknown command" in output.getvalue()
+
+
+def expected_seconds(size, rate):
+    """The time a download of size bytes takes at rate, once the burst is used up."""
+    return (size - max(rate * RATE_BURST_TIME, MIN_READ_SIZE)) / rate
+
+
+def test_file_limit_is_kept(server, download, engine):
+    rate = MB
+    started = time.monotonic()
+    manager = download(f"{server}/{SIZE}.bin", engine=engine, num_threads=4, rate_limit=rate)
+    elapsed = time.monotonic() - started
+    assert manager.errors == []
+    assert elapsed == pytest.approx(expected_seconds(SIZE, rate), rel=TOLERANCE)
+
+
+def test_global_and_file_limits_apply_together(server, download, global_limit):
+    global_limit(MB / 2)
+    started = time.monotonic()
+    manager = download(f"{server}/{SIZE // 2}.bin", num_threads=4, rate_limit=MB)
+    elapsed = time.monotonic() - started
+    assert manager.errors == []
+    assert elapsed == pytest.approx(expected_seconds(SIZE // 2, MB / 2), rel=TOLERANCE)
+
+
+def test_limit_can_be_lifted_while_downloading(server, make_manager):
+    manager = make_manager(f"{server}/{4 * SIZE}.bin", num_threads=4, rate_limit=MB / 4)
+    thread = threading.Thread(target=manager.run, daemon=True)
+    started = time.monotonic()
+    thread.start()
+    time.sleep(0.5)
+    manager.set_rate_limit(None)
+    thread.join(10)
+    assert not thread.is_alive()
+    assert time.monotonic() - started < 4
+    with open(manager.save_path, 'rb') as f:
+        assert f.read() == make_data(4 * SIZE)
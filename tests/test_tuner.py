@@ -0,0 +1,122 @@
+import time
+
+from bench import BenchServer, make_data
+from core import AUTO, AUTO_MAX_CONNECTIONS, AUTO_START_CONNECTIONS, ConnectionCountCache, ConnectionTuner, \
+    MetadataCache
+
+SIZE = 8 * 1024 * 1024
+
+
+class ThrottlingServer(BenchServer):
+    """A server answering 503 to every range request but the first for its first seconds."""
+
+    throttle_time = 2.5
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.started = None
+
+    def respond(self, data, range_header):
+        if self.started is None:
+            self.started = time.monotonic()
+        elif range_header != 'bytes=0-' and time.monotonic() < self.started + self.throttle_time:
+            return 503, [('Content-Length', '0')], data[:0]
+        return super().respond(data, range_header)
+
+
+def feed(tuner, speeds):
+    """Updates the tuner once a second with the speeds, after a first sample."""
+    total = 0
+    counts = [tuner.update(0.0, total)]
+    for second, speed in enumerate(speeds, 1):
+        total += speed
+        counts.append(tuner.update(float(second), total))
+    return counts
+
+
+def test_tuner_climbs_while_the_speed_improves():
+    tuner = ConnectionTuner(start=2, maximum=32)
+    assert feed(tuner, [100, 200, 300]) == [2, 3, 4, 6]
+    assert not tuner.settled
+    assert tuner.result == 4
+
+
+def test_tuner_settles_on_the_best_count_at_a_plateau():
+    tuner = ConnectionTuner(start=2, maximum=32)
+    assert feed(tuner, [100, 200, 205]) == [2, 3, 4, 3]
+    assert tuner.settled
+    assert tuner.result == 3
+    assert tuner.update(4.0, 1000) == 3
+
+
+def test_tuner_stops_at_the_maximum():
+    tuner = ConnectionTuner(start=2, maximum=3)
+    assert feed(tuner, [100, 200, 300]) == [2, 3, 3, 3]
+    assert tuner.settled
+
+
+def test_tuner_backs_off_when_throttled():
+    tuner = ConnectionTuner(start=4, maximum=32)
+    feed(tuner, [100])
+    tuner.note_throttled()
+    assert tuner.update(2.0, 200) == 5
+    tuner.note_throttled()
+    assert tuner.update(3.0, 300) == 4
+    assert tuner.ceiling == 4
+    assert tuner.settled
+    tuner.note_throttled()
+    assert tuner.update(4.0, 400) == 3
+    assert tuner.update(5.0, 1000) == 3
+
+
+def test_tuner_backs_off_when_the_latency_grows():
+    tuner = ConnectionTuner(start=4, maximum=32)
+    assert feed(tuner, [100]) == [4, 6]
+    tuner.note_latency(0.01)
+    assert tuner.update(2.0, 300) == 9
+    tuner.note_latency(1.0)
+    assert tuner.update(3.0, 600) == 8
+    assert tuner.ceiling == 8
+
+
+def test_skipped_interval_is_not_a_sample():
+    tuner = ConnectionTuner(start=2, maximum=32)
+    feed(tuner, [100, 200])
+    tuner.skip()
+    assert tuner.update(10.0, 310) == 4
+    assert not tuner.settled
+
+
+def test_connection_counts_are_cached_by_host(tmp_path):
+    path = str(tmp_path / 'connections.json')
+    ConnectionCountCache(path).set('http://example.com:8080/a.bin', 7)
+    cache = ConnectionCountCache(path)
+    assert cache.get('http://example.com:8080/b.bin') == 7
+    assert cache.get('http://example.org/a.bin') is None
+
+
+def test_unreadable_caches_are_empty(tmp_path):
+    path = tmp_path / 'cache.json'
+    path.write_text('not json')
+    assert ConnectionCountCache(str(path)).get('http://example.com/a.bin') is None
+    assert MetadataCache(str(path)).get('http://example.com/a.bin', str(tmp_path / 'a.bin')) is None
+
+
+def test_download_starts_from_the_cached_count(server, download, tmp_path):
+    url = f"{server}/{SIZE}.bin"
+    cache = ConnectionCountCache(str(tmp_path / 'connections.json'))
+    cache.set(url, 5)
+    manager = download(url, num_threads=AUTO, connection_cache=cache)
+    assert manager.errors == []
+    assert manager.tuner.count == 5
+    with open(manager.save_path, 'rb') as f:
+        assert f.read() == make_data(SIZE)
+
+
+def test_download_backs_off_when_throttled(make_server, download):
+    bench_server = make_server(ThrottlingServer, bandwidth=2 * 1024 * 1024)
+    manager = download(f"{bench_server.url}/{SIZE}.bin", num_threads=AUTO)
+    assert manager.errors == []
+    assert manager.tuner.ceiling < AUTO_START_CONNECTIONS < AUTO_MAX_CONNECTIONS
+    with open(manager.save_path, 'rb') as f:
+        assert f.read() == make_data(SIZE)